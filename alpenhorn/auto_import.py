@@ -10,10 +10,13 @@ from future.builtins.disabled import *  # noqa  pylint: disable=W0401, W0614
 import time
 import os
 import datetime
+from concurrent import futures
 
-import bisect
 import calendar
+import contextlib
 import configobj
+import sqlite3
+import threading
 
 import peewee as pw
 import numpy as np
@@ -28,6 +31,8 @@ from watchdog.events import FileSystemEventHandler
 import chimedb.core as db
 import chimedb.data_index as di
 
+from . import hashing, metrics, nodestats, schedule
+
 # Setup the logging
 from . import logger
 
@@ -39,10 +44,157 @@ LOCAL_IMPORT_RECORD = "/var/lib/alpenhorn/alpenhornd_import.dat"  # default path
 if "ALPENHORN_IMPORT_RECORD" in os.environ:
     LOCAL_IMPORT_RECORD = os.environ["ALPENHORN_IMPORT_RECORD"]
 
+# Number of threads importing the files found by the watchdogs
+if "ALPENHORN_IMPORT_WORKERS" in os.environ:
+    IMPORT_WORKERS = int(os.environ["ALPENHORN_IMPORT_WORKERS"])
+else:
+    IMPORT_WORKERS = 1
+
+# Maximum number of files waiting to be imported before the watchdogs are made
+# to wait
+IMPORT_QUEUE_SIZE = 10000
+
+# Number of threads hashing the new files in each batch being imported
+if "ALPENHORN_IMPORT_HASH_WORKERS" in os.environ:
+    IMPORT_HASH_WORKERS = int(os.environ["ALPENHORN_IMPORT_HASH_WORKERS"])
+else:
+    IMPORT_HASH_WORKERS = 1
+
+# Maximum number of files from one acquisition which are written to the DB
+# together, in a single transaction
+IMPORT_BATCH_SIZE = 100
+
 import_done = None
 
+import_queue = None
+
 obs_list = None
 
+crawl_thread = None
+_crawl_stop = threading.Event()
+
+# Locks held by the threads adding an acquisition and its information to the
+# DB, keyed by acquisition name, with the number of threads using each.
+_acq_locks = {}
+_acq_locks_lock = threading.Lock()
+
+
+class ImportCache(object):
+    """A record of the files which have already been imported.
+
+    The record is kept in an SQLite database indexed on the full path of the
+    file, so checking for a file and adding a new one don't depend on the
+    number of files already recorded. Records in the old plain-text format (one
+    path per line) are converted when first opened.
+
+    Parameters
+    ----------
+    path : string
+        The file holding the record.
+    """
+
+    _SQLITE_HEADER = b"SQLite format 3\x00"
+
+    def __init__(self, path):
+        self.path = path
+        self._convert_text_record()
+
+        # The cache is shared between the watchdog threads
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            # Write-ahead logging makes adding a record a cheap append which
+            # survives a crash of the daemon.
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS imported (path TEXT PRIMARY KEY)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS crawled (path TEXT PRIMARY KEY, mtime REAL)"
+            )
+            self._conn.commit()
+
+    def _convert_text_record(self):
+        """Convert a plain-text record into an SQLite one, if necessary."""
+        with open(self.path, "rb") as fp:
+            header = fp.read(len(self._SQLITE_HEADER))
+
+        # An empty file is also a valid (empty) SQLite database
+        if header == b"" or header == self._SQLITE_HEADER:
+            return
+
+        log.info('Converting import record "%s" to SQLite.' % self.path)
+
+        with open(self.path, "r") as fp:
+            paths = fp.read().splitlines()
+
+        # Write to a new file and move it into place so that the old record
+        # survives if we are interrupted.
+        new_path = self.path + ".new"
+        if os.path.exists(new_path):
+            os.remove(new_path)
+
+        conn = sqlite3.connect(new_path)
+        conn.execute("CREATE TABLE imported (path TEXT PRIMARY KEY)")
+        conn.executemany(
+            "INSERT OR IGNORE INTO imported (path) VALUES (?)",
+            ((p,) for p in paths if p),
+        )
+        conn.commit()
+        conn.close()
+
+        os.rename(new_path, self.path)
+
+    def __contains__(self, fullpath):
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT 1 FROM imported WHERE path = ?", (fullpath,)
+            )
+            return cursor.fetchone() is not None
+
+    def add(self, fullpath):
+        """Record that `fullpath` has been imported."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO imported (path) VALUES (?)", (fullpath,)
+            )
+            self._conn.commit()
+
+    def crawled_mtime(self, acq_path):
+        """The mtime of the acquisition directory `acq_path` when last crawled.
+
+        Returns None if the directory has never been completely crawled.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT mtime FROM crawled WHERE path = ?", (acq_path,)
+            )
+            row = cursor.fetchone()
+        return None if row is None else row[0]
+
+    def add_many(self, fullpaths):
+        """Record that all of `fullpaths` have been imported."""
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO imported (path) VALUES (?)",
+                ((path,) for path in fullpaths),
+            )
+            self._conn.commit()
+
+    def set_crawled_mtime(self, acq_path, mtime):
+        """Record that `acq_path` was completely crawled when its mtime was `mtime`."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO crawled (path, mtime) VALUES (?, ?)",
+                (acq_path, mtime),
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
 
 def load_import_cache():
     global import_done
@@ -51,35 +203,188 @@ def load_import_cache():
     # prevent needless DB queries when crawling the directories. If there is no
     # record, there is no checking. To start checking from scratch, create an
     # empty LOCAL_IMPORT_RECORD file.
-    try:
-        with open(LOCAL_IMPORT_RECORD, "r") as fp:
-            import_done = fp.read().splitlines()
-        import_done.sort()
-        if import_done is None:
-            import_done = []
-    except IOError:
+    if os.path.exists(LOCAL_IMPORT_RECORD):
+        import_done = ImportCache(LOCAL_IMPORT_RECORD)
+    else:
         log.info("No local record of imported files: not checking.")
 
 
+class ImportQueue(object):
+    """A queue of files to import, drained by a pool of worker threads.
+
+    A file is only queued once while it waits to be imported, so the repeated
+    events fired while a file is being written result in a single import. A
+    file is never imported by two workers at once. Workers take files from the
+    same acquisition off the queue in batches, to import them together. When
+    the queue is full, adding to it blocks until there is room.
+
+    Parameters
+    ----------
+    workers : int
+        Number of threads importing files.
+    maxsize : int
+        Maximum number of files waiting in the queue.
+    """
+
+    def __init__(self, workers=1, maxsize=IMPORT_QUEUE_SIZE):
+        self.workers = workers
+        self.maxsize = maxsize
+
+        self._cond = threading.Condition()
+        self._queue = []
+        self._pending = set()
+        self._active = set()
+        self._stopping = False
+        self._threads = []
+
+    @property
+    def depth(self):
+        """Number of files waiting to be imported."""
+        with self._cond:
+            return len(self._queue)
+
+    def put(self, node, root, acq_name, file_name):
+        """Queue a file for import, unless it is already waiting."""
+        fullpath = "%s/%s/%s" % (root, acq_name, file_name)
+
+        with self._cond:
+            if fullpath in self._pending:
+                return
+
+            if len(self._queue) >= self.maxsize:
+                log.warning(
+                    "Import queue is full (%i files). Waiting." % len(self._queue)
+                )
+                while len(self._queue) >= self.maxsize and not self._stopping:
+                    self._cond.wait()
+
+            self._queue.append((fullpath, node, root, acq_name, file_name))
+            self._pending.add(fullpath)
+            metrics.import_queue_depth.set(len(self._queue))
+            self._cond.notify_all()
+
+    def _get(self):
+        """Take the next batch of files which aren't being imported off the queue.
+
+        A batch holds up to `IMPORT_BATCH_SIZE` files from the same acquisition
+        directory, so that they can be imported together.
+        """
+        with self._cond:
+            while not self._stopping:
+                batch = []
+                for item in self._queue:
+                    if item[0] in self._active:
+                        continue
+                    if batch and (
+                        item[1].id != batch[0][1].id or item[2:4] != batch[0][2:4]
+                    ):
+                        continue
+                    batch.append(item)
+                    if len(batch) >= IMPORT_BATCH_SIZE:
+                        break
+
+                if batch:
+                    paths = set(item[0] for item in batch)
+                    self._queue = [item for item in self._queue if item[0] not in paths]
+                    self._pending.difference_update(paths)
+                    self._active.update(paths)
+                    metrics.import_queue_depth.set(len(self._queue))
+                    self._cond.notify_all()
+                    return batch
+
+                self._cond.wait()
+        return None
+
+    def import_now(self, node, root, acq_name, file_names):
+        """Import a batch of files from one acquisition in the calling thread.
+
+        If a worker is importing any of the same files, wait for it to finish
+        first.
+        """
+        fullpaths = ["%s/%s/%s" % (root, acq_name, name) for name in file_names]
+
+        with self._cond:
+            while any(path in self._active for path in fullpaths):
+                self._cond.wait()
+            self._active.update(fullpaths)
+
+        try:
+            import_files(node, root, acq_name, file_names)
+        finally:
+            self._done(fullpaths)
+
+    def _done(self, fullpaths):
+        with self._cond:
+            self._active.difference_update(fullpaths)
+            self._cond.notify_all()
+
+    def _work(self):
+        while True:
+            batch = self._get()
+            if batch is None:
+                return
+
+            fullpaths = [item[0] for item in batch]
+            node, root, acq_name = batch[0][1:4]
+            try:
+                import_files(node, root, acq_name, [item[4] for item in batch])
+            except Exception:
+                log.error(
+                    'Failed to import "%s".' % ", ".join(fullpaths), exc_info=True
+                )
+            finally:
+                self._done(fullpaths)
+
+    def start(self):
+        """Start the worker threads."""
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name="import-%i" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stop the workers once they have finished their current imports."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+    def join(self):
+        """Wait for the worker threads to finish."""
+        for thread in self._threads:
+            thread.join()
+
+
+def queue_import(node, root, acq_name, file_name):
+    """Import a file asynchronously, if the import queue is running."""
+    if import_queue is None:
+        import_file(node, root, acq_name, file_name)
+    else:
+        import_queue.put(node, root, acq_name, file_name)
+
+
 # Routines to control the filesystem watchdogs.
 # =============================================
 
 
 def setup_observers(node_list):
-    """Setup the watchdogs to look for new files in the nodes."""
+    """Setup the watchdogs to look for new files in the nodes.
+
+    The nodes are also crawled for files added while we weren't watching. The
+    crawl runs in the background, so this returns as soon as the watchdogs
+    have started.
+    """
+
+    global obs_list, import_queue, crawl_thread
 
-    global obs_list
+    # Start the workers importing the files the watchdogs find
+    import_queue = ImportQueue(workers=IMPORT_WORKERS)
+    import_queue.start()
 
-    # If any node has auto_import set, look for new files and add them to the
-    # DB. Then set up a watchdog for it.
+    # If any node has auto_import set, set up a watchdog for it.
     obs_list = []
     for node in node_list:
         if node.auto_import:
-            log.info('Crawling base directory "%s" for new files.' % node.root)
-            for acq_name, d, f_list in os.walk(node.root):
-                log.info("Crawling %s." % acq_name)
-                for file_name in sorted(f_list):
-                    import_file(node, node.root, os.path.basename(acq_name), file_name)
             # If it is an NFS mount, then the default Observer() doesn't work.
             # Determine this by seeing if the node name is the same as the node host:
             # not failsafe, but it will do for now.
@@ -96,6 +401,17 @@ def setup_observers(node_list):
         if obs:
             obs.start()
 
+    # Now look for new files which arrived before the watchdogs started, and
+    # add them to the DB.
+    crawl_nodes = [node for node in node_list if node.auto_import]
+    if len(crawl_nodes) > 0:
+        _crawl_stop.clear()
+        crawl_thread = threading.Thread(
+            target=crawl_nodes_for_import, args=(crawl_nodes,), name="crawl"
+        )
+        crawl_thread.daemon = True
+        crawl_thread.start()
+
 
 def stop_observers():
     """Stop watchidog threads."""
@@ -103,6 +419,11 @@ def stop_observers():
         if obs:
             obs.stop()
 
+    _crawl_stop.set()
+
+    if import_queue is not None:
+        import_queue.stop()
+
 
 def join_observers():
     """Wait for watchdog threads to terminate."""
@@ -110,11 +431,176 @@ def join_observers():
         if obs:
             obs.join()
 
+    if crawl_thread is not None:
+        crawl_thread.join()
+
+    if import_queue is not None:
+        import_queue.join()
+
+
+def crawl_nodes_for_import(node_list):
+    """Import any new files on the nodes in `node_list`.
+
+    Acquisition directories are crawled in parallel on `IMPORT_WORKERS`
+    threads.
+    """
+
+    with futures.ThreadPoolExecutor(max_workers=IMPORT_WORKERS) as pool:
+        jobs = []
+        for node in node_list:
+            log.info('Crawling base directory "%s" for new files.' % node.root)
+            for entry in sorted(os.scandir(node.root), key=lambda e: e.name):
+                if entry.is_dir():
+                    jobs.append(pool.submit(_crawl_acq, node, entry.name))
+
+        for job in futures.as_completed(jobs):
+            try:
+                job.result()
+            except Exception:
+                log.error("Crawl of acquisition failed.", exc_info=True)
+
+    if not _crawl_stop.is_set():
+        log.info("Finished crawling for new files.")
+
+
+def _crawl_acq(node, acq_name):
+    """Import any new files in the acquisition directory `acq_name` on `node`."""
+
+    if _crawl_stop.is_set():
+        return
+
+    # Skip anything which isn't an acquisition
+    try:
+        ts, inst, atype = di.util.parse_acq_name(acq_name)
+    except db.ValidationError:
+        log.info("Skipping non-acquisition path %s." % acq_name)
+        return
+
+    acq_path = "%s/%s" % (node.root, acq_name)
+
+    # Skip the acquisition if nothing has been added to (or removed from) the
+    # directory since it was last crawled.
+    mtime = os.stat(acq_path).st_mtime
+    if import_done is not None and import_done.crawled_mtime(acq_path) == mtime:
+        log.debug("Skipping unchanged acquisition %s." % acq_path)
+        return
+
+    log.info("Crawling %s." % acq_path)
+
+    file_names = sorted(entry.name for entry in os.scandir(acq_path) if entry.is_file())
+
+    # Only import the files which importing would change
+    known = _imported_files(node, acq_name, atype)
+    new_names = [name for name in file_names if name not in known]
+
+    for i in range(0, len(new_names), IMPORT_BATCH_SIZE):
+        if _crawl_stop.is_set():
+            return
+
+        import_queue.import_now(
+            node, node.root, acq_name, new_names[i : i + IMPORT_BATCH_SIZE]
+        )
+
+    if import_done is not None:
+        import_done.set_crawled_mtime(acq_path, mtime)
+
+
+def _imported_files(node, acq_name, atype):
+    """The files in an acquisition which importing from `node` would not change.
+
+    These are the files which have a good copy on the node, and the
+    information for their type in the DB. Other files are imported again, so
+    that their information is filled in.
+
+    Returns
+    -------
+    names : set
+        The names of the files.
+    """
+    files = {}
+    for file_id, name, ftype_name in (
+        di.ArchiveFile.select(di.ArchiveFile.id, di.ArchiveFile.name, di.FileType.name)
+        .join(di.ArchiveAcq)
+        .switch(di.ArchiveFile)
+        .join(di.FileType)
+        .switch(di.ArchiveFile)
+        .join(di.ArchiveFileCopy)
+        .where(
+            di.ArchiveAcq.name == acq_name,
+            di.ArchiveFileCopy.node == node,
+            di.ArchiveFileCopy.has_file == "Y",
+        )
+        .tuples()
+    ):
+        files[file_id] = (name, _file_info(atype, ftype_name))
+
+    names = set(name for name, info in files.values() if info is None)
+
+    # Look up the information of the other files, one query per info table.
+    # Information which would be filled in again must be there too.
+    for info in set(info for name, info in files.values() if info is not None):
+        model = info.model
+        ids = [file_id for file_id, (name, i) in files.items() if i is info]
+        query = model.select(model.file).where(model.file << ids)
+        if info.refill:
+            query = query.where(model.start_time.is_null(False))
+        names.update(files[file_id][0] for (file_id,) in query.tuples())
+
+    return names
+
 
 # Routines for registering files, acquisitions, copies and info in the DB.
 # ========================================================================
 
 
+@contextlib.contextmanager
+def _acq_lock(acq_name):
+    """Hold the lock for adding the acquisition `acq_name` to the DB.
+
+    The crawler and the import queue workers may import the first files of a
+    new acquisition at the same time.
+    """
+    with _acq_locks_lock:
+        lock, users = _acq_locks.get(acq_name, (None, 0))
+        if lock is None:
+            lock = threading.Lock()
+        _acq_locks[acq_name] = (lock, users + 1)
+
+    try:
+        with lock:
+            yield
+    finally:
+        with _acq_locks_lock:
+            lock, users = _acq_locks[acq_name]
+            if users == 1:
+                del _acq_locks[acq_name]
+            else:
+                _acq_locks[acq_name] = (lock, users - 1)
+
+
+def _get_or_add_acq(acq_name):
+    """Get the acquisition `acq_name` from the DB, adding it if necessary.
+
+    Returns None if the acquisition can't be added.
+    """
+    try:
+        acq = di.ArchiveAcq.get(di.ArchiveAcq.name == acq_name)
+        log.debug('Acquisition "%s" already in DB. Skipping.' % acq_name)
+        return acq
+    except pw.DoesNotExist:
+        pass
+
+    try:
+        acq = add_acq(acq_name)
+    except (db.AlreadyExistsError, pw.IntegrityError):
+        # Another process added it in the meantime
+        return di.ArchiveAcq.get(di.ArchiveAcq.name == acq_name)
+
+    if acq is not None:
+        log.info('Acquisition "%s" added to DB.' % acq_name)
+    return acq
+
+
 def add_acq(name, allow_new_inst=True, allow_new_atype=False, comment=None):
     """Add an aquisition to the database."""
     ts, inst, atype = di.util.parse_acq_name(name)
@@ -152,8 +638,59 @@ def add_acq(name, allow_new_inst=True, allow_new_atype=False, comment=None):
     )
 
 
-def get_acqcorrinfo_keywords_from_h5(path):
-    f = h5py.File(path, "r")
+# Routines for extracting metadata from HDF5 files.
+#
+# The `_*_info(f, path)` routines extract the keywords for one of the info
+# tables from an open HDF5 file `f`. Any time index is read in a single go
+# into a numpy array rather than an element at a time.
+
+
+def _field(data, index):
+    """Get the field at position `index` of a compound array as float64."""
+    return np.asarray(data[data.dtype.names[index]], dtype=np.float64)
+
+
+def _index_map_time_step(f):
+    """Median time between samples from the archive version 2 time index."""
+    ctime = _field(f["/index_map/time"][:], 1)
+    return np.median(np.diff(ctime))
+
+
+def _timestamp_time_step(f):
+    """Median time between samples from the legacy timestamp dataset.
+
+    The timestamps have separate seconds and microseconds fields.
+    """
+    t = f["timestamp"][:]
+    sec = _field(t, 1)
+    usec = _field(t, 2)
+
+    dt = np.diff(sec) + np.diff(usec) * 1e-6
+    dt[usec[1:] + 2e-5 < usec[:-1]] += 1.0
+
+    return np.median(dt)
+
+
+def _timestamp_span(f):
+    """Get the first and last times of a correlator-like file."""
+    try:
+        first, last = f["timestamp"][0], f["timestamp"][-1]
+        start_time = first[1] + first[2] * 1e-6
+        finish_time = last[1] + last[2] * 1e-6
+    except:
+        first, last = f["/index_map/time"][0], f["/index_map/time"][-1]
+        start_time = first[1]
+        finish_time = last[1]
+    return start_time, finish_time
+
+
+def _update_time_span(f):
+    """Get the first and last update times of a calibration file."""
+    update_time = f["index_map/update_time"]
+    return update_time[0], update_time[-1]
+
+
+def _acqcorrinfo(f, path):
     try:
         # This works on the 8-channel correlator.
         n_freq = f["/"].attrs["n_freq"][0]
@@ -167,36 +704,18 @@ def get_acqcorrinfo_keywords_from_h5(path):
         try:
             # Archive Version 2
             version = f.attrs["archive_version"][0]
-            dt = np.array([])
-            t = f["/index_map/time"]
-            for i in range(1, len(t)):
-                dt = np.append(dt, float(t[i][1]) - float(t[i - 1][1]))
-            integration = np.median(dt)
+            integration = _index_map_time_step(f)
             n_freq = len(f["/index_map/freq"])
             n_prod = len(f["/index_map/prod"])
         except:
-            dt = np.array([])
-            t = f["timestamp"]
-            for i in range(1, len(t)):
-                ddt = (
-                    float(t[i][1])
-                    - float(t[i - 1][1])
-                    + (float(t[i][2]) - float(t[i - 1][2])) * 1e-6
-                )
-                if t[i][2] + 2e-5 < t[i - 1][2]:
-                    dt = np.append(dt, ddt + 1.0)
-                else:
-                    dt = np.append(dt, ddt)
-            integration = np.median(dt)
+            integration = _timestamp_time_step(f)
             n_freq = f["/"].attrs["n_freq"][0]
             n_prod = len(f["/"].attrs["chan_indices"])
 
-    f.close()
     return {"integration": integration, "nfreq": n_freq, "nprod": n_prod}
 
 
-def get_acqhfbinfo_keywords_from_h5(path):
-    f = h5py.File(path, "r")
+def _acqhfbinfo(f, path):
     try:
         # This works on the 8-channel correlator.
         n_freq = f["/"].attrs["n_freq"][0]
@@ -211,33 +730,16 @@ def get_acqhfbinfo_keywords_from_h5(path):
         try:
             # Archive Version 2
             version = f.attrs["archive_version"][0]
-            dt = np.array([])
-            t = f["/index_map/time"]
-            for i in range(1, len(t)):
-                dt = np.append(dt, float(t[i][1]) - float(t[i - 1][1]))
-            integration = np.median(dt)
+            integration = _index_map_time_step(f)
             n_freq = len(f["/index_map/freq"])
             n_sub_freq = len(f["/index_map/subfreq"])
             n_beam = len(f["/index_map/beam"])
         except:
-            dt = np.array([])
-            t = f["timestamp"]
-            for i in range(1, len(t)):
-                ddt = (
-                    float(t[i][1])
-                    - float(t[i - 1][1])
-                    + (float(t[i][2]) - float(t[i - 1][2])) * 1e-6
-                )
-                if t[i][2] + 2e-5 < t[i - 1][2]:
-                    dt = np.append(dt, ddt + 1.0)
-                else:
-                    dt = np.append(dt, ddt)
-            integration = np.median(dt)
+            integration = _timestamp_time_step(f)
             n_freq = f["/"].attrs["n_freq"][0]
             n_sub_freq = len(f["/index_map/subfreq"])
             n_beam = len(f["/index_map/beam"])
 
-    f.close()
     return {
         "integration": integration,
         "nfreq": n_freq,
@@ -246,40 +748,9 @@ def get_acqhfbinfo_keywords_from_h5(path):
     }
 
 
-def get_acqhkinfo_keywords_from_h5(path):
-    fullpath = os.path.join(path, di.util.fname_atmel)
-    with open(fullpath, "r") as fp:
-        ret = []
-        for l in fp:
-            if l[0] == "#":
-                continue
-            if len(l.split()) < 2:
-                continue
-            name = l.split()[0]
-            iid = " ".join(l.split()[1:])
-            ret.append({"atmel_id": iid, "atmel_name": name})
-
-    return ret
-
-
-def get_acqrawadcinfo_keywords_from_h5(acq_name):
-    # We need to use the calendar module because the datetime module can't give us
-    # timegm() for some strange reason.
-    d = datetime.datetime.strptime(acq_name[0:16], "%Y%m%dT%H%M%SZ")
-    t = calendar.timegm(d.utctimetuple())
-    return {"start_time": t}
-
-
-def get_filecorrinfo_keywords_from_h5(path):
-    f = h5py.File(path, "r")
-    try:
-        start_time = f["timestamp"][0][1] + f["timestamp"][0][2] * 1e-6
-        finish_time = f["timestamp"][-1][1] + f["timestamp"][-1][2] * 1e-6
-    except:
-        start_time = f["/index_map/time"][0][1]
-        finish_time = f["/index_map/time"][-1][1]
+def _filecorrinfo(f, path):
+    start_time, finish_time = _timestamp_span(f)
     chunk_number, freq_number = di.util.parse_corrfile_name(os.path.basename(path))
-    f.close()
     return {
         "start_time": start_time,
         "finish_time": finish_time,
@@ -288,16 +759,9 @@ def get_filecorrinfo_keywords_from_h5(path):
     }
 
 
-def get_filehfbinfo_keywords_from_h5(path):
-    f = h5py.File(path, "r")
-    try:
-        start_time = f["timestamp"][0][1] + f["timestamp"][0][2] * 1e-6
-        finish_time = f["timestamp"][-1][1] + f["timestamp"][-1][2] * 1e-6
-    except:
-        start_time = f["/index_map/time"][0][1]
-        finish_time = f["/index_map/time"][-1][1]
+def _filehfbinfo(f, path):
+    start_time, finish_time = _timestamp_span(f)
     chunk_number, freq_number = di.util.parse_hfbfile_name(os.path.basename(path))
-    f.close()
     return {
         "start_time": start_time,
         "finish_time": finish_time,
@@ -306,13 +770,13 @@ def get_filehfbinfo_keywords_from_h5(path):
     }
 
 
-def get_fileweatherinfo_keywords_from_h5(path):
+def _fileweatherinfo(f, path):
     d = di.util.parse_weatherfile_name(os.path.basename(path))
 
-    f = h5py.File(path, "r")
     try:
-        start_time = f["/index_map/time"][0]
-        finish_time = f["/index_map/time"][-1]
+        time_index = f["/index_map/time"]
+        start_time = time_index[0]
+        finish_time = time_index[-1]
     except KeyError:
         # This is for multistation weather data, which does not contain a
         # "time" index map, but rather multiple "station_time_XXX" maps.
@@ -326,69 +790,158 @@ def get_fileweatherinfo_keywords_from_h5(path):
                 day + datetime.timedelta(days=1) - datetime.timedelta(seconds=1)
             ).utctimetuple()
         )
-    f.close()
 
     return {"start_time": start_time, "finish_time": finish_time, "date": d}
 
 
-def get_filerawadcinfo_keywords_from_h5(path):
-    with h5py.File(path, "r") as f:
-        times = f["timestamp"]["ctime"]
-        start_time = times.min()
-        finish_time = times.max()
-
-    return {"start_time": start_time, "finish_time": finish_time}
+def _filerawadcinfo(f, path):
+    times = f["timestamp"]["ctime"]
+    return {"start_time": times.min(), "finish_time": times.max()}
 
 
-def get_filehkinfo_keywords_from_h5(path):
-    f = h5py.File(path, "r")
-    start_time = f["index_map/time"][0]
-    finish_time = f["index_map/time"][-1]
+def _filehkinfo(f, path):
+    time_index = f["index_map/time"]
     chunk_number, atmel_name = di.util.parse_hkfile_name(os.path.basename(path))
-    f.close()
     return {
-        "start_time": start_time,
-        "finish_time": finish_time,
+        "start_time": time_index[0],
+        "finish_time": time_index[-1],
         "atmel_name": atmel_name,
         "chunk_number": chunk_number,
     }
 
 
-def get_filehkpinfo_keywords_from_h5(path):
-    def dset_timerange(dset):
-        # Get the span of times in a HKP dataset`
-        return dset["time"].min(), dset["time"].max()
-
+def _filehkpinfo(f, path):
     # Get the time range of each dataset and then return the extremes
-    with h5py.File(path, "r") as f:
-        timerange = [dset_timerange(ds) for ds in f.values()]
+    times = [dset["time"] for dset in f.values()]
+    return {
+        "start_time": min(t.min() for t in times),
+        "finish_time": max(t.max() for t in times),
+    }
 
-    start_times, finish_times = np.array(timerange).T
-    return {"start_time": start_times.min(), "finish_time": finish_times.max()}
 
+def _fileupdatetimeinfo(f, path):
+    start_time, finish_time = _update_time_span(f)
+    return {"start_time": start_time, "finish_time": finish_time}
 
-def get_filedigitalgaininfo_keywords_from_h5(path):
-    with h5py.File(path, "r") as f:
-        start_time = f["index_map/update_time"][0]
-        finish_time = f["index_map/update_time"][-1]
 
-    return {"start_time": start_time, "finish_time": finish_time}
+class H5Metadata(object):
+    """Metadata extracted from an HDF5 file, which is opened at most once.
 
+    The file is only opened when the first extraction is requested, and every
+    subsequent extraction uses the same open file. The result of each
+    extraction (or the exception it raised) is cached, so repeating it doesn't
+    touch the file again. Use as a context manager to close the file.
 
-def get_filecalibrationgaininfo_keywords_from_h5(path):
-    with h5py.File(path, "r") as f:
-        start_time = f["index_map/update_time"][0]
-        finish_time = f["index_map/update_time"][-1]
+    Parameters
+    ----------
+    path : string
+        Path to the HDF5 file.
+    """
 
-    return {"start_time": start_time, "finish_time": finish_time}
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._cache = {}
 
+    def get(self, extract):
+        """Get the result of `extract(f, path)` for the open file `f`."""
+        if extract not in self._cache:
+            try:
+                if self._file is None:
+                    self._file = h5py.File(self.path, "r")
+                self._cache[extract] = (extract(self._file, self.path), None)
+            except Exception as e:
+                self._cache[extract] = (None, e)
 
-def get_fileflaginputinfo_keywords_from_h5(path):
+        value, error = self._cache[extract]
+        if error is not None:
+            raise error
+        return value
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _from_h5(extract, path):
+    """Open the HDF5 file at `path` and extract keywords from it."""
     with h5py.File(path, "r") as f:
-        start_time = f["index_map/update_time"][0]
-        finish_time = f["index_map/update_time"][-1]
+        return extract(f, path)
 
-    return {"start_time": start_time, "finish_time": finish_time}
+
+def get_acqcorrinfo_keywords_from_h5(path):
+    return _from_h5(_acqcorrinfo, path)
+
+
+def get_acqhfbinfo_keywords_from_h5(path):
+    return _from_h5(_acqhfbinfo, path)
+
+
+def get_acqhkinfo_keywords_from_h5(path):
+    fullpath = os.path.join(path, di.util.fname_atmel)
+    with open(fullpath, "r") as fp:
+        ret = []
+        for l in fp:
+            if l[0] == "#":
+                continue
+            if len(l.split()) < 2:
+                continue
+            name = l.split()[0]
+            iid = " ".join(l.split()[1:])
+            ret.append({"atmel_id": iid, "atmel_name": name})
+
+    return ret
+
+
+def get_acqrawadcinfo_keywords_from_h5(acq_name):
+    # We need to use the calendar module because the datetime module can't give us
+    # timegm() for some strange reason.
+    d = datetime.datetime.strptime(acq_name[0:16], "%Y%m%dT%H%M%SZ")
+    t = calendar.timegm(d.utctimetuple())
+    return {"start_time": t}
+
+
+def get_filecorrinfo_keywords_from_h5(path):
+    return _from_h5(_filecorrinfo, path)
+
+
+def get_filehfbinfo_keywords_from_h5(path):
+    return _from_h5(_filehfbinfo, path)
+
+
+def get_fileweatherinfo_keywords_from_h5(path):
+    return _from_h5(_fileweatherinfo, path)
+
+
+def get_filerawadcinfo_keywords_from_h5(path):
+    return _from_h5(_filerawadcinfo, path)
+
+
+def get_filehkinfo_keywords_from_h5(path):
+    return _from_h5(_filehkinfo, path)
+
+
+def get_filehkpinfo_keywords_from_h5(path):
+    return _from_h5(_filehkpinfo, path)
+
+
+def get_filedigitalgaininfo_keywords_from_h5(path):
+    return _from_h5(_fileupdatetimeinfo, path)
+
+
+def get_filecalibrationgaininfo_keywords_from_h5(path):
+    return _from_h5(_fileupdatetimeinfo, path)
+
+
+def get_fileflaginputinfo_keywords_from_h5(path):
+    return _from_h5(_fileupdatetimeinfo, path)
 
 
 def get_miscfile_data(path):
@@ -454,77 +1007,114 @@ def get_filerawinfo_keywords(rawinfo, size_b, file_name):
     }
 
 
-def import_file(node, root, acq_name, file_name):
-    done = False
-    while not done:
-        try:
-            _import_file(node, root, acq_name, file_name)
-            done = True
-        except pw.OperationalError:
-            log.error(
-                "MySQL connexion dropped. Will attempt to reconnect in five seconds."
-            )
-            time.sleep(5)
-            db.connect(read_write=True, reconnect=True)
+class _FileInfo(object):
+    """How the info table for a type of file is filled.
+
+    Parameters
+    ----------
+    model : peewee.Model
+        The info table.
+    extract : callable
+        Extracts the keywords for the table. If `from_h5`, it is an HDF5
+        extractor used through the file's `H5Metadata`, otherwise it is called
+        with the path of the file.
+    refill : bool
+        Whether an existing row without a start time should be filled again.
+    from_h5 : bool
+        Whether the file is an HDF5 file.
+    """
 
+    def __init__(self, model, extract, refill=False, from_h5=True):
+        self.model = model
+        self.extract = extract
+        self.refill = refill
+        self.from_h5 = from_h5
+
+    def keywords(self, meta):
+        """Get the keywords for the file whose `H5Metadata` is `meta`."""
+        if self.from_h5:
+            return meta.get(self.extract)
+        return self.extract(meta.path)
+
+
+# The info table for each type of file, keyed by the acquisition type and the
+# file type. An acquisition type of None matches any acquisition.
+FILE_INFO = {
+    (None, "corr"): _FileInfo(di.CorrFileInfo, _filecorrinfo, refill=True),
+    (None, "hfb"): _FileInfo(di.HFBFileInfo, _filehfbinfo, refill=True),
+    (None, "hk"): _FileInfo(di.HKFileInfo, _filehkinfo, refill=True),
+    (None, "weather"): _FileInfo(di.WeatherFileInfo, _fileweatherinfo, refill=True),
+    (None, "rawadc"): _FileInfo(di.RawadcFileInfo, _filerawadcinfo),
+    (None, "hkp"): _FileInfo(di.HKPFileInfo, _filehkpinfo),
+    ("digitalgain", "calibration"): _FileInfo(
+        di.DigitalGainFileInfo, _fileupdatetimeinfo
+    ),
+    ("gain", "calibration"): _FileInfo(di.CalibrationGainFileInfo, _fileupdatetimeinfo),
+    ("flaginput", "calibration"): _FileInfo(di.FlagInputFileInfo, _fileupdatetimeinfo),
+    ("misc", "miscellaneous"): _FileInfo(
+        di.MiscFileInfo, get_miscfile_data, from_h5=False
+    ),
+}
+
+
+def _file_info(atype, ftype_name):
+    """Get the `_FileInfo` for a type of file, or None if it has no info table."""
+    info = FILE_INFO.get((atype, ftype_name))
+    if info is None:
+        info = FILE_INFO.get((None, ftype_name))
+    return info
 
-def _import_file(node, root, acq_name, file_name):
-    """Import a file into the DB.
 
-    This routine adds the following to the database, if they do not already exist
-    (or might be corrupted).
-    - The acquisition that the file is a part of.
-    - Information on the acquisition, if it is of type "corr".
-    - The file.
-    - Information on the file, if it is of type "corr".
-    - Indicates that the file exists on this node.
-    """
-    global import_done
-    curr_done = True
-    fullpath = "%s/%s/%s" % (root, acq_name, file_name)
-    log.debug("Considering %s for import." % fullpath)
+def import_file(node, root, acq_name, file_name):
+    """Import a single file into the DB. See `import_files`."""
+    import_files(node, root, acq_name, [file_name])
 
-    # Skip the file if ch_master.py still has a lock on it.
-    if os.path.isfile("%s/%s/.%s.lock" % (root, acq_name, file_name)):
-        log.debug('Skipping "%s", which is locked by ch_master.py.' % fullpath)
-        return
 
-    # Parse the path
+def import_files(node, root, acq_name, file_names):
+    """Import a batch of files from the same acquisition into the DB."""
+    # Any HDF5 metadata is read from each file once, and reused if we have to
+    # retry the import.
+    metas = dict(
+        (name, H5Metadata("%s/%s/%s" % (root, acq_name, name))) for name in file_names
+    )
     try:
-        ts, inst, atype = di.util.parse_acq_name(acq_name)
-    except db.ValidationError:
-        log.info("Skipping non-acquisition path %s." % acq_name)
-        return
+        done = False
+        while not done:
+            try:
+                _import_files(node, root, acq_name, file_names, metas)
+                done = True
+            except pw.OperationalError:
+                log.error(
+                    "MySQL connexion dropped. Will attempt to reconnect in five "
+                    "seconds."
+                )
+                time.sleep(5)
+                db.connect(read_write=True, reconnect=True)
+    finally:
+        for meta in metas.values():
+            meta.close()
 
-    if import_done is not None:
-        i = bisect.bisect_left(import_done, fullpath)
-        if i != len(import_done) and import_done[i] == fullpath:
-            log.debug("Skipping already-registered file %s." % fullpath)
-            return
 
-    # Figure out which acquisition this is; add if necessary.
-    try:
-        acq = di.ArchiveAcq.get(di.ArchiveAcq.name == acq_name)
-        log.debug('Acquisition "%s" already in DB. Skipping.' % acq_name)
-    except pw.DoesNotExist:
-        acq = add_acq(acq_name)
-        if acq is None:
-            return
-        log.info('Acquisition "%s" added to DB.' % acq_name)
+def _add_acq_info(acq, atype, root, acq_name, ftypes, metas):
+    """Make sure information about the acquisition exists in the DB.
 
-    # What kind of file do we have?
-    ftype = di.util.detect_file_type(file_name)
-    if ftype is None:
-        log.info('Skipping unrecognised file "%s/%s".' % (acq_name, file_name))
-        return
+    The information is taken from the first suitable file in the batch.
+
+    Returns
+    -------
+    ok : bool
+        False if the acquisition should be skipped.
+    """
+
+    def first(ftype_name):
+        return next(name for name in sorted(ftypes) if ftypes[name].name == ftype_name)
 
-    # Make sure information about the acquisition exists in the DB.
-    if atype == "corr" and ftype.name == "corr":
+    ftype_names = set(ftype.name for ftype in ftypes.values())
+
+    if atype == "corr" and "corr" in ftype_names:
         if di.CorrAcqInfo.get_or_none(acq=acq) is None:
             try:
-                di.CorrAcqInfo.create(
-                    acq=acq, **get_acqcorrinfo_keywords_from_h5(fullpath)
-                )
+                di.CorrAcqInfo.create(acq=acq, **metas[first("corr")].get(_acqcorrinfo))
                 log.info(
                     'Added information for correlator acquisition "%s" to '
                     "DB." % acq_name
@@ -535,12 +1125,10 @@ def _import_file(node, root, acq_name, file_name):
                     "empty. Leaving fields NULL." % (acq_name)
                 )
                 di.CorrAcqInfo.create(acq=acq)
-    elif atype == "hfb" and ftype.name == "hfb":
+    elif atype == "hfb" and "hfb" in ftype_names:
         if di.HFBAcqInfo.get_or_none(acq=acq) is None:
             try:
-                di.HFBAcqInfo.create(
-                    acq=acq, **get_acqhfbinfo_keywords_from_h5(fullpath)
-                )
+                di.HFBAcqInfo.create(acq=acq, **metas[first("hfb")].get(_acqhfbinfo))
                 log.info(
                     'Added information for HFB acquisition "%s" to ' "DB." % acq_name
                 )
@@ -550,19 +1138,21 @@ def _import_file(node, root, acq_name, file_name):
                     "empty. Leaving fields NULL." % (acq_name)
                 )
                 di.HFBAcqInfo.create(acq=acq)
-    elif atype == "hk" and ftype.name == "hk":
+    elif atype == "hk" and "hk" in ftype_names:
         try:
             keywords = get_acqhkinfo_keywords_from_h5("%s/%s" % (root, acq_name))
         except:
             log.warning("Could no open atmel_id.dat file. Skipping.")
             keywords = []
+
+        known = set(
+            name
+            for (name,) in di.HKAcqInfo.select(di.HKAcqInfo.atmel_name)
+            .where(di.HKAcqInfo.acq == acq)
+            .tuples()
+        )
         for kw in keywords:
-            if not sum(
-                1
-                for _ in di.HKAcqInfo.select()
-                .where(di.HKAcqInfo.acq == acq)
-                .where(di.HKAcqInfo.atmel_name == kw["atmel_name"])
-            ):
+            if kw["atmel_name"] not in known:
                 try:
                     di.HKAcqInfo.create(acq=acq, **kw)
                     log.info(
@@ -574,7 +1164,7 @@ def _import_file(node, root, acq_name, file_name):
                         'Missing info for acquisition "%s": atmel_id.dat '
                         "file missing or corrupt. Skipping this acquisition." % acq_name
                     )
-                    return
+                    return False
     elif atype == "rawadc":
         if di.RawadcAcqInfo.get_or_none(acq=acq) is None:
             di.RawadcAcqInfo.create(
@@ -584,261 +1174,244 @@ def _import_file(node, root, acq_name, file_name):
                 'Added information for raw ADC acquisition "%s" to ' "DB." % acq_name
             )
 
-    # Add the file, if necessary.
+    return True
+
+
+def _import_files(node, root, acq_name, file_names, metas):
+    """Import a batch of files from the same acquisition into the DB.
+
+    This routine adds the following to the database, if they do not already exist
+    (or might be corrupted).
+    - The acquisition that the files are a part of.
+    - Information on the acquisition, if it is of type "corr".
+    - The files.
+    - Information on the files, if there is an info table for their type.
+    - Indicates that the files exist on this node.
+
+    The new files, copies and file information are written with bulk inserts in
+    a single transaction. HDF5 metadata is taken from `metas`, a dict of
+    `H5Metadata` keyed by file name.
+    """
+
+    def path(name):
+        return "%s/%s/%s" % (root, acq_name, name)
+
+    # Parse the path
     try:
-        file = di.ArchiveFile.get(
-            di.ArchiveFile.name == file_name, di.ArchiveFile.acq == acq
-        )
-        size_b = file.size_b
-        log.debug('File "%s/%s" already in DB. Skipping.' % (acq_name, file_name))
-    except pw.DoesNotExist:
-        log.debug("Computing md5sum.")
-        md5sum = di.util.md5sum_file(fullpath, cmd_line=True)
-        size_b = os.path.getsize(fullpath)
-        done = False
-        while not done:
-            try:
-                file = di.ArchiveFile.create(
-                    acq=acq, type=ftype, name=file_name, size_b=size_b, md5sum=md5sum
-                )
-                done = True
-            except pw.OperationalError:
-                log.error(
-                    "MySQL connexion dropped. Will attempt to reconnect in "
-                    "five seconds."
-                )
-                time.sleep(5)
-                db.connect(read_write=True, reconnect=True)
-        log.info('File "%s/%s" added to DB.' % (acq_name, file_name))
-
-    # Register the copy of the file here on the collection server, if (1) it does
-    # not exist, or (2) it does exist but has been labelled as corrupt. If (2),
-    # check again.
-    # Use a transaction to avoid race condition
-    with db.proxy.transaction():
-        if not file.copies.where(di.ArchiveFileCopy.node == node).count():
-            copy = di.ArchiveFileCopy.create(
-                file=file, node=node, has_file="Y", wants_file="Y"
-            )
-            log.info('Registered file copy "%s/%s" to DB.' % (acq_name, file_name))
+        ts, inst, atype = di.util.parse_acq_name(acq_name)
+    except db.ValidationError:
+        log.info("Skipping non-acquisition path %s." % acq_name)
+        return
 
-    # Make sure information about the file exists in the DB.
-    if ftype.name == "corr":
-        # Add if (1) there is no corrinfo or (2) the corrinfo is missing.
-        i = di.CorrFileInfo.get_or_none(file=file)
-        if i is None:
-            try:
-                di.CorrFileInfo.create(
-                    file=file, **get_filecorrinfo_keywords_from_h5(fullpath)
-                )
-                log.info(
-                    'Added information for file "%s/%s" to DB.' % (acq_name, file_name)
-                )
-            except:
-                if di.CorrFileInfo.get_or_none(file=file) is None:
-                    di.CorrFileInfo.create(file=file)
-                log.warning(
-                    'Missing info for file "%s/%s": HDF5 datasets '
-                    "empty or unreadable. Leaving fields NULL." % (acq_name, file_name)
-                )
-        elif not i.start_time:
-            try:
-                k = get_filecorrinfo_keywords_from_h5(fullpath)
-            except:
-                log.debug('Still missing info for file "%s/%s".')
+    considered = []
+    for file_name in file_names:
+        fullpath = path(file_name)
+        log.debug("Considering %s for import." % fullpath)
+
+        # Skip the file if ch_master.py still has a lock on it.
+        if os.path.isfile("%s/%s/.%s.lock" % (root, acq_name, file_name)):
+            log.debug('Skipping "%s", which is locked by ch_master.py.' % fullpath)
+            continue
+
+        if import_done is not None and fullpath in import_done:
+            log.debug("Skipping already-registered file %s." % fullpath)
+            continue
+
+        considered.append(file_name)
+
+    if not considered:
+        return
+
+    # Figure out which acquisition this is, and add it and its information if
+    # necessary, one thread at a time.
+    with _acq_lock(acq_name):
+        acq = _get_or_add_acq(acq_name)
+        if acq is None:
+            return
+
+        # What kind of files do we have?
+        ftypes = {}
+        for file_name in considered:
+            ftype = di.util.detect_file_type(file_name)
+            if ftype is None:
+                log.info('Skipping unrecognised file "%s/%s".' % (acq_name, file_name))
             else:
-                i.start_time = k["start_time"]
-                i.finish_time = k["finish_time"]
-                i.chunk_number = k["chunk_number"]
-                i.freq_number = k["freq_number"]
-                i.save()
-                log.info(
-                    'Added information for file "%s/%s" to DB.' % (acq_name, file_name)
-                )
-    elif ftype.name == "hfb":
-        # Add if (1) there is no corrinfo or (2) the corrinfo is missing.
-        i = di.HFBFileInfo.get_or_none(file=file)
-        if i is None:
+                ftypes[file_name] = ftype
+
+        if not ftypes:
+            return
+
+        if not _add_acq_info(acq, atype, root, acq_name, ftypes, metas):
+            return
+
+    names = sorted(ftypes)
+
+    # Find the files already in the DB in one go, and gather the new ones.
+    files = dict(
+        (file.name, file)
+        for file in di.ArchiveFile.select().where(
+            di.ArchiveFile.acq == acq, di.ArchiveFile.name << names
+        )
+    )
+
+    new_names = []
+    for file_name in names:
+        if file_name in files:
+            log.debug('File "%s/%s" already in DB. Skipping.' % (acq_name, file_name))
+        else:
+            new_names.append(file_name)
+
+    # Hash the new files in-process, several at a time. Their metadata is read
+    # straight afterwards, while they are still in the page cache, so each new
+    # file is only read from disk once.
+    new_files = []
+    if new_names:
+        log.debug("Computing md5sums of %i files." % len(new_names))
+        paths = dict((path(name), name) for name in new_names)
+        for fullpath, md5sum in hashing.md5sum_files(
+            sorted(paths), workers=IMPORT_HASH_WORKERS
+        ):
+            if md5sum is None:
+                log.warning('File "%s" has disappeared. Skipping.' % fullpath)
+                continue
+            if md5sum == hashing.UNREADABLE:
+                log.warning('File "%s" can\'t be read. Skipping.' % fullpath)
+                continue
+
+            new_files.append(
+                {
+                    "acq": acq,
+                    "type": ftypes[paths[fullpath]],
+                    "name": paths[fullpath],
+                    "size_b": os.path.getsize(fullpath),
+                    "md5sum": md5sum,
+                }
+            )
+        new_files.sort(key=lambda f: f["name"])
+
+        hashed = set(f["name"] for f in new_files)
+        names = [name for name in names if name in files or name in hashed]
+
+    # Find the existing information for the files already in the DB, one
+    # query per info table.
+    infos = {}
+    for file_name in names:
+        info = _file_info(atype, ftypes[file_name].name)
+        if info is not None:
+            infos[file_name] = info
+
+    info_rows = {}
+    for model in set(info.model for info in infos.values()):
+        ids = [
+            files[name].id
+            for name, info in infos.items()
+            if info.model is model and name in files
+        ]
+        if ids:
+            for row in model.select().where(model.file << ids):
+                info_rows[row.file_id] = row
+
+    # Extract the information needed from the files before writing anything.
+    new_info = {}
+    refilled = []
+    for file_name, info in sorted(infos.items()):
+        row = info_rows.get(files[file_name].id) if file_name in files else None
+
+        if row is None:
+            # Add if there is no info
             try:
-                di.HFBFileInfo.create(
-                    file=file, **get_filehfbinfo_keywords_from_h5(fullpath)
-                )
-                log.info(
-                    'Added information for file "%s/%s" to DB.' % (acq_name, file_name)
-                )
+                new_info[file_name] = info.keywords(metas[file_name])
             except:
-                if di.HFBFileInfo.get_or_none(file=file) is None:
-                    di.HFBFileInfo.create(file=file)
+                new_info[file_name] = {}
                 log.warning(
-                    'Missing info for file "%s/%s": HDF5 datasets '
-                    "empty or unreadable. Leaving fields NULL." % (acq_name, file_name)
+                    'Missing info for file "%s/%s": datasets empty or unreadable. '
+                    "Leaving fields NULL." % (acq_name, file_name)
                 )
-        elif not i.start_time:
+        elif info.refill and not row.start_time:
+            # Fill again if the info is missing
             try:
-                k = get_filehfbinfo_keywords_from_h5(fullpath)
-            except:
-                log.debug('Still missing info for file "%s/%s".')
-            else:
-                i.start_time = k["start_time"]
-                i.finish_time = k["finish_time"]
-                i.chunk_number = k["chunk_number"]
-                i.freq_number = k["freq_number"]
-                i.save()
-                log.info(
-                    'Added information for file "%s/%s" to DB.' % (acq_name, file_name)
-                )
-    elif ftype.name == "hk":
-        # Add if (1) there is no hkinfo or (2) the hkinfo is missing.
-        i = di.HKFileInfo.get_or_none(file=file)
-        if i is None:
-            try:
-                di.HKFileInfo.create(
-                    file=file, **get_filehkinfo_keywords_from_h5(fullpath)
-                )
-                log.info(
-                    'Added information for file "%s/%s" to DB.' % (acq_name, file_name)
-                )
+                keywords = info.keywords(metas[file_name])
             except:
-                if di.HKFileInfo.get_or_none(file=file) is None:
-                    di.HKFileInfo.create(file=file)
-                log.warning(
-                    'Missing info for file "%s/%s": HDF5 datasets '
-                    "empty or unreadable. Leaving fields NULL." % (acq_name, file_name)
+                log.debug(
+                    'Still missing info for file "%s/%s".' % (acq_name, file_name)
                 )
-        elif not i.start_time:
-            try:
-                k = get_filehkinfo_keywords_from_h5(fullpath)
-            except:
-                log.debug('Still missing info for file "%s/%s".')
             else:
-                i.start_time = k["start_time"]
-                i.finish_time = k["finish_time"]
-                i.atmel_name = k["atmel_name"]
-                i.chunk_number = k["chunk_number"]
-                i.save()
-                log.info(
-                    'Added information for file "%s/%s" to DB.' % (acq_name, file_name)
-                )
-    elif ftype.name == "weather":
-        # Add if (1) there is no weatherinfo or (2) the weatherinfo is missing.
-        i = di.WeatherFileInfo.get_or_none(file=file)
-        if i is None:
-            di.WeatherFileInfo.create(
-                file=file, **get_fileweatherinfo_keywords_from_h5(fullpath)
+                for key, value in keywords.items():
+                    setattr(row, key, value)
+                refilled.append((file_name, row))
+
+        metas[file_name].close()
+
+    # Write everything in one transaction, which also avoids a race condition
+    # when registering the copies.
+    with db.proxy.atomic():
+        if new_files:
+            di.ArchiveFile.insert_many(new_files).execute()
+            for file in di.ArchiveFile.select().where(
+                di.ArchiveFile.acq == acq,
+                di.ArchiveFile.name << [f["name"] for f in new_files],
+            ):
+                files[file.name] = file
+                log.info('File "%s/%s" added to DB.' % (acq_name, file.name))
+            nodestats.add(None, len(new_files), sum(f["size_b"] for f in new_files))
+
+        # Register the copy of the file here on the collection server, if it
+        # does not exist.
+        have_copy = set(
+            file_id
+            for (file_id,) in di.ArchiveFileCopy.select(di.ArchiveFileCopy.file)
+            .where(
+                di.ArchiveFileCopy.node == node,
+                di.ArchiveFileCopy.file << [files[name].id for name in names],
             )
-            log.info(
-                'Added information for file "%s/%s" to DB.' % (acq_name, file_name)
+            .tuples()
+        )
+        new_copies = [name for name in names if files[name].id not in have_copy]
+        if new_copies:
+            di.ArchiveFileCopy.insert_many(
+                [
+                    {
+                        "file": files[name],
+                        "node": node,
+                        "has_file": "Y",
+                        "wants_file": "Y",
+                    }
+                    for name in new_copies
+                ]
+            ).execute()
+            for file_name in new_copies:
+                log.info('Registered file copy "%s/%s" to DB.' % (acq_name, file_name))
+            nodestats.add(
+                node, len(new_copies), sum(files[name].size_b for name in new_copies)
             )
-        elif not i.start_time:
-            try:
-                k = get_fileweatherinfo_keywords_from_h5(fullpath)
-            except:
-                log.debug('Still missing info for file "%s/%s".')
-            else:
-                i.start_time = k["start_time"]
-                i.finish_time = k["finish_time"]
-                i.date = k["date"]
-                i.save()
-                log.info(
-                    'Added information for file "%s/%s" to DB.' % (acq_name, file_name)
-                )
 
-    elif ftype.name == "rawadc":
-        # Add if there is no rawadcinfo
-        if di.RawadcFileInfo.get_or_none(file=file) is None:
-            try:
-                di.RawadcFileInfo.create(
-                    file=file, **get_filerawadcinfo_keywords_from_h5(fullpath)
-                )
-                log.info(
-                    'Added information for file "%s/%s" to DB.' % (acq_name, file_name)
-                )
-            except:
-                if di.RawadcFileInfo.get_or_none(file=file) is None:
-                    di.RawadcFileInfo.create(file=file)
-                log.warning(
-                    'Missing info for file "%s/%s". Leaving fields NULL.'
-                    % (acq_name, file_name)
-                )
+        # Rows inserted together need the same columns, so group them by the
+        # keywords present as well as by table.
+        batches = {}
+        for file_name, keywords in new_info.items():
+            row = dict(keywords, file=files[file_name])
+            key = (infos[file_name].model, tuple(sorted(row)))
+            batches.setdefault(key, []).append(row)
 
-    elif ftype.name == "hkp":
-        # Add if there is no hkpinfo
-        if di.HKPFileInfo.get_or_none(file=file) is None:
-            try:
-                di.HKPFileInfo.create(
-                    file=file, **get_filehkpinfo_keywords_from_h5(fullpath)
-                )
-                log.info(
-                    'Added information for file "%s/%s" to DB.' % (acq_name, file_name)
-                )
-            except:
-                if di.HKPFileInfo.get_or_none(file=file) is None:
-                    di.HKPFileInfo.create(file=file)
-                log.warning(
-                    'Missing info for file "%s/%s". Leaving fields NULL.'
-                    % (acq_name, file_name)
-                )
-    elif atype == "digitalgain" and ftype.name == "calibration":
-        if di.DigitalGainFileInfo.get_or_none(file=file) is None:
-            try:
-                di.DigitalGainFileInfo.create(
-                    file=file, **get_filedigitalgaininfo_keywords_from_h5(fullpath)
-                )
-                log.info(
-                    'Added information for file "%s/%s" to DB.' % (acq_name, file_name)
-                )
-            except:
-                if di.DigitalGainFileInfo.get_or_none(file=file) is None:
-                    di.DigitalGainFileInfo.create(file=file)
-                log.warning(
-                    'Missing info for file "%s/%s". Leaving fields NULL.'
-                    % (acq_name, file_name)
-                )
-    elif atype == "gain" and ftype.name == "calibration":
-        if di.CalibrationGainFileInfo.get_or_none(file=file) is None:
-            try:
-                di.CalibrationGainFileInfo.create(
-                    file=file, **get_filecalibrationgaininfo_keywords_from_h5(fullpath)
-                )
-                log.info(
-                    'Added information for file "%s/%s" to DB.' % (acq_name, file_name)
-                )
-            except:
-                if di.CalibrationGainFileInfo.get_or_none(file=file) is None:
-                    di.CalibrationGainFileInfo.create(file=file)
-                log.warning(
-                    'Missing info for file "%s/%s". Leaving fields NULL.'
-                    % (acq_name, file_name)
-                )
-    elif atype == "flaginput" and ftype.name == "calibration":
-        if di.FlagInputFileInfo.get_or_none(file=file) is None:
-            try:
-                di.FlagInputFileInfo.create(
-                    file=file, **get_fileflaginputinfo_keywords_from_h5(fullpath)
-                )
-                log.info(
-                    'Added information for file "%s/%s" to DB.' % (acq_name, file_name)
-                )
-            except:
-                if di.FlagInputFileInfo.get_or_none(file=file) is None:
-                    di.FlagInputFileInfo.create(file=file)
-                log.warning(
-                    'Missing info for file "%s/%s". Leaving fields NULL.'
-                    % (acq_name, file_name)
-                )
+        for (model, columns), rows in batches.items():
+            model.insert_many(rows).execute()
 
-    elif atype == "misc" and ftype.name == "miscellaneous":
-        with db.proxy.atomic():
-            if di.MiscFileInfo.get_or_none(file=file) is None:
-                di.MiscFileInfo.create(file=file, **get_miscfile_data(fullpath))
-                log.info(
-                    'Added information for file "%s/%s" to DB.' % (acq_name, file_name)
-                )
+        for file_name, row in refilled:
+            row.save()
+
+    metrics.imported_files.inc(len(new_files), node=node.name)
+    metrics.imported_bytes.inc(sum(f["size_b"] for f in new_files), node=node.name)
+
+    # Requests for new files tend to follow soon after they are imported
+    if new_files:
+        schedule.node_schedule.wake(["requests", "hpss"])
+
+    added = [name for name, keywords in new_info.items() if keywords]
+    for file_name in sorted(added + [name for name, row in refilled]):
+        log.info('Added information for file "%s/%s" to DB.' % (acq_name, file_name))
 
     if import_done is not None:
-        bisect.insort_left(import_done, fullpath)
-        with open(LOCAL_IMPORT_RECORD, "w") as fp:
-            fp.write("\n".join(import_done))
+        import_done.add_many([path(name) for name in names])
 
 
 # Watchdog stuff
@@ -858,21 +1431,21 @@ class RegisterFile(FileSystemEventHandler):
         # Figure out the parts; it should be ROOT/ACQ_NAME/FILE_NAME
         subpath = event.src_path.replace(self.root + "/", "").split("/")
         if len(subpath) == 2:
-            import_file(self.node, self.root, subpath[0], subpath[1])
+            queue_import(self.node, self.root, subpath[0], subpath[1])
         return
 
     def on_created(self, event):
         # Figure out the parts; it should be ROOT/ACQ_NAME/FILE_NAME
         subpath = event.src_path.replace(self.root + "/", "").split("/")
         if len(subpath) == 2:
-            import_file(self.node, self.root, subpath[0], subpath[1])
+            queue_import(self.node, self.root, subpath[0], subpath[1])
         return
 
     def on_moved(self, event):
         # Figure out the parts; it should be ROOT/ACQ_NAME/FILE_NAME
         subpath = event.dest_path.replace(self.root + "/", "").split("/")
         if len(subpath) == 2:
-            import_file(self.node, self.root, subpath[0], subpath[1])
+            queue_import(self.node, self.root, subpath[0], subpath[1])
         return
 
     def on_deleted(self, event):
@@ -883,4 +1456,4 @@ class RegisterFile(FileSystemEventHandler):
         if len(subpath) == 2:
             if subpath[1][0] == "." and subpath[1][-5:] == ".lock":
                 subpath[1] = subpath[1][1:-5]
-                import_file(self.node, self.root, subpath[0], subpath[1])
+                queue_import(self.node, self.root, subpath[0], subpath[1])
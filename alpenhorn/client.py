@@ -23,11 +23,69 @@ import peewee as pw
 import chimedb.core as db
 import chimedb.data_index as di
 
+from . import nodestats, replicas
+from . import verify as verify_mod
+
+# Number of rows fetched per query when paging through large queries
+PAGE_SIZE = 5000
+
 
 def normalize(name):
     return name.replace("_", "-")
 
 
+def _paged(query, key, page_size=PAGE_SIZE):
+    """Iterate over the rows of `query` a page at a time.
+
+    Each page is fetched with its own query, ordered by `key`, so that memory
+    use is bounded however many rows there are, and no result is held open on
+    the server between pages.
+
+    Parameters
+    ----------
+    query : peewee.Select
+        The query. The first columns selected must be those of `key`.
+    key : peewee.Field or tuple
+        A field, or tuple of fields, unique amongst the rows of the query.
+    page_size : int
+        The number of rows per page.
+
+    Yields
+    ------
+    rows : list
+        A page of row tuples.
+    """
+    keys = key if isinstance(key, tuple) else (key,)
+
+    last = None
+    while True:
+        page = query.order_by(*keys).limit(page_size)
+        if last is not None:
+            page = page.where(_after(keys, last))
+
+        rows = list(page.tuples())
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        last = rows[-1][: len(keys)]
+
+
+def _after(keys, values):
+    """An expression selecting the rows which come after `values` in `keys` order.
+
+    This is written out as (k0 > v0) OR (k0 = v0 AND k1 > v1) OR ..., which
+    more databases can answer from an index than a row-value comparison.
+    """
+    expr = None
+    for i in reversed(range(len(keys))):
+        term = keys[i] > values[i]
+        if expr is not None:
+            term = term | ((keys[i] == values[i]) & expr)
+        expr = term
+    return expr
+
+
 # Pass token_normalize_func to context to allow commands with underscores
 @click.group(context_settings={"token_normalize_func": normalize})
 def cli():
@@ -83,27 +141,11 @@ def sync(
         raise db.NotFoundError('Group "%s" does not exist in the DB.' % group_name)
 
     # Construct list of file copies that are available on the source node, and
-    # not available on any nodes at the destination. This query is quite complex
-    # so I've broken it up...
-
-    # First get the nodes at the destination...
-    nodes_at_dest = di.StorageNode.select().where(di.StorageNode.group == to_group)
-
-    # Then use this to get a list of all files at the destination...
-    files_at_dest = (
-        di.ArchiveFile.select()
-        .join(di.ArchiveFileCopy)
-        .where(
-            di.ArchiveFileCopy.node << nodes_at_dest, di.ArchiveFileCopy.has_file == "Y"
-        )
-    )
-
-    # Then combine to get all file(copies) that are available at the source but
-    # not at the destination...
+    # not available on any nodes at the destination
     copy = di.ArchiveFileCopy.select().where(
         di.ArchiveFileCopy.node == from_node,
         di.ArchiveFileCopy.has_file == "Y",
-        ~(di.ArchiveFileCopy.file << files_at_dest),
+        ~replicas.copy_exists(di.ArchiveFileCopy.file, group=to_group),
     )
 
     # If the target option has been specified, only copy nodes also not
@@ -117,23 +159,10 @@ def sync(
                 'Target group "%s" does not exist in the DB.' % target
             )
 
-        # First get the nodes at the destination...
-        nodes_at_target = di.StorageNode.select().where(
-            di.StorageNode.group == target_group
-        )
-
-        # Then use this to get a list of all files at the destination...
-        files_at_target = (
-            di.ArchiveFile.select()
-            .join(di.ArchiveFileCopy)
-            .where(
-                di.ArchiveFileCopy.node << nodes_at_target,
-                di.ArchiveFileCopy.has_file == "Y",
-            )
-        )
-
         # Only match files that are also not available at the target
-        copy = copy.where(~(di.ArchiveFileCopy.file << files_at_target))
+        copy = copy.where(
+            ~replicas.copy_exists(di.ArchiveFileCopy.file, group=target_group)
+        )
 
     # In transport mode (DEPRECATED) we only move files that don't have an
     # archive copy elsewhere...
@@ -142,22 +171,13 @@ def sync(
 
         warnings.warn("Transport mode is deprecated. Try to use --target instead.")
 
-        # Get list of other archive nodes
-        other_archive_nodes = di.StorageNode.select().where(
-            di.StorageNode.storage_type == "A", di.StorageNode.id != from_node
-        )
-
-        files_in_archive = (
-            di.ArchiveFile.select()
-            .join(di.ArchiveFileCopy)
-            .where(
-                di.ArchiveFileCopy.node << other_archive_nodes,
-                di.ArchiveFileCopy.has_file == "Y",
+        # Exclude files with a copy on any other archive node
+        copy = copy.where(
+            ~replicas.copy_exists(
+                di.ArchiveFileCopy.file, storage_type="A", exclude_node=from_node
             )
         )
 
-        copy = copy.where(~(di.ArchiveFileCopy.file << files_in_archive))
-
     # Join onto ArchiveFile for later query parts
     copy = copy.join(di.ArchiveFile)
 
@@ -172,30 +192,40 @@ def sync(
         # Restrict files to be in the acquisition
         copy = copy.where(di.ArchiveFile.acq == acq)
 
-    if not copy.count():
+    # Summarise the copies in SQL, rather than fetching them all
+    ncopies, size_bytes = copy.select(
+        pw.fn.COUNT(di.ArchiveFileCopy.id), pw.fn.SUM(di.ArchiveFile.size_b)
+    ).scalar(as_tuple=True)
+
+    if not ncopies:
         print("No files to copy from node %s." % (node_name))
         return
 
     # Show acquisitions based summary of files to be copied
     if show_acq:
-        acqs = [c.file.acq.name for c in copy]
-
-        import collections
-
-        for acq, count in collections.Counter(acqs).items():
-            print("%s [%i files]" % (acq, count))
+        acqs = (
+            copy.select(di.ArchiveAcq.name, pw.fn.COUNT(di.ArchiveFileCopy.id))
+            .join(di.ArchiveAcq)
+            .group_by(di.ArchiveAcq.name)
+            .tuples()
+        )
+        for acq_name, count in acqs:
+            print("%s [%i files]" % (acq_name, count))
 
     # Show all files to be copied
     if show_files:
-        for c in copy:
-            print("%s/%s" % (c.file.acq.name, c.file.name))
+        names = copy.select(
+            di.ArchiveFileCopy.id, di.ArchiveAcq.name, di.ArchiveFile.name
+        ).join(di.ArchiveAcq)
+        for rows in _paged(names, di.ArchiveFileCopy.id):
+            for _, acq_name, file_name in rows:
+                print("%s/%s" % (acq_name, file_name))
 
-    size_bytes = copy.select(pw.fn.Sum(di.ArchiveFile.size_b)).scalar()
-    size_gb = int(size_bytes) / 1073741824.0
+    size_gb = int(size_bytes or 0) / 1073741824.0
 
     print(
         "Will request that %d files (%.1f GB) be copied from node %s to group %s."
-        % (copy.count(), size_gb, node_name, group_name)
+        % (ncopies, size_gb, node_name, group_name)
     )
 
     if not (force or click.confirm("Do you want to proceed?")):
@@ -204,113 +234,126 @@ def sync(
 
     dtnow = datetime.datetime.now()
 
-    # Perform update in a transaction to avoid any clobbering from concurrent updates
-    with di.ArchiveFileCopyRequest._meta.database.atomic():
-        # Get a list of all the file ids for the copies we should perform
-        files_ids = [c.file_id for c in copy]
-
-        # Get a list of all the file ids for exisiting requests
-        requests = di.ArchiveFileCopyRequest.select().where(
-            di.ArchiveFileCopyRequest.group_to == to_group,
-            di.ArchiveFileCopyRequest.node_from == from_node,
-        )
-        req_file_ids = [req.file_id for req in requests]
-
-        # Separate the files into ones that already have requests and ones that don't
-        files_in = [x for x in files_ids if x in req_file_ids]
-        files_out = [x for x in files_ids if x not in req_file_ids]
-
-        sys.stdout.write(
-            "Updating %i existing requests and inserting %i new ones.\n"
-            % (len(files_in), len(files_out))
-        )
+    # The requests from the source node to the destination group
+    requests = di.ArchiveFileCopyRequest.select(di.ArchiveFileCopyRequest.file).where(
+        di.ArchiveFileCopyRequest.group_to == to_group,
+        di.ArchiveFileCopyRequest.node_from == from_node,
+    )
 
-        # Perform an update of all the existing copy requests
-        if len(files_in) > 0:
-            update = di.ArchiveFileCopyRequest.update(
-                nice=nice,
-                completed=False,
-                cancelled=False,
-                timestamp=dtnow,
-                n_requests=di.ArchiveFileCopyRequest.n_requests + 1,
-            )
+    n_updated = 0
+    n_inserted = 0
 
-            update = update.where(
-                di.ArchiveFileCopyRequest.file << files_in,
-                di.ArchiveFileCopyRequest.group_to == to_group,
-                di.ArchiveFileCopyRequest.node_from == from_node,
+    # Perform update in a transaction to avoid any clobbering from concurrent
+    # updates. The copies are handled a page at a time, to keep memory use
+    # bounded.
+    with di.ArchiveFileCopyRequest._meta.database.atomic():
+        file_ids = copy.select(di.ArchiveFileCopy.id, di.ArchiveFileCopy.file)
+        for rows in _paged(file_ids, di.ArchiveFileCopy.id):
+            page_ids = sorted(set(file_id for _, file_id in rows))
+
+            # Separate the files into ones that already have requests and ones
+            # that don't
+            files_in = set(
+                file_id
+                for (file_id,) in requests.where(
+                    di.ArchiveFileCopyRequest.file << page_ids
+                ).tuples()
             )
-            update.execute()
-
-        # Insert any new requests
-        if len(files_out) > 0:
-            # Construct a list of all the rows to insert
-            insert = [
-                {
-                    "file": fid,
-                    "node_from": from_node,
-                    "nice": 0,
-                    "group_to": to_group,
-                    "completed": False,
-                    "n_requests": 1,
-                    "timestamp": dtnow,
-                }
-                for fid in files_out
-            ]
+            files_out = [x for x in page_ids if x not in files_in]
+
+            # Perform an update of all the existing copy requests
+            if len(files_in) > 0:
+                update = di.ArchiveFileCopyRequest.update(
+                    nice=nice,
+                    completed=False,
+                    cancelled=False,
+                    timestamp=dtnow,
+                    n_requests=di.ArchiveFileCopyRequest.n_requests + 1,
+                )
 
-            # Do a bulk insert of these new rows
-            di.ArchiveFileCopyRequest.insert_many(insert).execute()
+                update = update.where(
+                    di.ArchiveFileCopyRequest.file << sorted(files_in),
+                    di.ArchiveFileCopyRequest.group_to == to_group,
+                    di.ArchiveFileCopyRequest.node_from == from_node,
+                )
+                update.execute()
+                n_updated += len(files_in)
+
+            # Insert any new requests
+            if len(files_out) > 0:
+                # Construct a list of all the rows to insert
+                insert = [
+                    {
+                        "file": fid,
+                        "node_from": from_node,
+                        "nice": 0,
+                        "group_to": to_group,
+                        "completed": False,
+                        "n_requests": 1,
+                        "timestamp": dtnow,
+                    }
+                    for fid in files_out
+                ]
+
+                # Do a bulk insert of these new rows
+                di.ArchiveFileCopyRequest.insert_many(insert).execute()
+                n_inserted += len(files_out)
+
+    sys.stdout.write(
+        "Updated %i existing requests and inserted %i new ones.\n"
+        % (n_updated, n_inserted)
+    )
 
 
 @cli.command()
 @click.option(
     "--all", help="Show the status of all nodes, not just active ones.", is_flag=True
 )
-def status(all):
-    """Summarise the status of alpenhorn storage nodes."""
+@click.option(
+    "--refresh",
+    help="Recompute the file totals of every node from the file copies first.",
+    is_flag=True,
+)
+def status(all, refresh):
+    """Summarise the status of alpenhorn storage nodes.
 
-    import tabulate
+    The file totals of each node are maintained as copies are added and
+    removed, rather than being counted up each time. Use --refresh to
+    recompute them if they look wrong.
+    """
 
-    db.connect()
+    import tabulate
 
-    # Data to fetch from the database (node name, total files, total size)
-    query_info = (
-        di.StorageNode.name,
-        pw.fn.Count(di.ArchiveFileCopy.id).alias("count"),
-        pw.fn.Sum(di.ArchiveFile.size_b).alias("total_size"),
-        di.StorageNode.host,
-        di.StorageNode.root,
-    )
+    if refresh:
+        db.connect(read_write=True)
+        nodestats.refresh()
+    else:
+        db.connect()
 
-    # Per node totals
-    nodes = (
-        di.StorageNode.select(*query_info)
-        .join(di.ArchiveFileCopy)
-        .where(di.ArchiveFileCopy.has_file == "Y")
-        .join(di.ArchiveFile)
-        .group_by(di.StorageNode)
-        .order_by(di.StorageNode.name)
-    )
+    nodes = di.StorageNode.select(
+        di.StorageNode.id, di.StorageNode.name, di.StorageNode.host, di.StorageNode.root
+    ).order_by(di.StorageNode.name)
 
     if not all:
         nodes = nodes.where(di.StorageNode.active)
 
-    # Totals for the whole archive
-    tot = di.ArchiveFile.select(
-        pw.fn.Count(di.ArchiveFile.id).alias("count"),
-        pw.fn.Sum(di.ArchiveFile.size_b).alias("total_size"),
-    ).scalar(as_tuple=True)
+    nodes = list(nodes.tuples())
+
+    # Per node totals, and totals for the whole archive
+    totals = nodestats.totals([node[0] for node in nodes] + [None])
+    tot = totals[None]
 
     data = [
         [
-            node[0],
-            int(node[1]),
-            int(node[2]) / 2**40.0,
-            100.0 * int(node[1]) / int(tot[0]),
-            100.0 * int(node[2]) / int(tot[1]),
-            "%s:%s" % (node[3], node[4]),
+            name,
+            totals[node_id][0],
+            totals[node_id][1] / 2**40.0,
+            100.0 * totals[node_id][0] / tot[0],
+            100.0 * totals[node_id][1] / tot[1],
+            "%s:%s" % (host, root),
         ]
-        for node in nodes.tuples()
+        for node_id, name, host, root in nodes
+        if totals[node_id][0] > 0
     ]
 
     headers = ["Node", "Files", "Size [TB]", "Files [%]", "Size [%]", "Path"]
@@ -330,8 +373,49 @@ def status(all):
     multiple=True,
     help="Limit verification to specified acquisitions. Use repeated --acq flags to specify multiple acquisitions.",
 )
-def verify(node_name, md5, fixdb, acq):
-    """Verify the archive on NODE against the database."""
+@click.option(
+    "--fast",
+    help="only check that files exist, by listing each acquisition directory "
+    "once rather than looking up each file",
+    is_flag=True,
+)
+@click.option(
+    "--workers",
+    "-w",
+    help="Number of files (or directories, with --fast) to check at the same time.",
+    type=int,
+    default=1,
+)
+@click.option(
+    "--state",
+    metavar="FILE",
+    help="File in which to save progress, so that an interrupted check can be "
+    "resumed. If not given, nothing is saved.",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--since",
+    metavar="DATE",
+    help="Skip files found to be good since DATE by an earlier check.",
+    type=click.DateTime(),
+    default=None,
+)
+def verify(node_name, md5, fixdb, acq, fast, workers, state, since):
+    """Verify the archive on NODE against the database.
+
+    Files are checked in order of acquisition, several at a time with
+    --workers. With --state, progress is saved to a file: if a check is
+    interrupted, running it again with the same options and state file carries
+    on where it left off.
+
+    By default the size of each file is checked. With --fast, only whether
+    each file exists is checked, by listing each acquisition directory once,
+    which puts much less load on the metadata servers of cluster filesystems.
+    """
+
+    if fast and md5:
+        raise click.UsageError("--fast and --md5 can't be used together.")
 
     db.connect()
 
@@ -343,56 +427,111 @@ def verify(node_name, md5, fixdb, acq):
 
     ## Use a complicated query with a tuples construct to fetch everything we
     ## need in a single query. This massively speeds up the whole process versus
-    ## fetching all the FileCopy's then querying for Files and Acqs.
+    ## fetching all the FileCopy's then querying for Files and Acqs. Files are
+    ## ordered by acquisition, so files in the same directory are read together.
     lfiles = (
         di.ArchiveFile.select(
-            di.ArchiveFile.name,
             di.ArchiveAcq.name,
+            di.ArchiveFile.name,
+            di.ArchiveFileCopy.id,
             di.ArchiveFile.size_b,
             di.ArchiveFile.md5sum,
-            di.ArchiveFileCopy.id,
         )
         .join(di.ArchiveAcq)
         .switch(di.ArchiveFile)
         .join(di.ArchiveFileCopy)
         .where(di.ArchiveFileCopy.node == this_node, di.ArchiveFileCopy.has_file == "Y")
-        .tuples()
     )
 
-    missing_files = []
-    corrupt_files = []
+    # Limit to the specified acquisitions
+    if len(acq) > 0:
+        lfiles = lfiles.where(di.ArchiveAcq.name << list(acq))
 
-    missing_ids = []
-    corrupt_ids = []
+    ntotal = lfiles.count()
 
-    nfiles = 0
+    # Open the record of progress, and start or resume a run
+    progress = verify_mod.VerifyState(state or ":memory:")
+    if md5:
+        level = verify_mod.CHECK_MD5
+    elif fast:
+        level = verify_mod.CHECK_EXISTS
+    else:
+        level = verify_mod.CHECK_SIZE
+    options = "node=%s level=%i acq=%s" % (node_name, level, ",".join(sorted(acq)))
+    run_start, resumed = progress.start_run(options)
+    if resumed:
+        print(
+            "Resuming the check started %s."
+            % datetime.datetime.fromtimestamp(run_start).strftime("%Y-%m-%d %H:%M")
+        )
+    since = time.mktime(since.timetuple()) if since is not None else None
+
+    counts = {"checked": 0, "resumed": 0, "skipped": 0}
+
+    def to_check(bar):
+        """The copies which need checking, as (id, path, size, md5sum)."""
+        # Fetch the copies a page at a time, in order of acquisition and
+        # file, as checking them can take a long time.
+        for rows in _paged(
+            lfiles, (di.ArchiveAcq.name, di.ArchiveFile.name, di.ArchiveFileCopy.id)
+        ):
+            for acqname, filename, fc_id, filesize, md5sum in rows:
+                checked_time, result, this_run = progress.checked(fc_id, level)
+
+                if this_run:
+                    # Checked earlier in this run
+                    counts["resumed"] += 1
+                    bar.update(1)
+                elif (
+                    since is not None
+                    and checked_time is not None
+                    and checked_time >= since
+                    and result == verify_mod.OK
+                ):
+                    # Found to be good recently enough
+                    counts["skipped"] += 1
+                    bar.update(1)
+                else:
+                    filepath = this_node.root + "/" + acqname + "/" + filename
+                    yield fc_id, filepath, filesize, md5sum
 
-    with click.progressbar(lfiles, label="Scanning files") as lfiles_iter:
-        for filename, acqname, filesize, md5sum, fc_id in lfiles_iter:
-            # Skip if not in specified acquisitions
-            if len(acq) > 0 and acqname not in acq:
-                continue
+    try:
+        with click.progressbar(length=ntotal, label="Scanning files") as bar:
+            if fast:
+                results = verify_mod.check_dirs(
+                    verify_mod.by_dir(to_check(bar)), workers=workers
+                )
+            else:
+                results = verify_mod.check_copies(
+                    to_check(bar), workers=workers, md5=md5
+                )
 
-            nfiles += 1
+            for fc_id, filepath, result in results:
+                progress.record(fc_id, filepath, level, result)
+                counts["checked"] += 1
+                bar.update(1)
+    except BaseException:
+        progress.close()
+        raise
 
-            filepath = this_node.root + "/" + acqname + "/" + filename
+    progress.finish_run()
 
-            # Check if file is plain missing
-            if not os.path.exists(filepath):
-                missing_files.append(filepath)
-                missing_ids.append(fc_id)
-                continue
+    # The problems found in this run, including any part of it resumed
+    missing_files = []
+    corrupt_files = []
 
-            if md5:
-                file_md5 = di.util.md5sum_file(filepath)
-                corrupt = file_md5 != md5sum
-            else:
-                corrupt = os.path.getsize(filepath) != filesize
+    missing_ids = []
+    corrupt_ids = []
 
-            if corrupt:
-                corrupt_files.append(filepath)
-                corrupt_ids.append(fc_id)
-                continue
+    for fc_id, filepath, result in progress.problems():
+        if result == verify_mod.MISSING:
+            missing_files.append(filepath)
+            missing_ids.append(fc_id)
+        else:
+            corrupt_files.append(filepath)
+            corrupt_ids.append(fc_id)
+
+    progress.close()
 
     if len(missing_files) > 0:
         print()
@@ -408,7 +547,11 @@ def verify(node_name, md5, fixdb, acq):
 
     print()
     print("=== Summary ===")
-    print("  %i total files" % nfiles)
+    print("  %i total files" % ntotal)
+    if counts["resumed"] > 0:
+        print("  %i files checked before resuming" % counts["resumed"])
+    if counts["skipped"] > 0:
+        print("  %i files skipped as checked recently" % counts["skipped"])
     print("  %i missing files" % len(missing_files))
     print("  %i corrupt files" % len(corrupt_files))
     print()
@@ -420,18 +563,14 @@ def verify(node_name, md5, fixdb, acq):
         db.connect(read_write=True)
 
         if (len(missing_files) > 0) and click.confirm("Fix missing files"):
-            missing_count = (
-                di.ArchiveFileCopy.update(has_file="N")
-                .where(di.ArchiveFileCopy.id << missing_ids)
-                .execute()
+            missing_count = nodestats.update_copies(
+                di.ArchiveFileCopy.id << missing_ids, "N"
             )
             print("  %i marked as missing" % missing_count)
 
         if (len(corrupt_files) > 0) and click.confirm("Fix corrupt files"):
-            corrupt_count = (
-                di.ArchiveFileCopy.update(has_file="M")
-                .where(di.ArchiveFileCopy.id << corrupt_ids)
-                .execute()
+            corrupt_count = nodestats.update_copies(
+                di.ArchiveFileCopy.id << corrupt_ids, "M"
             )
             print("  %i corrupt files marked for verification" % corrupt_count)
 
@@ -533,9 +672,7 @@ def clean(node_name, days, size, force, now, target, acq):
         except pw.DoesNotExit:
             raise db.NotFoundError("Specified acquisition %s does not exist" % acq)
 
-        files_in_acq = di.ArchiveFile.select().where(di.ArchiveFile.acq == acq)
-
-        files = files.where(di.ArchiveFileCopy.file << files_in_acq)
+        files = files.where(di.ArchiveFile.acq == acq)
 
     # If the target option has been specified, only clean files also available there...
     if target is not None:
@@ -547,23 +684,10 @@ def clean(node_name, days, size, force, now, target, acq):
                 'Target group "%s" does not exist in the DB.' % target
             )
 
-        # First get the nodes at the destination...
-        nodes_at_target = di.StorageNode.select().where(
-            di.StorageNode.group == target_group
-        )
-
-        # Then use this to get a list of all files at the destination...
-        files_at_target = (
-            di.ArchiveFile.select()
-            .join(di.ArchiveFileCopy)
-            .where(
-                di.ArchiveFileCopy.node << nodes_at_target,
-                di.ArchiveFileCopy.has_file == "Y",
-            )
-        )
-
         # Only match files that are also available at the target
-        files = files.where(di.ArchiveFileCopy.file << files_at_target)
+        files = files.where(
+            replicas.copy_exists(di.ArchiveFileCopy.file, group=target_group)
+        )
 
     # If --days has been set we need to restrict to files older than the given
     # time. This only works for a few particular file types
@@ -1081,6 +1205,7 @@ def import_files(node_name, verbose, acq, dry):
                         di.ArchiveFileCopy.create(
                             file=archive_file, node=node, has_file="Y", wants_file="Y"
                         )
+                        nodestats.add(node, 1, archive_file.size_b)
 
     print("\n==== Summary ====")
     print()
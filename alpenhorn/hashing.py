@@ -0,0 +1,160 @@
+"""Routines for computing MD5 hashes of files."""
+
+# === Start Python 2/3 compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+from future.builtins import *  # noqa  pylint: disable=W0401, W0614
+from future.builtins.disabled import *  # noqa  pylint: disable=W0401, W0614
+
+# === End Python 2/3 compatibility
+
+import hashlib
+import os
+import threading
+import time
+from concurrent import futures
+
+# Setup the logging
+from . import logger
+
+log = logger.get_log()
+
+# Size of the blocks read when hashing a file. Large reads keep the number of
+# system calls down, and let hashlib release the GIL for most of the work.
+BLOCK_SIZE = 4 * 2**20
+
+# Given by `md5sum_files` in place of the hash of a file which exists, but
+# can't be read
+UNREADABLE = "unreadable"
+
+
+class RateLimiter(object):
+    """Limit the combined rate at which bytes are read by several threads.
+
+    Parameters
+    ----------
+    bytes_per_second : float
+        The maximum rate. If None or zero, there is no limit.
+    """
+
+    def __init__(self, bytes_per_second=None):
+        self.bytes_per_second = bytes_per_second
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def consume(self, nbytes):
+        """Account for `nbytes` read, sleeping as needed to keep to the rate."""
+        if not self.bytes_per_second:
+            return
+
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + nbytes / self.bytes_per_second
+
+        if start > now:
+            time.sleep(start - now)
+
+
+class HashStats(object):
+    """Thread-safe totals of the hashing done, for reporting throughput."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+
+    def record(self, nbytes):
+        """Record that a file of `nbytes` was hashed."""
+        with self._lock:
+            self.files += 1
+            self.bytes += nbytes
+
+
+def md5sum_file(path, limiter=None, stats=None):
+    """Compute the MD5 hash of a file.
+
+    Parameters
+    ----------
+    path : string
+        The file to hash.
+    limiter : RateLimiter, optional
+        Used to limit the rate at which the file is read.
+    stats : HashStats, optional
+        Updated with the size of the file.
+
+    Returns
+    -------
+    md5sum : string
+        The hex digest of the file.
+    """
+    md5 = hashlib.md5()
+    buf = bytearray(BLOCK_SIZE)
+    view = memoryview(buf)
+    nbytes = 0
+
+    with open(path, "rb", buffering=0) as f:
+        # Let the kernel read further ahead, as we read the file straight through
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            md5.update(view[:n])
+            nbytes += n
+            if limiter is not None:
+                limiter.consume(n)
+
+    if stats is not None:
+        stats.record(nbytes)
+
+    return md5.hexdigest()
+
+
+def _md5sum_if_exists(path, limiter, stats):
+    try:
+        return md5sum_file(path, limiter, stats)
+    except (IOError, OSError) as e:
+        if not os.path.exists(path):
+            return None
+        log.error('Could not read file "%s": %s' % (path, e))
+        return UNREADABLE
+
+
+def md5sum_files(paths, workers=1, limiter=None, stats=None, pool=None):
+    """Compute the MD5 hashes of several files on a pool of threads.
+
+    Parameters
+    ----------
+    paths : iterable
+        The files to hash.
+    workers : int
+        The number of files to hash at once.
+    limiter : RateLimiter, optional
+        Used to limit the combined rate at which the files are read.
+    stats : HashStats, optional
+        Updated for each file hashed.
+    pool : concurrent.futures.ThreadPoolExecutor, optional
+        The pool to hash the files on, so it can be reused between calls. If
+        not given, a pool of `workers` threads is made for this call.
+
+    Yields
+    ------
+    path : string
+        The file hashed. Files are yielded in the order they finish.
+    md5sum : string
+        The hex digest, None if the file does not exist, or `UNREADABLE` if it
+        couldn't be read.
+    """
+    if pool is None:
+        with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for result in md5sum_files(paths, workers, limiter, stats, pool):
+                yield result
+        return
+
+    jobs = {
+        pool.submit(_md5sum_if_exists, path, limiter, stats): path for path in paths
+    }
+    for job in futures.as_completed(jobs):
+        yield jobs[job], job.result()
@@ -8,21 +8,161 @@ from future.builtins.disabled import *  # noqa  pylint: disable=W0401, W0614
 # === End Python 2/3 compatibility
 
 
-import peewee as pw
 import click
 
 import chimedb.core as db
 import chimedb.data_index.orm as di
 
 from . import logger  # Import logger here to avoid connection
+from . import nodestats
 
 # messages for transfer
 
 # Get a reference to the log
 log = logger.get_log()
 
-# Connect to the database read/write
-db.connect(read_write=True)
+# The callbacks, and whether each one records a new copy of the file
+ACTIONS = {
+    "push_success": True,
+    "pull_success": True,
+    "push_failed": False,
+    "pull_failed": False,
+}
+
+# Log messages for the callbacks
+_MESSAGES = {
+    "push_success": "Successful push: %s/%s onto node %s",
+    "pull_success": "Successful pull: %s/%s into node %s",
+    "push_failed": "Failed push: %s/%s into node %s",
+    "pull_failed": "Failed pull: %s/%s onto node %s",
+}
+
+
+def apply_callbacks(callbacks):
+    """Update the database to reflect the outcome of a batch of HPSS transfers.
+
+    The files and nodes are looked up in one go, and the copies of the
+    successfully transferred files are updated or inserted in bulk, in a single
+    transaction.
+
+    Parameters
+    ----------
+    callbacks : list
+        Tuples of (action, file_id, node_id), where action is a key of
+        `ACTIONS`.
+    """
+
+    file_ids = set(file_id for action, file_id, node_id in callbacks)
+    node_ids = set(node_id for action, file_id, node_id in callbacks)
+
+    files = {}
+    sizes = {}
+    for file_id, file_name, acq_name, size_b in (
+        di.ArchiveFile.select(
+            di.ArchiveFile.id,
+            di.ArchiveFile.name,
+            di.ArchiveAcq.name,
+            di.ArchiveFile.size_b,
+        )
+        .join(di.ArchiveAcq)
+        .where(di.ArchiveFile.id << list(file_ids))
+        .tuples()
+    ):
+        files[file_id] = (acq_name, file_name)
+        sizes[file_id] = size_b or 0
+    nodes = dict(
+        di.StorageNode.select(di.StorageNode.id, di.StorageNode.name)
+        .where(di.StorageNode.id << list(node_ids))
+        .tuples()
+    )
+
+    # The file copies to mark as present, by node
+    present = {}
+    for action, file_id, node_id in callbacks:
+        if file_id not in files or node_id not in nodes:
+            log.error(
+                "Unknown file %i or node %i in callback %s."
+                % (file_id, node_id, action)
+            )
+            continue
+
+        if ACTIONS[action]:
+            present.setdefault(node_id, set()).add(file_id)
+
+    with db.proxy.atomic():
+        for node_id, node_file_ids in present.items():
+            # Update the FileCopy (if exists), or insert a new FileCopy
+            existing = dict(
+                di.ArchiveFileCopy.select(
+                    di.ArchiveFileCopy.file, di.ArchiveFileCopy.id
+                )
+                .where(
+                    di.ArchiveFileCopy.node == node_id,
+                    di.ArchiveFileCopy.file << list(node_file_ids),
+                )
+                .tuples()
+            )
+
+            if existing:
+                nodestats.update_copies(
+                    di.ArchiveFileCopy.id << list(existing.values()),
+                    "Y",
+                    wants_file="Y",
+                )
+
+            new = sorted(node_file_ids - set(existing))
+            if new:
+                di.ArchiveFileCopy.insert_many(
+                    [
+                        {
+                            "file": file_id,
+                            "node": node_id,
+                            "has_file": "Y",
+                            "wants_file": "Y",
+                        }
+                        for file_id in new
+                    ]
+                ).execute()
+                nodestats.add(node_id, len(new), sum(sizes[file_id] for file_id in new))
+
+    for action, file_id, node_id in callbacks:
+        if file_id in files and node_id in nodes:
+            acq_name, file_name = files[file_id]
+            message = _MESSAGES[action] % (acq_name, file_name, nodes[node_id])
+            if ACTIONS[action]:
+                log.info(message)
+            else:
+                # We don't really need to do anything other than log this (we
+                # could reattempt)
+                log.warn(message)
+
+
+def parse_callbacks(lines):
+    """Parse callbacks given one per line as "ACTION FILE_ID NODE_ID".
+
+    Blank lines are ignored, and lines which can't be parsed are logged and
+    skipped.
+
+    Returns
+    -------
+    callbacks : list
+        Tuples of (action, file_id, node_id), as taken by `apply_callbacks`.
+    """
+    callbacks = []
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+
+        try:
+            action, file_id, node_id = fields
+            if action not in ACTIONS:
+                raise ValueError("unknown action")
+            callbacks.append((action, int(file_id), int(node_id)))
+        except ValueError:
+            log.error("Incomprehensible callback: {0}".format(line.strip()))
+
+    return callbacks
 
 
 def normalize(name):
@@ -34,7 +174,9 @@ def normalize(name):
 def cli():
     """Call back commands for updating the database from a shell script after an
     HPSS transfer."""
-    pass
+
+    # Connect to the database read/write
+    db.connect(read_write=True)
 
 
 @cli.command()
@@ -45,14 +187,7 @@ def push_failed(file_id, node_id):
 
     INTERNAL COMMAND. NOT FOR HUMAN USE!
     """
-    afile = di.ArchiveFile.select().where(di.ArchiveFile.id == file_id).get()
-    node = di.StorageNode.select().where(di.StorageNode.id == node_id).get()
-
-    log.warn(
-        "Failed push: %s/%s into node %s" % (afile.acq.name, afile.name, node.name)
-    )
-
-    # We don't really need to do anything other than log this (we could reattempt)
+    apply_callbacks([("push_failed", file_id, node_id)])
 
 
 @cli.command()
@@ -63,14 +198,7 @@ def pull_failed(file_id, node_id):
 
     INTERNAL COMMAND. NOT FOR HUMAN USE!
     """
-    afile = di.ArchiveFile.select().where(di.ArchiveFile.id == file_id).get()
-    node = di.StorageNode.select().where(di.StorageNode.id == node_id).get()
-
-    log.warn(
-        "Failed pull: %s/%s onto node %s" % (afile.acq.name, afile.name, node.name)
-    )
-
-    # We don't really need to do anything other than log this (we could reattempt)
+    apply_callbacks([("pull_failed", file_id, node_id)])
 
 
 @cli.command()
@@ -81,30 +209,7 @@ def push_success(file_id, node_id):
 
     INTERNAL COMMAND. NOT FOR HUMAN USE!
     """
-
-    afile = di.ArchiveFile.select().where(di.ArchiveFile.id == file_id).get()
-    node = di.StorageNode.select().where(di.StorageNode.id == node_id).get()
-
-    # Update the FileCopy (if exists), or insert a new FileCopy
-    try:
-        fcopy = (
-            di.ArchiveFileCopy.select()
-            .where(di.ArchiveFileCopy.file == afile, di.ArchiveFileCopy.node == node)
-            .get()
-        )
-
-        fcopy.has_file = "Y"
-        fcopy.wants_file = "Y"
-        fcopy.save()
-
-    except pw.DoesNotExist:
-        di.ArchiveFileCopy.insert(
-            file=afile, node=node, has_file="Y", wants_file="Y"
-        ).execute()
-
-    log.info(
-        "Successful push: %s/%s onto node %s" % (afile.acq.name, afile.name, node.name)
-    )
+    apply_callbacks([("push_success", file_id, node_id)])
 
 
 @cli.command()
@@ -115,27 +220,18 @@ def pull_success(file_id, node_id):
 
     INTERNAL COMMAND. NOT FOR HUMAN USE!
     """
+    apply_callbacks([("pull_success", file_id, node_id)])
 
-    afile = di.ArchiveFile.select().where(di.ArchiveFile.id == file_id).get()
-    node = di.StorageNode.select().where(di.StorageNode.id == node_id).get()
-
-    # Update the FileCopy (if exists), or insert a new FileCopy
-    try:
-        fcopy = (
-            di.ArchiveFileCopy.select()
-            .where(di.ArchiveFileCopy.file == afile, di.ArchiveFileCopy.node == node)
-            .get()
-        )
 
-        fcopy.has_file = "Y"
-        fcopy.wants_file = "Y"
-        fcopy.save()
+@cli.command()
+@click.argument("callback_file", type=click.File("r"), default="-")
+def batch(callback_file):
+    """Update the database to reflect the outcome of many HPSS transfers.
 
-    except pw.DoesNotExist:
-        di.ArchiveFileCopy.insert(
-            file=afile, node=node, has_file="Y", wants_file="Y"
-        ).execute()
+    Each line of CALLBACK_FILE (standard input by default) gives the action,
+    file ID and node ID of a transfer, e.g. "push_success 123 4". The actions
+    are push_success, push_failed, pull_success and pull_failed.
 
-    log.info(
-        "Successful pull: %s/%s into node %s" % (afile.acq.name, afile.name, node.name)
-    )
+    INTERNAL COMMAND. NOT FOR HUMAN USE!
+    """
+    apply_callbacks(parse_callbacks(callback_file))
@@ -0,0 +1,320 @@
+"""Counters and histograms of the work done by alpenhornd.
+
+The metrics are exported in the Prometheus text format over HTTP, on the local
+port given by ALPENHORN_METRICS_PORT.
+"""
+
+# === Start Python 2/3 compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+from future.builtins import *  # noqa  pylint: disable=W0401, W0614
+from future.builtins.disabled import *  # noqa  pylint: disable=W0401, W0614
+
+# === End Python 2/3 compatibility
+
+import abc
+import os
+import threading
+import time
+from http import server
+
+# Setup the logging
+from . import logger
+
+log = logger.get_log()
+
+# Local port on which to serve the metrics. If not set, they aren't served.
+if "ALPENHORN_METRICS_PORT" in os.environ:
+    METRICS_PORT = int(os.environ["ALPENHORN_METRICS_PORT"])
+else:
+    METRICS_PORT = None
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    300.0,
+    600.0,
+    1800.0,
+    3600.0,
+)
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ""
+    return (
+        "{"
+        + ",".join(
+            '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+            for name, value in pairs
+        )
+        + "}"
+    )
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric(abc.ABC):
+    """A metric, with a value for each combination of its labels.
+
+    Parameters
+    ----------
+    name : string
+        The name of the metric.
+    description : string
+        What the metric measures.
+    labels : list
+        The names of the labels of the metric. A value must be given for each
+        when the metric is updated.
+    """
+
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    @abc.abstractmethod
+    def _samples(self):
+        """Yield (name, label pairs, value) for each sample of the metric."""
+
+    def render(self):
+        """The metric in the Prometheus text format."""
+        lines = [
+            "# HELP %s %s" % (self.name, self.description),
+            "# TYPE %s %s" % (self.name, self.kind),
+        ]
+        with self._lock:
+            for name, pairs, value in self._samples():
+                lines.append(
+                    "%s%s %s" % (name, _format_labels(pairs), _format_value(value))
+                )
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """A value which only increases."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Increase the counter by `amount`."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        for key, value in sorted(self._values.items()):
+            yield self.name, list(zip(self.labels, key)), value
+
+
+class Gauge(_Metric):
+    """A value which may go up or down."""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        """Set the value of the gauge."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self):
+        for key, value in sorted(self._values.items()):
+            yield self.name, list(zip(self.labels, key)), value
+
+
+class Histogram(_Metric):
+    """The distribution of observed values, counted into buckets.
+
+    Parameters
+    ----------
+    buckets : list, optional
+        The upper bounds of the buckets.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        """Record an observation of `value`."""
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0.0]
+            counts, total = self._values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key][1] = total + value
+
+    def _samples(self):
+        for key, (counts, total) in sorted(self._values.items()):
+            pairs = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield self.name + "_bucket", pairs + [
+                    ("le", _format_value(bound))
+                ], cumulative
+            yield self.name + "_sum", pairs, total
+            yield self.name + "_count", pairs, cumulative
+
+
+class Registry(object):
+    """A collection of metrics, rendered together."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+
+    def register(self, metric):
+        """Add `metric` to the registry, and return it."""
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All the metrics in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics)
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+registry = Registry()
+
+
+def counter(name, description, labels=()):
+    return registry.register(Counter(name, description, labels))
+
+
+def gauge(name, description, labels=()):
+    return registry.register(Gauge(name, description, labels))
+
+
+def histogram(name, description, labels=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, description, labels, buckets))
+
+
+# The metrics
+# ===========
+
+loop_seconds = histogram("alpenhorn_loop_seconds", "Duration of the main loop.")
+
+transfers = counter(
+    "alpenhorn_transfers_total",
+    "Transfers finished, by outcome.",
+    ["source", "dest", "result"],
+)
+transfer_bytes = counter(
+    "alpenhorn_transfer_bytes_total",
+    "Bytes successfully transferred.",
+    ["source", "dest"],
+)
+transfer_seconds = histogram(
+    "alpenhorn_transfer_seconds",
+    "Duration of successful transfers.",
+    ["source", "dest"],
+)
+md5_failures = counter(
+    "alpenhorn_md5_failures_total",
+    "Transferred files whose MD5 hash did not match the DB.",
+    ["source", "dest"],
+)
+requests_pending = gauge(
+    "alpenhorn_requests_pending",
+    "Files requested for transfer onto the node when last checked.",
+    ["node"],
+)
+
+imported_files = counter(
+    "alpenhorn_imported_files_total", "New files added to the DB.", ["node"]
+)
+imported_bytes = counter(
+    "alpenhorn_imported_bytes_total", "Size of the new files added to the DB.", ["node"]
+)
+import_queue_depth = gauge(
+    "alpenhorn_import_queue_depth", "Files waiting in the import queue."
+)
+
+integrity_files = counter(
+    "alpenhorn_integrity_files_total",
+    "Suspect file copies checked, by outcome.",
+    ["node", "result"],
+)
+integrity_bytes = counter(
+    "alpenhorn_integrity_bytes_total", "Bytes read checking file copies.", ["node"]
+)
+integrity_seconds = counter(
+    "alpenhorn_integrity_seconds_total", "Time spent checking file copies.", ["node"]
+)
+
+db_query_seconds = histogram(
+    "alpenhorn_db_query_seconds", "Duration of DB queries.", ["statement"]
+)
+
+
+def instrument_db(database):
+    """Time every query made through `database`, a peewee Database."""
+    execute_sql = database.execute_sql
+
+    def timed_execute_sql(sql, *args, **kwargs):
+        start = time.time()
+        try:
+            return execute_sql(sql, *args, **kwargs)
+        finally:
+            statement = sql.split(None, 1)[0].upper() if sql.strip() else ""
+            db_query_seconds.observe(time.time() - start, statement=statement)
+
+    database.execute_sql = timed_execute_sql
+
+
+class _MetricsHandler(server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, address="127.0.0.1"):
+    """Serve the metrics at http://`address`:`port`/metrics from a thread."""
+    httpd = server.HTTPServer((address, port), _MetricsHandler)
+    thread = threading.Thread(target=httpd.serve_forever, name="metrics")
+    thread.daemon = True
+    thread.start()
+    log.info("Serving metrics on %s:%i." % httpd.server_address)
+    return httpd
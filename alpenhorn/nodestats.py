@@ -0,0 +1,309 @@
+"""Materialized totals of the files and bytes held on each node.
+
+The number and total size of the file copies present (has_file == "Y") on
+each node, and of the files in the whole archive, are kept in the
+`alpenhorn_node_stats` table. They are adjusted whenever alpenhorn adds or
+removes copies, so they can be read without aggregating over every copy in
+the archive.
+
+The table is part of the database schema, and alpenhorn never creates it:
+add it alongside the data index tables when setting up or migrating the
+database (see the documentation). Until it exists, the totals are computed
+on the fly and none are stored.
+
+The daemon computes and stores the totals of the archive, and of the nodes
+on its host, when it starts, if they aren't stored already. Changes to totals
+which aren't stored are not recorded, and readers compute those totals on the
+fly. All the totals can be recomputed with `refresh` (`alpenhorn status
+--refresh`) if they drift, e.g. after the copy table is changed by hand.
+"""
+
+# === Start Python 2/3 compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+from future.builtins import *  # noqa  pylint: disable=W0401, W0614
+from future.builtins.disabled import *  # noqa  pylint: disable=W0401, W0614
+
+# === End Python 2/3 compatibility
+
+import datetime
+
+import peewee as pw
+from peewee import fn
+
+import chimedb.core as db
+import chimedb.data_index as di
+
+# Setup the logging
+from . import logger
+
+log = logger.get_log()
+
+
+class NodeStats(pw.Model):
+    """The totals for a node, or for the whole archive.
+
+    Attributes
+    ----------
+    scope : string
+        What the totals are of: "node:<id>" for a node, or "archive" for all
+        files in the archive. Each has at most one row.
+    node : foreign key
+        The node, or NULL for the totals of the archive.
+    files : integer
+        The number of file copies present on the node.
+    bytes : integer
+        The total size of those copies.
+    refreshed : datetime
+        When the totals were last computed in full.
+    """
+
+    scope = pw.CharField(max_length=32, unique=True)
+    node = pw.ForeignKeyField(di.StorageNode, null=True)
+    files = pw.BigIntegerField(default=0)
+    bytes = pw.BigIntegerField(default=0)
+    refreshed = pw.DateTimeField()
+
+    class Meta:
+        database = db.proxy
+        table_name = "alpenhorn_node_stats"
+
+
+# Whether the table exists, once checked
+_have_table = None
+
+
+def table_exists():
+    """Whether the stats table exists. Only checked the first time."""
+    global _have_table
+
+    if _have_table is None:
+        _have_table = NodeStats.table_exists()
+    return _have_table
+
+
+def _scope(node):
+    """The scope of the totals of `node` (a node, node id, or None)."""
+    if node is None:
+        return "archive"
+    return "node:%i" % getattr(node, "id", node)
+
+
+def _aggregate(node_ids=None, archive=True):
+    """Compute the totals of the given nodes, and of the archive, in full.
+
+    Returns a dict of (files, bytes) keyed by node id, with None for the
+    archive if `archive` is set. Nodes without any copies aren't included.
+    """
+    totals = {}
+
+    if node_ids is None or node_ids:
+        query = (
+            di.ArchiveFileCopy.select(
+                di.ArchiveFileCopy.node,
+                fn.COUNT(di.ArchiveFileCopy.id),
+                fn.SUM(di.ArchiveFile.size_b),
+            )
+            .join(di.ArchiveFile)
+            .where(di.ArchiveFileCopy.has_file == "Y")
+            .group_by(di.ArchiveFileCopy.node)
+        )
+        if node_ids is not None:
+            query = query.where(di.ArchiveFileCopy.node << list(node_ids))
+
+        for node_id, files, size in query.tuples():
+            totals[node_id] = (int(files), int(size or 0))
+
+    if archive:
+        files, size = di.ArchiveFile.select(
+            fn.COUNT(di.ArchiveFile.id), fn.SUM(di.ArchiveFile.size_b)
+        ).scalar(as_tuple=True)
+        totals[None] = (int(files), int(size or 0))
+
+    return totals
+
+
+def _store(totals, replace=True):
+    """Store the totals in `totals`.
+
+    Stored totals already there are replaced if `replace` is set, and kept
+    otherwise. Either way, each row is written by a single statement, so
+    there is never more than one row for a node.
+    """
+    now = datetime.datetime.now()
+    rows = [
+        dict(
+            scope=_scope(node_id),
+            node=node_id,
+            files=files,
+            bytes=size,
+            refreshed=now,
+        )
+        for node_id, (files, size) in totals.items()
+    ]
+    if not rows:
+        return
+
+    if replace:
+        NodeStats.replace_many(rows).execute()
+    else:
+        NodeStats.insert_many(rows).on_conflict_ignore().execute()
+
+
+def refresh():
+    """Recompute the totals of every node, and of the archive, in full.
+
+    Needs write access to the database. Does nothing if the stats table
+    hasn't been created.
+    """
+    if not table_exists():
+        log.warning(
+            "Can't refresh the file totals: table %s doesn't exist."
+            % NodeStats._meta.table_name
+        )
+        return
+
+    node_ids = [
+        node_id for (node_id,) in di.StorageNode.select(di.StorageNode.id).tuples()
+    ]
+    # Aggregate and store in one transaction, so the totals stored are those
+    # of a single snapshot of the copies
+    with db.proxy.atomic():
+        totals = _aggregate()
+        for node_id in node_ids:
+            totals.setdefault(node_id, (0, 0))
+
+        _store(totals)
+    log.info("Refreshed the file totals of %i nodes." % len(node_ids))
+
+
+def totals(node_ids, store=False):
+    """The number and total size of the file copies on some nodes.
+
+    Parameters
+    ----------
+    node_ids : list
+        The ids of the nodes. Include None to also get the totals of the
+        whole archive.
+    store : bool, optional
+        Whether to store the totals of any nodes which have to be computed in
+        full, so they are maintained from then on. Needs write access, and
+        does nothing if the stats table hasn't been created.
+
+    Returns
+    -------
+    totals : dict
+        Pairs of (files, bytes), keyed by node id.
+    """
+    node_ids = set(node_ids)
+    result = {}
+
+    if table_exists():
+        query = NodeStats.select(
+            NodeStats.node, NodeStats.files, NodeStats.bytes
+        ).where(NodeStats.scope << [_scope(i) for i in node_ids])
+
+        for node_id, files, size in query.tuples():
+            result[node_id] = (files, size)
+
+    missing = node_ids - set(result)
+    if missing:
+        # Aggregate and store in one transaction, as in refresh()
+        with db.proxy.atomic():
+            computed = _aggregate(missing - {None}, archive=None in missing)
+            computed = dict((i, computed.get(i, (0, 0))) for i in missing)
+            result.update(computed)
+
+            if store and table_exists():
+                # If another process stored them first, keep theirs
+                _store(computed, replace=False)
+
+    return result
+
+
+def node_totals(node, store=False):
+    """The number and total size of the file copies on `node`.
+
+    Returns
+    -------
+    files : int
+    bytes : int
+    """
+    return totals([node.id], store=store)[node.id]
+
+
+def add(node, files, size):
+    """Adjust the stored totals for file copies added to (or removed from) a node.
+
+    Parameters
+    ----------
+    node : di.StorageNode or int
+        The node, or None to adjust the totals of the whole archive for files
+        added to it.
+    files : int
+        The number of copies added. Negative if they were removed.
+    size : int
+        Their total size.
+    """
+    if not files or not table_exists():
+        return
+
+    NodeStats.update(files=NodeStats.files + files, bytes=NodeStats.bytes + size).where(
+        NodeStats.scope == _scope(node)
+    ).execute()
+
+
+def _for_update(query):
+    """Lock the rows selected by `query`, if the database can."""
+    if db.proxy.for_update:
+        query = query.for_update()
+    return query
+
+
+def update_copies(condition, has_file, **fields):
+    """Set the `has_file` state of file copies, adjusting the stored totals.
+
+    Parameters
+    ----------
+    condition : peewee.Expression
+        Selects the copies to update, e.g. `di.ArchiveFileCopy.id << ids`.
+    has_file : string
+        The new state of the copies.
+    **fields
+        Any other fields of the copies to set.
+
+    Returns
+    -------
+    nupdated : int
+        The number of rows the update reports as changed.
+    """
+    with db.proxy.atomic():
+        # Only copies going into or out of the present state change the totals.
+        # The copies are locked until the update is committed, so that another
+        # process changing them at the same time can't count them too.
+        changes = {}
+        if table_exists():
+            copies = (
+                di.ArchiveFileCopy.select(
+                    di.ArchiveFileCopy.node,
+                    di.ArchiveFileCopy.has_file,
+                    di.ArchiveFile.size_b,
+                )
+                .join(di.ArchiveFile)
+                .where(condition)
+            )
+            for node_id, old_has_file, size in _for_update(copies).tuples():
+                if (old_has_file == "Y") != (has_file == "Y"):
+                    files, total = changes.get(node_id, (0, 0))
+                    changes[node_id] = (files + 1, total + (size or 0))
+
+        nupdated = (
+            di.ArchiveFileCopy.update(has_file=has_file, **fields)
+            .where(condition)
+            .execute()
+        )
+
+        sign = 1 if has_file == "Y" else -1
+        for node_id, (files, size) in changes.items():
+            add(node_id, sign * files, sign * size)
+
+    return nupdated
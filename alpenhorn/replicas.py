@@ -0,0 +1,111 @@
+"""Query expressions for questions about where the copies of files are.
+
+Questions such as "is this file on node X", "is it anywhere in group Y" or
+"how many archive copies does it have" are asked as subqueries correlated with
+the file of each row of the outer query. Used in a WHERE clause as EXISTS,
+they can be answered with an index lookup per row, rather than by building
+the set of files matching the subquery, which the database may materialize
+as a huge IN list.
+
+For example, the copies on node `node` of files which are not on any node in
+group `group` are::
+
+    di.ArchiveFileCopy.select().where(
+        di.ArchiveFileCopy.node == node,
+        di.ArchiveFileCopy.has_file == "Y",
+        ~replicas.copy_exists(di.ArchiveFileCopy.file, group=group),
+    )
+"""
+
+# === Start Python 2/3 compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+from future.builtins import *  # noqa  pylint: disable=W0401, W0614
+from future.builtins.disabled import *  # noqa  pylint: disable=W0401, W0614
+
+# === End Python 2/3 compatibility
+
+from peewee import fn
+
+import chimedb.data_index as di
+
+
+def _copies(
+    column,
+    file,
+    node=None,
+    group=None,
+    storage_type=None,
+    exclude_node=None,
+    exclude_copy=None,
+    has_file="Y",
+):
+    """Select `column` of the copies of `file` matching the conditions given.
+
+    `column` is called with the aliased copy table to make the column.
+    """
+    copy = di.ArchiveFileCopy.alias()
+    query = copy.select(column(copy)).where(copy.file == file)
+
+    if has_file is not None:
+        query = query.where(copy.has_file == has_file)
+    if node is not None:
+        query = query.where(copy.node == node)
+    if exclude_node is not None:
+        query = query.where(copy.node != exclude_node)
+    if exclude_copy is not None:
+        query = query.where(copy.id != exclude_copy)
+
+    # Only join onto the nodes when they are needed
+    if group is not None or storage_type is not None:
+        copy_node = di.StorageNode.alias()
+        query = query.join(copy_node, on=(copy.node == copy_node.id))
+        if group is not None:
+            query = query.where(copy_node.group == group)
+        if storage_type is not None:
+            query = query.where(copy_node.storage_type == storage_type)
+
+    return query
+
+
+def copy_exists(file, **kwargs):
+    """An expression which is true if there is a copy of `file`.
+
+    Parameters
+    ----------
+    file : peewee.Field or int
+        The file, usually a column of the outer query (e.g.
+        `di.ArchiveFileCopy.file` or `di.ArchiveFileCopyRequest.file`).
+    node : di.StorageNode or peewee.Field, optional
+        Only consider copies on this node.
+    group : di.StorageGroup or peewee.Field, optional
+        Only consider copies on nodes in this group.
+    storage_type : string, optional
+        Only consider copies on nodes of this type (e.g. "A" for archive).
+    exclude_node : di.StorageNode or peewee.Field, optional
+        Ignore copies on this node.
+    exclude_copy : di.ArchiveFileCopy or peewee.Field, optional
+        Ignore this copy, usually the copy of the outer query.
+    has_file : string, optional
+        Only consider copies with this `has_file` state. Defaults to "Y". If
+        None, copies in any state are considered.
+
+    Returns
+    -------
+    expr : peewee.Expression
+        An EXISTS expression.
+    """
+    return fn.EXISTS(_copies(lambda copy: copy.id, file, **kwargs))
+
+
+def copy_count(file, **kwargs):
+    """A subquery counting the copies of `file`.
+
+    This takes the same parameters as `copy_exists`. The subquery can be
+    selected, or compared against a number.
+
+    Returns
+    -------
+    query : peewee.Select
+        A subquery giving the number of copies.
+    """
+    return _copies(lambda copy: fn.COUNT(copy.id), file, **kwargs)
@@ -0,0 +1,144 @@
+"""Scheduling of the stages of the node updates made by the main loop."""
+
+# === Start Python 2/3 compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+from future.builtins import *  # noqa  pylint: disable=W0401, W0614
+from future.builtins.disabled import *  # noqa  pylint: disable=W0401, W0614
+
+# === End Python 2/3 compatibility
+
+import threading
+import time
+
+# Seconds between runs of each stage of a node update
+STAGE_CADENCE = {
+    "free_space": 60,
+    "integrity": 300,
+    "delete": 120,
+    "requests": 60,
+    "hpss": 60,
+}
+
+# Number of runs in a row a stage may find nothing to do before it backs off,
+# and the maximum factor by which its cadence is then stretched.
+IDLE_RUNS = 3
+MAX_BACKOFF = 8
+
+
+class NodeSchedule(object):
+    """When each stage of the update of each node is next due.
+
+    A stage which did some work is run again straight away, as there may be
+    more to do. One which found nothing to do for more than `idle_runs` runs
+    in a row has its cadence doubled each further run, up to `max_backoff`
+    times. Stages can be woken early when something happens which may have
+    given them work. This is safe to use from concurrent node workers.
+
+    Parameters
+    ----------
+    cadence : dict
+        Seconds between runs of each stage, keyed by stage name.
+    idle_runs : int
+        Number of idle runs before a stage backs off.
+    max_backoff : int
+        The maximum factor by which the cadence of an idle stage is stretched.
+    """
+
+    def __init__(self, cadence, idle_runs=IDLE_RUNS, max_backoff=MAX_BACKOFF):
+        self.cadence = dict(cadence)
+        self.idle_runs = idle_runs
+        self.max_backoff = max_backoff
+
+        self._cond = threading.Condition()
+        self._woken = False
+
+        # Time each stage is next due, and the number of idle runs in a row,
+        # keyed by (node id, stage). Stages which haven't run yet are due.
+        self._next = {}
+        self._idle = {}
+
+    def retain(self, node_ids):
+        """Forget the schedule of any node not in `node_ids`."""
+        node_ids = set(node_ids)
+        with self._cond:
+            for key in list(self._next):
+                if key[0] not in node_ids:
+                    del self._next[key]
+                    self._idle.pop(key, None)
+
+    def due(self, node_id):
+        """The stages of the update of node `node_id` which are due now."""
+        now = time.time()
+        with self._cond:
+            return [
+                stage
+                for stage in self.cadence
+                if self._next.get((node_id, stage), 0) <= now
+            ]
+
+    def done(self, node_id, stage, work=None):
+        """Record that `stage` has run on node `node_id`.
+
+        Parameters
+        ----------
+        work : int or bool, optional
+            The amount of work the stage did. If it did any, it is due again
+            now; if it did none, it may back off. If None, the stage just
+            runs at its cadence.
+        """
+        now = time.time()
+        key = (node_id, stage)
+        with self._cond:
+            if work is None:
+                self._idle[key] = 0
+                self._next[key] = now + self.cadence[stage]
+            elif work:
+                self._idle[key] = 0
+                self._next[key] = now
+            else:
+                self._idle[key] = self._idle.get(key, 0) + 1
+                factor = 2 ** max(self._idle[key] - self.idle_runs, 0)
+                self._next[key] = now + self.cadence[stage] * min(
+                    factor, self.max_backoff
+                )
+
+    def wake(self, stages=None, node_id=None):
+        """Make stages due now, and wake up the main loop if it is waiting.
+
+        Parameters
+        ----------
+        stages : list, optional
+            The stages to wake. If not given, wake all of them.
+        node_id : int, optional
+            Only wake the stages of this node.
+        """
+        with self._cond:
+            for key in self._next:
+                if (stages is None or key[1] in stages) and (
+                    node_id is None or key[0] == node_id
+                ):
+                    self._next[key] = 0
+                    self._idle[key] = 0
+            self._woken = True
+            self._cond.notify_all()
+
+    def wait(self, timeout):
+        """Wait until a stage is due, or the schedule is woken.
+
+        Parameters
+        ----------
+        timeout : float
+            The maximum number of seconds to wait.
+        """
+        with self._cond:
+            if not self._woken:
+                until = time.time() + timeout
+                if self._next:
+                    until = min(until, min(self._next.values()))
+                while not self._woken and time.time() < until:
+                    self._cond.wait(until - time.time())
+            self._woken = False
+
+
+# The schedule of the updates of the nodes on this host
+node_schedule = NodeSchedule(STAGE_CADENCE)
@@ -16,7 +16,7 @@ import click
 from alpenhorn import logger
 import chimedb.core as db
 import chimedb.data_index as di
-from alpenhorn import update, auto_import
+from alpenhorn import update, auto_import, metrics, nodestats
 
 log = logger.get_log()
 
@@ -39,6 +39,11 @@ def cli():
     # We need write access to the DB.
     db.connect(read_write=True)
 
+    # Serve the metrics, and time the DB queries made
+    if metrics.METRICS_PORT is not None:
+        metrics.instrument_db(db.proxy.obj)
+        metrics.start_http_server(metrics.METRICS_PORT)
+
     # Get the name of this host
     host = socket.gethostname().split(".")[0]
 
@@ -55,6 +60,17 @@ def cli():
     if len(node_list) == 0:
         log.warn('No nodes on this host ("%s") registered in the DB!' % host)
 
+    # Store the totals of the archive, and of the nodes here, if they aren't
+    # already, so that the files added from now on are counted in them.
+    # Without the table of node totals, they are aggregated every time.
+    if nodestats.table_exists():
+        nodestats.totals([None] + [node.id for node in node_list], store=True)
+    else:
+        log.warning(
+            "The table of node totals doesn't exist. Node sizes will be "
+            "computed in full each time they are needed."
+        )
+
     # Load the cache of already imported files
     auto_import.load_import_cache()
 
@@ -0,0 +1,251 @@
+"""Persistent, multiplexed SSH connections to remote hosts."""
+
+# === Start Python 2/3 compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+from future.builtins import *  # noqa  pylint: disable=W0401, W0614
+from future.builtins.disabled import *  # noqa  pylint: disable=W0401, W0614
+
+# === End Python 2/3 compatibility
+
+import atexit
+import os
+import re
+import subprocess
+import tempfile
+import threading
+import time
+
+# Setup the logging
+from . import logger
+
+log = logger.get_log()
+
+# Directory holding the control sockets of the master connections. If not set,
+# a temporary directory is used.
+if "ALPENHORN_SSH_CONTROL_DIR" in os.environ:
+    SSH_CONTROL_DIR = os.environ["ALPENHORN_SSH_CONTROL_DIR"]
+else:
+    SSH_CONTROL_DIR = None
+
+# Whether to multiplex SSH connections over master connections at all
+SSH_MULTIPLEX = os.environ.get("ALPENHORN_SSH_MULTIPLEX", "1") not in ("", "0")
+
+# Seconds a master connection is kept open while unused
+SSH_PERSIST = 600
+
+# Seconds to wait for a master connection to be established, and before trying
+# again to connect to a host which failed
+SSH_CONNECT_TIMEOUT = 20
+SSH_RETRY_TIME = 300
+
+
+class SSHMaster(object):
+    """A master SSH connection to a remote host, shared by other connections.
+
+    Other connections to the host multiplex their sessions over the master
+    rather than each doing their own handshake. They are never made masters
+    themselves, so a transfer never ends up holding a connection open in the
+    background. If the master isn't running, they connect directly.
+
+    Parameters
+    ----------
+    destination : string
+        The host to connect to, optionally as "user@host".
+    control_dir : string
+        Directory in which to create the control socket.
+    ssh : string
+        The ssh executable.
+    persist : int
+        Seconds the master is kept open while unused.
+    """
+
+    def __init__(self, destination, control_dir, ssh="ssh", persist=SSH_PERSIST):
+        self.destination = destination
+        self.ssh = ssh
+        self.persist = persist
+
+        name = re.sub(r"[^A-Za-z0-9@._-]", "_", destination)
+        self.control_path = os.path.join(control_dir, name)
+
+        self._lock = threading.Lock()
+        self._failed_time = None
+
+    def options(self):
+        """Options for an ssh command to use the master connection."""
+        return ["-o", "ControlMaster=no", "-o", "ControlPath=%s" % self.control_path]
+
+    def command(self):
+        """An ssh command for connecting to the host through the master."""
+        return [self.ssh, "-q"] + self.options()
+
+    def _control(self, op):
+        """Send the control command `op` to the master. Returns True on success."""
+        try:
+            ret = subprocess.call(
+                [self.ssh, "-q", "-O", op] + self.options() + [self.destination],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=SSH_CONNECT_TIMEOUT,
+            )
+        except subprocess.TimeoutExpired:
+            return False
+        return ret == 0
+
+    def check(self):
+        """Is the master connection running?"""
+        return os.path.exists(self.control_path) and self._control("check")
+
+    def start(self):
+        """Start the master connection, unless it is already running.
+
+        Returns
+        -------
+        healthy : bool
+            Whether the master is running.
+        """
+        with self._lock:
+            if self.check():
+                return True
+
+            # Don't hold up every transfer retrying a host we can't reach
+            if (
+                self._failed_time is not None
+                and time.time() - self._failed_time < SSH_RETRY_TIME
+            ):
+                return False
+
+            # Remove any stale socket left by a master which died
+            if os.path.exists(self.control_path):
+                os.remove(self.control_path)
+
+            log.debug("Starting SSH master connection to %s." % self.destination)
+
+            # With -f, ssh goes into the background once it has connected
+            try:
+                ret = subprocess.call(
+                    [
+                        self.ssh,
+                        "-q",
+                        "-f",
+                        "-N",
+                        "-o",
+                        "BatchMode=yes",
+                        "-o",
+                        "ConnectTimeout=%i" % SSH_CONNECT_TIMEOUT,
+                        "-o",
+                        "ControlMaster=yes",
+                        "-o",
+                        "ControlPersist=%i" % self.persist,
+                        "-o",
+                        "ControlPath=%s" % self.control_path,
+                        self.destination,
+                    ],
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    timeout=2 * SSH_CONNECT_TIMEOUT,
+                )
+            except subprocess.TimeoutExpired:
+                ret = -1
+
+            if ret == 0 and self.check():
+                self._failed_time = None
+                return True
+
+            log.warning(
+                "Could not start SSH master connection to %s. Connecting directly."
+                % self.destination
+            )
+            self._failed_time = time.time()
+            return False
+
+    def stop(self):
+        """Close the master connection, if it is running."""
+        with self._lock:
+            if os.path.exists(self.control_path):
+                self._control("exit")
+
+
+class SSHConnections(object):
+    """The master SSH connections to each remote host, started when needed.
+
+    This is safe to use from concurrent node workers.
+
+    Parameters
+    ----------
+    control_dir : string, optional
+        Directory for the control sockets. If not given, a temporary directory
+        is created.
+    ssh : string
+        The ssh executable. This can be replaced by a stand-in for testing.
+    enabled : bool
+        If False, connections are made directly rather than through masters.
+    """
+
+    def __init__(self, control_dir=None, ssh="ssh", enabled=True):
+        self.control_dir = control_dir
+        self.ssh = ssh
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._masters = {}
+
+    def _master(self, destination):
+        with self._lock:
+            if self.control_dir is None:
+                self.control_dir = tempfile.mkdtemp(prefix="alpenhorn-ssh-")
+            elif not os.path.isdir(self.control_dir):
+                os.makedirs(self.control_dir, 0o700)
+
+            if destination not in self._masters:
+                self._masters[destination] = SSHMaster(
+                    destination, self.control_dir, ssh=self.ssh
+                )
+
+            return self._masters[destination]
+
+    def command(self, destination):
+        """An ssh command for connecting to `destination`.
+
+        The command connects through the master connection to the host, which
+        is started if needed. If the master can't be started, the command
+        connects directly.
+
+        Returns
+        -------
+        cmd : list
+            The command, without the destination.
+        """
+        if self.enabled:
+            master = self._master(destination)
+            if master.start():
+                return master.command()
+
+        return [self.ssh, "-q"]
+
+    def health(self):
+        """Check the master connections.
+
+        Returns
+        -------
+        health : dict
+            Whether the master to each destination is running.
+        """
+        with self._lock:
+            masters = list(self._masters.values())
+
+        return dict((master.destination, master.check()) for master in masters)
+
+    def close(self):
+        """Close all the master connections."""
+        with self._lock:
+            masters = list(self._masters.values())
+
+        for master in masters:
+            master.stop()
+
+
+connections = SSHConnections(control_dir=SSH_CONTROL_DIR, enabled=SSH_MULTIPLEX)
+
+atexit.register(connections.close)
@@ -0,0 +1,217 @@
+"""Scheduling of concurrent file transfers onto nodes."""
+
+# === Start Python 2/3 compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+from future.builtins import *  # noqa  pylint: disable=W0401, W0614
+from future.builtins.disabled import *  # noqa  pylint: disable=W0401, W0614
+
+# === End Python 2/3 compatibility
+
+import subprocess
+import tempfile
+import threading
+import time
+
+# Setup the logging
+from . import logger
+
+log = logger.get_log()
+
+
+class Transfer(object):
+    """A transfer of a requested file onto a node.
+
+    A transfer either runs a command in a subprocess, or, when `cmd` is None,
+    has already been completed (e.g. by hard linking) with return code `ret`.
+
+    Parameters
+    ----------
+    req : di.ArchiveFileCopyRequest
+        The request being serviced.
+    node : di.StorageNode
+        The destination node.
+    cmd : list, optional
+        The command performing the transfer.
+    check : callable, optional
+        Called as `check(transfer)` once the command has exited to interpret its
+        output. It should set `ret`, `md5sum` and `check_source_on_err`.
+    ret : int, optional
+        Return code of an already completed transfer.
+    md5sum : string, optional
+        MD5 hash of the file written by an already completed transfer.
+    check_source_on_err : bool, optional
+        Whether a failure should mark the source copy as suspect.
+    """
+
+    def __init__(
+        self,
+        req,
+        node,
+        cmd=None,
+        check=None,
+        ret=None,
+        md5sum=None,
+        check_source_on_err=True,
+    ):
+        self.req = req
+        self.node = node
+        self.cmd = cmd
+        self.check = check
+
+        self.ret = ret
+        self.md5sum = md5sum
+        self.check_source_on_err = check_source_on_err
+        self.stdout = None
+        self.stderr = None
+
+        self.start_time = None
+        self.end_time = None
+
+        self._proc = None
+        self._stdout_fp = None
+        self._stderr_fp = None
+
+    @property
+    def file_id(self):
+        return self.req.file_id
+
+    @property
+    def host(self):
+        """The host the file is being transferred from."""
+        return self.req.node_from.host
+
+    @property
+    def size_b(self):
+        return self.req.file.size_b
+
+    def start(self):
+        """Start the transfer without waiting for it to finish."""
+        self.start_time = time.time()
+
+        if self.cmd is None:
+            self.end_time = self.start_time
+            return
+
+        # Capture the output in temporary files rather than pipes so that a
+        # chatty command can't block on a full pipe while we aren't reading it.
+        self._stdout_fp = tempfile.TemporaryFile()
+        self._stderr_fp = tempfile.TemporaryFile()
+        self._proc = subprocess.Popen(
+            self.cmd, stdout=self._stdout_fp, stderr=self._stderr_fp
+        )
+
+    def poll(self):
+        """Has the transfer finished? If so, collect its results."""
+        if self.end_time is not None:
+            return True
+
+        # Not started yet
+        if self.start_time is None:
+            return False
+
+        if self._proc.poll() is None:
+            return False
+
+        self.end_time = time.time()
+        self.ret = self._proc.returncode
+        self.stdout = self._read_output(self._stdout_fp)
+        self.stderr = self._read_output(self._stderr_fp)
+
+        if self.check is not None:
+            self.check(self)
+
+        return True
+
+    @staticmethod
+    def _read_output(fp):
+        fp.seek(0)
+        out = fp.read().decode(errors="replace")
+        fp.close()
+        return out
+
+
+class TransferScheduler(object):
+    """Run transfers concurrently, limited per destination node and source host.
+
+    The scheduler may be shared between threads updating different nodes.
+
+    Parameters
+    ----------
+    max_per_node : int
+        Maximum number of transfers running onto a single node.
+    max_per_host : int
+        Maximum number of transfers running from a single source host.
+    """
+
+    def __init__(self, max_per_node=1, max_per_host=1):
+        self.max_per_node = max_per_node
+        self.max_per_host = max_per_host
+
+        self._lock = threading.Lock()
+        self._running = []
+
+    def reserve(self, req, node):
+        """Reserve a slot for transferring the file requested by `req` onto `node`.
+
+        The slot counts against the limits until it is passed to `start` with
+        the transfer to run in it, or given back with `release`.
+
+        Returns
+        -------
+        slot : Transfer
+            A placeholder holding the slot, or None if the node or source host
+            has no free slot.
+        """
+        slot = Transfer(req, node)
+        with self._lock:
+            n_node = sum(1 for t in self._running if t.node.id == node.id)
+            n_host = sum(1 for t in self._running if t.host == slot.host)
+
+            if n_node >= self.max_per_node or n_host >= self.max_per_host:
+                return None
+
+            self._running.append(slot)
+
+        return slot
+
+    def start(self, slot, transfer):
+        """Start `transfer` in the slot reserved by `reserve`."""
+        with self._lock:
+            self._running.remove(slot)
+            transfer.start()
+            self._running.append(transfer)
+
+    def release(self, slot):
+        """Give back a slot reserved by `reserve` without using it."""
+        with self._lock:
+            self._running.remove(slot)
+
+    def poll(self, node):
+        """Return the transfers onto `node` which have finished since last polled."""
+        with self._lock:
+            running = [t for t in self._running if t.node.id == node.id]
+
+        finished = [t for t in running if t.poll()]
+
+        with self._lock:
+            for t in finished:
+                self._running.remove(t)
+
+        return finished
+
+    def running(self, node=None):
+        """Number of transfers in progress (onto `node`, if given)."""
+        with self._lock:
+            return sum(1 for t in self._running if node is None or t.node.id == node.id)
+
+    def in_flight(self, file_id, node):
+        """Is the file with id `file_id` currently being transferred onto `node`?"""
+        with self._lock:
+            return any(
+                t.file_id == file_id and t.node.id == node.id for t in self._running
+            )
+
+    def bytes_in_flight(self, node):
+        """Total size of the files currently being transferred onto `node`."""
+        with self._lock:
+            return sum(t.size_b for t in self._running if t.node.id == node.id)
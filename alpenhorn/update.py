@@ -12,7 +12,9 @@ import time
 import datetime
 import re
 import socket
-import glob
+import fnmatch
+import threading
+from concurrent import futures
 
 import peewee as pw
 from peewee import fn
@@ -20,6 +22,17 @@ from peewee import fn
 import chimedb.core as db
 import chimedb.data_index as di
 
+from . import (
+    hashing,
+    hpss_callback,
+    metrics,
+    nodestats,
+    replicas,
+    schedule,
+    ssh,
+    transfer,
+)
+
 # Setup the logging
 from . import logger
 
@@ -27,7 +40,10 @@ log = logger.get_log()
 
 # Parameters.
 max_time_per_node_operation = 300  # Don't let node operations hog time.
-min_loop_time = 60  # Main loop at most every 60 seconds.
+min_loop_time = 60  # Host-wide checks (SSH, batch queue) at most every 60 seconds.
+wake_poll_time = 10  # Check for new requests and HPSS callbacks every 10 seconds.
+delete_batch_size = 500  # Number of file copies removed per DB update.
+integrity_batch_size = 25  # Number of suspect file copies checked per DB update.
 
 RSYNC_OPTS = [
     "--quiet",
@@ -40,8 +56,37 @@ RSYNC_OPTS = [
     "--sparse",
 ]
 
-# Globals.
-done_transport_this_cycle = False
+# Maximum number of concurrent transfers onto each node, and from each source
+# host. The defaults of one perform a single transfer at a time.
+if "ALPENHORN_TRANSFERS_PER_NODE" in os.environ:
+    max_transfers_per_node = int(os.environ["ALPENHORN_TRANSFERS_PER_NODE"])
+else:
+    max_transfers_per_node = 1
+
+if "ALPENHORN_TRANSFERS_PER_HOST" in os.environ:
+    max_transfers_per_host = int(os.environ["ALPENHORN_TRANSFERS_PER_HOST"])
+else:
+    max_transfers_per_host = 1
+
+# Number of threads checking the integrity of files, and the maximum combined
+# rate at which they read (in MB/s; zero for no limit). The rate limit prevents
+# integrity checks from starving transfers of disk bandwidth.
+if "ALPENHORN_INTEGRITY_WORKERS" in os.environ:
+    integrity_workers = int(os.environ["ALPENHORN_INTEGRITY_WORKERS"])
+else:
+    integrity_workers = 1
+
+if "ALPENHORN_INTEGRITY_RATE" in os.environ:
+    integrity_rate = float(os.environ["ALPENHORN_INTEGRITY_RATE"])
+else:
+    integrity_rate = 0.0
+
+# Number of nodes to update concurrently, each on its own worker thread. The
+# default of one updates the nodes serially from the main loop.
+if "ALPENHORN_NODE_WORKERS" in os.environ:
+    max_node_workers = int(os.environ["ALPENHORN_NODE_WORKERS"])
+else:
+    max_node_workers = 1
 
 # The path used for HPSS scripts and callbacks
 if "ALPENHORN_HPSS_SCRIPT_DIR" in os.environ:
@@ -49,6 +94,22 @@ if "ALPENHORN_HPSS_SCRIPT_DIR" in os.environ:
 else:
     HPSS_SCRIPT_DIR = None
 
+# Number of HPSS jobs to keep waiting in the queue to push files into, and
+# pull files out of, HPSS. Jobs which have started running aren't counted.
+if "ALPENHORN_HPSS_PUSH_JOBS" in os.environ:
+    hpss_push_jobs = int(os.environ["ALPENHORN_HPSS_PUSH_JOBS"])
+else:
+    hpss_push_jobs = 1
+
+if "ALPENHORN_HPSS_PULL_JOBS" in os.environ:
+    hpss_pull_jobs = int(os.environ["ALPENHORN_HPSS_PULL_JOBS"])
+else:
+    hpss_pull_jobs = 2
+
+# Whether each HPSS job transfers all its files in a few hsi sessions, rather
+# than starting hsi for every step of every file.
+hpss_batch_hsi = os.environ.get("ALPENHORN_HPSS_BATCH_HSI", "") not in ("", "0")
+
 
 def run_command(cmd, **kwargs):
     """Run a command.
@@ -112,45 +173,200 @@ def pbs_jobs():
     return [_parse_job(node) for node in qstat_xml.firstChild.childNodes]
 
 
+# The fields fetched from squeue, and the names of their columns in the full
+# output
+SQUEUE_FIELDS = [("%i", "JOBID"), ("%t", "ST"), ("%P", "PARTITION"), ("%j", "NAME")]
+
+
 def slurm_jobs():
     """Fetch the jobs in the slurm queue on this host.
 
+    Only the fields in `SQUEUE_FIELDS` are fetched.
+
     Returns
     -------
     jobs : dict
+        The jobs, or None if the queue couldn't be queried.
     """
 
     import getpass
 
     user = getpass.getuser()
 
-    ret, out, err = run_command(["squeue", "-o", "%all", "-u", user])
-    lines = out.split("\n")
-    headers = lines[0].split("|")
+    fmt = "|".join(field for field, name in SQUEUE_FIELDS)
+    names = [name for field, name in SQUEUE_FIELDS]
+
+    ret, out, err = run_command(["squeue", "-h", "-o", fmt, "-u", user])
+
+    if ret != 0:
+        log.warning("Could not query the slurm queue: %s" % err.strip())
+        return None
 
     jobs = []
 
-    for line in lines[1:-1]:
-        job = dict(list(zip(headers, line.split("|"))))
-        jobs.append(job)
+    for line in out.splitlines():
+        if line:
+            jobs.append(dict(zip(names, line.split("|"))))
 
     return jobs
 
 
-def queued_archive_jobs():
-    """Fetch the info about jobs waiting in the archive queue.
+class SchedulerState(object):
+    """The cached state of the batch queue, and the jobs we have submitted.
 
-    Returns
-    -------
-    jobs: dict
+    The queue is only queried again once the cached state is older than `ttl`
+    seconds, or a job has been submitted. If a query fails, the state found by
+    the last one which succeeded is kept, and `known` is False until the queue
+    can be queried again. This is safe to use from concurrent node workers.
+
+    Parameters
+    ----------
+    query : callable
+        Returns the jobs in the queue, or None if it can't be queried, as
+        `slurm_jobs` does.
+    ttl : float
+        Number of seconds for which the state of the queue is cached. Submitted
+        jobs are tracked for at least this long, even if they don't show up in
+        the queue.
+
+    Attributes
+    ----------
+    known : bool
+        Whether the last query of the queue succeeded.
     """
 
-    jobs = slurm_jobs()
+    def __init__(self, query, ttl):
+        self.query = query
+        self.ttl = ttl
+        self.known = False
+
+        self._lock = threading.Lock()
+        self._jobs = []
+        self._time = None
+        self._submitted = {}
+
+    def jobs(self):
+        """The jobs in the queue, as of the last query which succeeded."""
+        with self._lock:
+            now = time.time()
+            if self._time is None or now - self._time > self.ttl:
+                jobs = self.query()
+                self._time = now
+                self.known = jobs is not None
+
+                if self.known:
+                    self._jobs = jobs
+
+                    # Stop tracking submitted jobs which have left the queue,
+                    # giving new ones time to show up in it
+                    queued = set(job["JOBID"] for job in jobs)
+                    for job_id, (kind, submit_time) in list(self._submitted.items()):
+                        if job_id not in queued and submit_time < now - self.ttl:
+                            del self._submitted[job_id]
+
+            return self._jobs
+
+    def invalidate(self):
+        """Query the queue again the next time it is needed."""
+        with self._lock:
+            self._time = None
+
+    def submitted(self, job_id, kind):
+        """Track the job `job_id`, of type `kind`, which has just been submitted."""
+        with self._lock:
+            self._submitted[job_id] = (kind, time.time())
+            self._time = None
+
+    def in_flight(self, kind=None):
+        """The IDs of the submitted jobs (of type `kind`, if given) still queued."""
+        self.jobs()
+        with self._lock:
+            return sorted(
+                job_id
+                for job_id, (job_kind, submit_time) in self._submitted.items()
+                if kind is None or job_kind == kind
+            )
 
-    # return [ job for job in jobs if (job['job_state'] == 'Q' and job['queue'] == 'archivelong')]
-    return [
-        job for job in jobs if (job["ST"] == "PD" and job["PARTITION"] == "archivelong")
-    ]
+
+# The state of the queue running HPSS jobs, refreshed at most once a minute
+hpss_queue = SchedulerState(slurm_jobs, ttl=min_loop_time)
+
+
+class TransportCycle(object):
+    """Track which transport node is allowed to take transfers this cycle.
+
+    Only one transport disk should be filled at a time. The first transport
+    node to start a transfer in a cycle claims it; other transport nodes are
+    skipped until the next cycle. A claim which doesn't lead to a successful
+    transfer is released so that another transport node may try. This is safe
+    to use from concurrent node workers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._node_id = None
+        self._done = False
+
+    def reset(self):
+        """Start a new cycle with no transport node chosen."""
+        with self._lock:
+            self._node_id = None
+            self._done = False
+
+    def available(self, node):
+        """Can transfers onto `node` proceed this cycle?"""
+        with self._lock:
+            return self._node_id is None or self._node_id == node.id
+
+    def claim(self, node):
+        """Try to claim this cycle for `node`. Returns True on success."""
+        with self._lock:
+            if self._node_id is None:
+                self._node_id = node.id
+            return self._node_id == node.id
+
+    def complete(self, node):
+        """Record that `node` has completed a transfer this cycle."""
+        with self._lock:
+            if self._node_id == node.id:
+                self._done = True
+
+    def release(self, node):
+        """Release the claim held by `node` if it transferred nothing."""
+        with self._lock:
+            if self._node_id == node.id and not self._done:
+                self._node_id = None
+
+
+transport_cycle = TransportCycle()
+
+# Scheduler for the transfers onto all nodes on this host
+transfer_scheduler = transfer.TransferScheduler(
+    max_per_node=max_transfers_per_node, max_per_host=max_transfers_per_host
+)
+
+# Limits the rate of integrity checks
+integrity_limiter = hashing.RateLimiter(integrity_rate * 2**20)
+
+# Locks ensuring a node is never updated by two workers at once, keyed by node
+# id, and the lock protecting the dict itself.
+_node_locks = {}
+_node_locks_lock = threading.Lock()
+
+# Thread pool used to update nodes concurrently (created on first use)
+_node_pool = None
+
+# When each stage of the update of each node is next due
+node_schedule = schedule.node_schedule
+
+# The latest request seen by `_new_requests`
+_last_request_id = None
+
+
+def _node_lock(node):
+    """Get the update lock for `node`."""
+    with _node_locks_lock:
+        return _node_locks.setdefault(node.id, threading.Lock())
 
 
 def is_md5_hash(h):
@@ -166,27 +382,102 @@ def command_available(cmd):
 
 
 def update_loop(host):
-    """Loop over nodes performing any updates needed."""
-    global done_transport_this_cycle
+    """Loop over nodes performing any updates needed.
+
+    Each stage of the update of each node runs to its own schedule (see
+    `schedule.NodeSchedule`). Between passes the loop waits for the next stage
+    to become due, checking every `wake_poll_time` seconds for new requests
+    and HPSS callbacks, which make the stages they concern due straight away.
+    """
+
+    last_check_time = None
 
     while True:
         loop_start = time.time()
-        done_transport_this_cycle = False
+        transport_cycle.reset()
+
+        # Deal with the HPSS callback hack. Finished jobs leave room for more.
+        if run_hpss_callbacks_from_file():
+            node_schedule.wake(["hpss"])
+
+        # New requests may give the transfer stages something to do
+        if _new_requests():
+            node_schedule.wake(["requests", "hpss"])
+
+        # Check the persistent SSH connections. Any which are down are started
+        # again when next used.
+        if last_check_time is None or loop_start - last_check_time > min_loop_time:
+            last_check_time = loop_start
+            for destination, healthy in ssh.connections.health().items():
+                if not healthy:
+                    log.warning("SSH master connection to %s is down." % destination)
+
+        # Fetch the nodes to update (perform a new query each time in case we
+        # get a new node, e.g. transport disk)
+        nodes = list(di.StorageNode.select().where(di.StorageNode.host == host))
+        node_schedule.retain([node.id for node in nodes])
+
+        # Find the stages due on each node
+        due = [(node, node_schedule.due(node.id)) for node in nodes]
+        due = [(node, stages) for node, stages in due if stages]
+
+        # Update the nodes, either concurrently or one after another
+        if due:
+            if max_node_workers > 1:
+                update_nodes_concurrently(due)
+            else:
+                for node, stages in due:
+                    update_node(node, stages)
+
+            loop_time = time.time() - loop_start
+            metrics.loop_seconds.observe(loop_time)
+            log.info("Main loop execution was %d sec." % loop_time)
+
+        # Wait until a stage is due, or something happens
+        node_schedule.wait(wake_poll_time)
+
+
+def update_nodes_concurrently(due):
+    """Update each node on a pool of up to `max_node_workers` threads.
 
-        # Deal with the HPSS callback hack
-        run_hpss_callbacks_from_file()
+    Node updates are dominated by subprocesses, filesystem access and DB
+    round-trips, so threads are sufficient to overlap them. Returns once every
+    node has been updated. The first exception raised by a node update, if
+    any, is re-raised here.
 
-        # Iterate over nodes and perform each update (perform a new query
-        # each time in case we get a new node, e.g. transport disk)
-        for node in di.StorageNode.select().where(di.StorageNode.host == host):
-            update_node(node)
+    Parameters
+    ----------
+    due : list
+        List of (node, stages) pairs, giving the stages to run on each node.
+    """
+    global _node_pool
+
+    if _node_pool is None:
+        _node_pool = futures.ThreadPoolExecutor(max_workers=max_node_workers)
 
-        # Check the time spent so far, and wait if needed
-        loop_time = time.time() - loop_start
-        log.info("Main loop execution was %d sec." % loop_time)
-        remaining = min_loop_time - loop_time
-        if remaining > 1:
-            time.sleep(remaining)
+    node_futures = [
+        _node_pool.submit(update_node, node, stages) for node, stages in due
+    ]
+
+    # Wait for every node to finish before reporting any errors so that we
+    # don't start the next cycle with updates still running
+    futures.wait(node_futures)
+    for future in node_futures:
+        future.result()
+
+
+def _new_requests():
+    """Have any transfer requests been made since this was last called?"""
+    global _last_request_id
+
+    last_id = (
+        di.ArchiveFileCopyRequest.select(fn.MAX(di.ArchiveFileCopyRequest.id)).scalar()
+        or 0
+    )
+
+    new = _last_request_id is not None and last_id > _last_request_id
+    _last_request_id = last_id
+    return new
 
 
 def update_node_free_space(node):
@@ -237,39 +528,111 @@ def update_node_free_space(node):
 
 
 def update_node_integrity(node):
-    """Check the integrity of file copies on the node."""
+    """Check the integrity of file copies on the node.
 
-    # Find suspect file copies in the database
-    fcopy_query = (
-        di.ArchiveFileCopy.select()
-        .where(di.ArchiveFileCopy.node == node, di.ArchiveFileCopy.has_file == "M")
-        .limit(25)
-    )
+    Suspect copies are hashed in batches on up to `integrity_workers` threads
+    until the time allowed for the node is used up. Returns the number of
+    copies checked.
+    """
 
-    # Loop over these file copies and check their md5sum
-    for fcopy in fcopy_query:
-        fullpath = "%s/%s/%s" % (node.root, fcopy.file.acq.name, fcopy.file.name)
-        log.info('Checking file "%s" on node "%s".' % (fullpath, node.name))
+    start_time = time.time()
+    last_id = 0
+    nchecked = 0
+
+    # Hash on one pool for the whole call, with totals kept for this node
+    # alone, as other nodes may be checked at the same time.
+    stats = hashing.HashStats()
+    with futures.ThreadPoolExecutor(max_workers=integrity_workers) as pool:
+        while time.time() - start_time < max_time_per_node_operation:
+            # Find the next batch of suspect file copies in the database
+            fcopies = list(
+                di.ArchiveFileCopy.select(
+                    di.ArchiveFileCopy.id,
+                    di.ArchiveAcq.name,
+                    di.ArchiveFile.name,
+                    di.ArchiveFile.md5sum,
+                    di.ArchiveFile.size_b,
+                )
+                .join(di.ArchiveFile)
+                .join(di.ArchiveAcq)
+                .where(
+                    di.ArchiveFileCopy.node == node,
+                    di.ArchiveFileCopy.has_file == "M",
+                    di.ArchiveFileCopy.id > last_id,
+                )
+                .order_by(di.ArchiveFileCopy.id)
+                .limit(integrity_batch_size)
+                .tuples()
+            )
 
-        # If the file exists calculate its md5sum and check against the DB
-        if os.path.exists(fullpath):
-            if di.util.md5sum_file(fullpath) == fcopy.file.md5sum:
-                log.info("File is A-OK!")
-                fcopy.has_file = "Y"
-            else:
-                log.error("File is corrupted!")
-                fcopy.has_file = "X"
-        else:
-            log.error("File does not exist!")
-            fcopy.has_file = "N"
+            if len(fcopies) == 0:
+                break
+            last_id = fcopies[-1][0]
+
+            copies = {
+                "%s/%s/%s" % (node.root, acq_name, file_name): (fc_id, md5sum, size_b)
+                for fc_id, acq_name, file_name, md5sum, size_b in fcopies
+            }
+
+            # The copies to set to each new has_file state
+            new_state = {"Y": [], "X": [], "N": []}
+
+            # Calculate the md5sum of each file which exists and check against the
+            # DB
+            for fullpath, md5sum in hashing.md5sum_files(
+                copies, integrity_workers, integrity_limiter, stats, pool
+            ):
+                fc_id, db_md5sum, size_b = copies[fullpath]
+                if md5sum is None:
+                    log.error(
+                        'File "%s" on node "%s" does not exist!' % (fullpath, node.name)
+                    )
+                    new_state["N"].append(fc_id)
+                    metrics.integrity_files.inc(node=node.name, result="missing")
+                elif md5sum == hashing.UNREADABLE:
+                    log.error(
+                        'File "%s" on node "%s" can\'t be read!' % (fullpath, node.name)
+                    )
+                    new_state["X"].append(fc_id)
+                    metrics.integrity_files.inc(node=node.name, result="unreadable")
+                elif md5sum == db_md5sum:
+                    log.info('File "%s" on node "%s" is A-OK!' % (fullpath, node.name))
+                    new_state["Y"].append(fc_id)
+                    metrics.integrity_files.inc(node=node.name, result="ok")
+                else:
+                    log.error(
+                        'File "%s" on node "%s" is corrupted!' % (fullpath, node.name)
+                    )
+                    new_state["X"].append(fc_id)
+                    metrics.integrity_files.inc(node=node.name, result="corrupt")
+
+                if md5sum not in (None, hashing.UNREADABLE):
+                    metrics.integrity_bytes.inc(size_b or 0, node=node.name)
+
+            # Update the copy statuses
+            for has_file, ids in new_state.items():
+                if len(ids) > 0:
+                    nodestats.update_copies(di.ArchiveFileCopy.id << ids, has_file)
+                    nchecked += len(ids)
+
+    metrics.integrity_seconds.inc(time.time() - start_time, node=node.name)
+
+    if stats.files > 0:
+        size_mb = stats.bytes / 2**20.0
+        check_time = time.time() - start_time
+        log.info(
+            'Checked %i files (%.1f MB) on node "%s" in %i seconds [%.1f MB/s]'
+            % (stats.files, size_mb, node.name, int(check_time), size_mb / check_time)
+        )
 
-        # Update the copy status
-        log.info("Updating file copy status [id=%i]." % fcopy.id)
-        fcopy.save()
+    return nchecked
 
 
 def update_node_delete(node):
-    """Process this node for files to delete."""
+    """Process this node for files to delete.
+
+    Returns the number of file copies removed.
+    """
 
     # If we are below the minimum available size, we should consider all files
     # not explicitly wanted (wants_file != 'Y') as candidates for deletion,
@@ -284,84 +647,136 @@ def update_node_delete(node):
     else:
         dfclause = di.ArchiveFileCopy.wants_file == "N"
 
-    # Search db for candidates on this node to delete.
-    del_files = di.ArchiveFileCopy.select().where(
-        dfclause, di.ArchiveFileCopy.node == node, di.ArchiveFileCopy.has_file == "Y"
-    )
+    start_time = time.time()
 
-    # Process candidates for deletion
-    del_count = 0  # Counter for no. of deletions (limits no. per node update)
-    for fcopy in del_files.order_by(di.ArchiveFileCopy.id):
-        # Limit number of deletions to 500 per main loop iteration.
-        if del_count >= 500:
-            break
-
-        # Get all the *other* copies.
-        other_copies = fcopy.file.copies.where(di.ArchiveFileCopy.id != fcopy.id)
-
-        # Get the number of copies on archive nodes
-        ncopies = (
-            other_copies.join(di.StorageNode)
-            .where(di.StorageNode.storage_type == "A")
-            .count()
+    # Search db for candidates on this node to delete, along with the number
+    # of *other* copies of each file on archive nodes.
+    archive_copies = replicas.copy_count(
+        di.ArchiveFileCopy.file,
+        storage_type="A",
+        exclude_copy=di.ArchiveFileCopy.id,
+        has_file=None,
+    )
+    del_files = (
+        di.ArchiveFileCopy.select(
+            di.ArchiveFileCopy.id,
+            di.ArchiveAcq.name,
+            di.ArchiveFile.name,
+            archive_copies,
         )
+        .join(di.ArchiveFile)
+        .join(di.ArchiveAcq)
+        .where(
+            dfclause,
+            di.ArchiveFileCopy.node == node,
+            di.ArchiveFileCopy.has_file == "Y",
+        )
+        .order_by(di.ArchiveFileCopy.id)
+        .tuples()
+    )
 
-        shortname = "%s/%s" % (fcopy.file.acq.name, fcopy.file.name)
-        fullpath = "%s/%s/%s" % (node.root, fcopy.file.acq.name, fcopy.file.name)
-
+    # Process candidates for deletion in batches
+    batch = []
+    nremoved = 0
+    for fc_id, acq_name, file_name, ncopies in del_files:
         # If at least two other copies we can delete the file.
         if ncopies >= 2:
-            # Use transaction such that errors thrown in the os.remove do not leave
-            # the database inconsistent.
-            with db.proxy.transaction():
-                if os.path.exists(fullpath):
-                    os.remove(fullpath)  # Remove the actual file
-
-                    # Check if the acquisition directory is now empty,
-                    # and remove if it is.
-                    dirname = os.path.dirname(fullpath)
-                    if not os.listdir(dirname):
-                        log.info(
-                            "Removing acquisition directory %s on %s"
-                            % (fcopy.file.acq.name, fcopy.node.name)
-                        )
-                        os.rmdir(dirname)
+            batch.append((fc_id, acq_name, file_name))
+        else:
+            log.info("Too few backups to delete %s/%s" % (acq_name, file_name))
 
-                fcopy.has_file = "N"
-                fcopy.wants_file = "N"  # Set in case it was 'M' before
-                fcopy.save()  # Update the FileCopy in the database
+        if len(batch) >= delete_batch_size:
+            nremoved += _delete_copies(node, batch)
+            batch = []
 
-                log.info("Removed file copy: %s" % shortname)
+            if time.time() - start_time > max_time_per_node_operation:
+                break  # Don't hog all the time.
 
-            del_count += 1
+    if len(batch) > 0:
+        nremoved += _delete_copies(node, batch)
+
+    return nremoved
 
-        else:
-            log.info("Too few backups to delete %s" % shortname)
+
+def _delete_copies(node, batch):
+    """Remove a batch of file copies from `node`.
+
+    Parameters
+    ----------
+    node : di.StorageNode
+        The node to delete from.
+    batch : list
+        List of (copy id, acquisition name, file name) tuples.
+
+    Returns
+    -------
+    nremoved : int
+        The number of copies removed.
+    """
+
+    removed_ids = []
+    removed_names = []
+    acq_names = set()
+
+    # Remove the actual files. Any which can't be removed are left marked as
+    # present in the database.
+    for fc_id, acq_name, file_name in batch:
+        fullpath = "%s/%s/%s" % (node.root, acq_name, file_name)
+        try:
+            if os.path.exists(fullpath):
+                os.remove(fullpath)
+                acq_names.add(acq_name)
+        except OSError as e:
+            log.error("Could not remove file %s: %s" % (fullpath, e))
+            continue
+
+        removed_ids.append(fc_id)
+        removed_names.append("%s/%s" % (acq_name, file_name))
+
+    # Update the FileCopys in the database. Set wants_file in case it was
+    # 'M' before.
+    if len(removed_ids) > 0:
+        nodestats.update_copies(
+            di.ArchiveFileCopy.id << removed_ids, "N", wants_file="N"
+        )
+
+    for shortname in removed_names:
+        log.info("Removed file copy: %s" % shortname)
+
+    # Check if the acquisition directories are now empty, and remove them if
+    # they are.
+    for acq_name in sorted(acq_names):
+        dirname = "%s/%s" % (node.root, acq_name)
+        if os.path.isdir(dirname) and not os.listdir(dirname):
+            log.info("Removing acquisition directory %s on %s" % (acq_name, node.name))
+            os.rmdir(dirname)
+
+    return len(removed_ids)
 
 
 def update_node_requests(node):
-    """Process file copy requests onto this node."""
+    """Process file copy requests onto this node.
 
-    global done_transport_this_cycle
+    Transfers are left running when the pass ends, and dealt with by a later
+    pass once they finish. Returns the number of transfers which succeeded.
+    """
 
     # Ensure we are not on an HPSS node
     if is_hpss_node(node):
         log.error("Cannot process HPSS node here.")
-        return
+        return 0
+
+    # Deal with any transfers started by earlier passes which have finished
+    ncompleted = _finish_transfers(node)
 
     # Skip if node is too full
     if node.avail_gb < (node.min_avail_gb + 10):
         log.info("Node %s is nearly full. Skip transfers." % node.name)
-        return
+        return ncompleted
 
-    # Calculate the total archive size from the database
-    size_query = (
-        di.ArchiveFile.select(fn.Sum(di.ArchiveFile.size_b))
-        .join(di.ArchiveFileCopy)
-        .where(di.ArchiveFileCopy.node == node, di.ArchiveFileCopy.has_file == "Y")
-    )
-    size = size_query.scalar(as_tuple=True)[0]
-    current_size_gb = float(0.0 if size is None else size) / 2**30.0
+    # Get the total size of the files on the node from the maintained totals
+    size = nodestats.node_totals(node, store=True)[1]
+    current_size_gb = float(size) / 2**30.0
 
     # Stop if the current archive size is bigger than the maximum (if set, i.e. > 0)
     if current_size_gb > node.max_total_gb and node.max_total_gb > 0.0:
@@ -369,368 +784,538 @@ def update_node_requests(node):
             "Node %s has reached maximum size (current: %.1f GB, limit: %.1f GB)"
             % (node.name, current_size_gb, node.max_total_gb)
         )
-        return
+        return ncompleted
 
-    # ... OR if this is a transport node quit if the transport cycle is done.
-    if node.storage_type == "T" and done_transport_this_cycle:
+    # ... OR if this is a transport node quit if another transport node has
+    # been chosen this cycle.
+    if node.storage_type == "T" and not transport_cycle.available(node):
         log.info("Ignoring transport node %s" % node.name)
-        return
+        return ncompleted
+
+    try:
+        return ncompleted + _update_node_requests(node)
+    finally:
+        if node.storage_type == "T":
+            transport_cycle.release(node)
+
+
+def _pending_requests(node):
+    """Fetch the requests for transfers onto `node` which can be acted on.
+
+    Requests for files which already exist on the node are marked as complete,
+    and requests whose source copy is missing are left out. Everything needed
+    to perform a transfer (file, acquisition and source node) is fetched in the
+    same query to avoid lazily loading it for each request.
+    """
+
+    # Mark as complete any requests for files already on this node
+    n = (
+        di.ArchiveFileCopyRequest.update(completed=True)
+        .where(
+            ~di.ArchiveFileCopyRequest.completed,
+            ~di.ArchiveFileCopyRequest.cancelled,
+            di.ArchiveFileCopyRequest.group_to == node.group,
+            replicas.copy_exists(di.ArchiveFileCopyRequest.file, node=node),
+        )
+        .execute()
+    )
+    if n > 0:
+        log.info(
+            "Completed %i requests for files which already exist on this node "
+            '("%s").' % (n, node.name)
+        )
+
+    # Is there a good copy of the requested file on the source node?
+    src_exists = replicas.copy_exists(
+        di.ArchiveFileCopyRequest.file, node=di.ArchiveFileCopyRequest.node_from
+    )
+
+    # Fetch requests to process from the database. The node_from cannot be an
+    # HPSS node and must be active.
+    requests = (
+        di.ArchiveFileCopyRequest.select(
+            di.ArchiveFileCopyRequest, di.ArchiveFile, di.ArchiveAcq, di.StorageNode
+        )
+        .join(di.StorageNode, on=di.ArchiveFileCopyRequest.node_from)
+        .switch(di.ArchiveFileCopyRequest)
+        .join(di.ArchiveFile, on=di.ArchiveFileCopyRequest.file)
+        .join(di.ArchiveAcq, on=di.ArchiveFile.acq)
+        .where(
+            ~di.ArchiveFileCopyRequest.completed,
+            ~di.ArchiveFileCopyRequest.cancelled,
+            di.ArchiveFileCopyRequest.group_to == node.group,
+            di.StorageNode.address != "HPSS",
+            di.StorageNode.active,
+        )
+    )
+
+    # For transport disks we should only copy onto the transport node if the
+    # from_node is local, this should prevent pointlessly rsyncing across the
+    # network
+    if node.storage_type == "T":
+        requests = requests.where(di.StorageNode.host == node.host)
+
+    # Report on requests which can't be satisfied from their source
+    n = requests.where(~src_exists).count()
+    if n > 0:
+        log.error(
+            'Skipping %i requests onto node "%s" since the files are not '
+            "available on the source node." % (n, node.name)
+        )
+
+    return requests.where(src_exists)
+
+
+def _update_node_requests(node):
+    """Transfer requested files onto `node`.
+
+    Returns the number of transfers which succeeded. Those which fail aren't
+    counted, so that a request which can't be met doesn't make the stage due
+    again straight away.
+    """
 
     start_time = time.time()
 
-    # Fetch requests to process from the database
-    requests = di.ArchiveFileCopyRequest.select().where(
-        ~di.ArchiveFileCopyRequest.completed,
-        ~di.ArchiveFileCopyRequest.cancelled,
-        di.ArchiveFileCopyRequest.group_to == node.group,
+    requests = list(_pending_requests(node))
+    metrics.requests_pending.set(
+        len(set(req.file_id for req in requests)), node=node.name
     )
 
-    # Add in constraint that node_from cannot be an HPSS node
-    requests = requests.join(di.StorageNode).where(di.StorageNode.address != "HPSS")
+    # Files we've already dealt with during this pass
+    files_seen = set()
+    ncompleted = 0
+
+    try:
+        for req in requests:
+            if time.time() - start_time > max_time_per_node_operation:
+                break  # Don't hog all the time.
+
+            # Deal with any transfers which have finished in the meantime
+            ncompleted += _finish_transfers(node)
+
+            # Skip files we've already transferred during this pass (possibly
+            # from a different source), or are still transferring onto this
+            # node from a previous one.
+            if req.file_id in files_seen or transfer_scheduler.in_flight(
+                req.file_id, node
+            ):
+                continue
+            files_seen.add(req.file_id)
+
+            # Check that there is enough space available, allowing for the
+            # transfers still in progress.
+            avail_b = node.avail_gb * 2**30.0 - transfer_scheduler.bytes_in_flight(node)
+            if avail_b < 2.0 * req.file.size_b:
+                log.warning(
+                    'Node "%s" is full: not adding datafile "%s/%s".'
+                    % (node.name, req.file.acq.name, req.file.name)
+                )
+                continue
+
+            # Transport nodes need to claim the transport cycle before going on
+            if node.storage_type == "T" and not transport_cycle.claim(node):
+                log.info("Ignoring transport node %s" % node.name)
+                break
+
+            # Wait for a free transfer slot for this node and source host
+            # before touching the filesystem, so that local transfers are
+            # limited too. If none frees up in time, leave the request for the
+            # next pass.
+            slot = transfer_scheduler.reserve(req, node)
+            while slot is None:
+                if time.time() - start_time > max_time_per_node_operation:
+                    break
+                time.sleep(1)
+                ncompleted += _finish_transfers(node)
+                slot = transfer_scheduler.reserve(req, node)
+
+            if slot is None:
+                log.info(
+                    'No transfer slot free for node "%s" in time. Trying again '
+                    "later." % node.name
+                )
+                break
 
-    for req in requests:
-        if time.time() - start_time > max_time_per_node_operation:
-            break  # Don't hog all the time.
+            try:
+                xfer = _create_transfer(req, node)
+            except:
+                transfer_scheduler.release(slot)
+                raise
+            transfer_scheduler.start(slot, xfer)
 
-        # By default, if a copy fails, we mark the source file as suspect
-        # so it gets re-MD5'd on the source node.
-        check_source_on_err = True
+    finally:
+        # Deal with any transfers which finished during the pass. Those still
+        # running are left to a later one.
+        ncompleted += _finish_transfers(node)
 
-        # Only continue if the node is actually active
-        if not req.node_from.active:
-            continue
+    return ncompleted
 
-        # For transport disks we should only copy onto the transport
-        # node if the from_node is local, this should prevent pointlessly
-        # rsyncing across the network
-        if node.storage_type == "T" and node.host != req.node_from.host:
-            log.debug(
-                "Skipping request for %s/%s from remote node [%s] onto local "
-                "transport disks"
-                % (req.file.acq.name, req.file.name, req.node_from.name)
-            )
-            continue
 
-        # Only proceed if the destination file does not already exist.
-        try:
-            di.ArchiveFileCopy.get(
-                di.ArchiveFileCopy.file == req.file,
-                di.ArchiveFileCopy.node == node,
-                di.ArchiveFileCopy.has_file == "Y",
+def _check_bbcp(xfer):
+    """Extract the md5 hash of the transferred file from the bbcp output."""
+    xfer.md5sum = None
+
+    # Attempt to parse STDERR for the md5 hash
+    if xfer.ret == 0:
+        mo = re.search("md5 ([a-f0-9]{32})", xfer.stderr)
+        if mo is None:
+            log.error(
+                "BBCP transfer has gone awry. STDOUT: %s\n STDERR: %s"
+                % (xfer.stdout, xfer.stderr)
             )
-            log.info(
-                "Skipping request for %s/%s since it already exists on "
-                'this node ("%s"), and updating DB to reflect this.'
-                % (req.file.acq.name, req.file.name, node.name)
+            xfer.ret = -1
+        else:
+            xfer.md5sum = mo.group(1)
+
+
+def _check_rsync(xfer):
+    """Interpret the result of an rsync transfer."""
+
+    # rsync v3+ already does a whole-file MD5 sum while
+    # transferring and guarantees the written file has the same
+    # MD5 sum as the source file, so we can skip the check here.
+    xfer.md5sum = xfer.req.file.md5sum if xfer.ret == 0 else None
+
+    # If the rsync error occured during `mkstemp` this is a
+    # problem on the destination, not the source
+    if xfer.ret and "mkstemp" in xfer.stderr:
+        log.warn('rsync file creation failed on "{0}"'.format(xfer.node.name))
+        xfer.check_source_on_err = False
+    elif "write failed on" in xfer.stderr:
+        log.warn(
+            'rsync failed to write to "{0}": {1}'.format(
+                xfer.node.name,
+                xfer.stderr[xfer.stderr.rfind(":") + 2 :].strip(),
             )
-            di.ArchiveFileCopyRequest.update(completed=True).where(
-                di.ArchiveFileCopyRequest.file == req.file
-            ).where(di.ArchiveFileCopyRequest.group_to == node.group).execute()
-            continue
-        except pw.DoesNotExist:
-            pass
+        )
+        xfer.check_source_on_err = False
 
-        # Only proceed if the source file actually exists (and is not corrupted).
-        try:
-            di.ArchiveFileCopy.get(
-                di.ArchiveFileCopy.file == req.file,
-                di.ArchiveFileCopy.node == req.node_from,
-                di.ArchiveFileCopy.has_file == "Y",
-            )
-        except pw.DoesNotExist:
-            log.error(
-                "Skipping request for %s/%s since it is not available on "
-                'node "%s". [file_id=%i]'
-                % (req.file.acq.name, req.file.name, req.node_from.name, req.file.id)
+
+def _create_transfer(req, node):
+    """Construct the transfer of the file requested by `req` onto `node`.
+
+    Local transfers which can be done by hard linking are performed
+    immediately, so a transfer slot must already be reserved; otherwise the
+    returned transfer runs bbcp or rsync once started.
+    """
+
+    # Constuct the origin and destination paths.
+    from_path = "%s/%s/%s" % (req.node_from.root, req.file.acq.name, req.file.name)
+    if req.node_from.host != node.host:
+        from_path = "%s@%s:%s" % (
+            req.node_from.username,
+            req.node_from.address,
+            from_path,
+        )
+
+    to_path = "%s/%s/" % (node.root, req.file.acq.name)
+    if not os.path.isdir(to_path):
+        log.info('Creating directory "%s".' % to_path)
+        os.mkdir(to_path)
+
+    # Giddy up!
+    log.info('Transferring file "%s/%s".' % (req.file.acq.name, req.file.name))
+
+    # First we need to check if we are copying over the network
+    if req.node_from.host != node.host:
+        # Connect through the persistent connection to the remote host, to
+        # save doing an SSH handshake for every file.
+        ssh_cmd = ssh.connections.command(
+            "%s@%s" % (req.node_from.username, req.node_from.address)
+        )
+
+        # First try bbcp which is a fast multistream transfer tool. bbcp can
+        # calculate the md5 hash as it goes, so we'll do that to save doing
+        # it at the end.
+        if command_available("bbcp"):
+            return transfer.Transfer(
+                req,
+                node,
+                cmd=[
+                    "bbcp",
+                    "-S",
+                    " ".join(ssh_cmd + ["-x", "-a", "%I", "-l", "%U", "%H", "bbcp"]),
+                    "-V",
+                    "-f",
+                    "-z",
+                    "--port",
+                    "4200",
+                    "-W",
+                    "4M",
+                    "-s",
+                    "16",
+                    "-e",
+                    "-E",
+                    "%md5=",
+                    from_path,
+                    to_path,
+                ],
+                check=_check_bbcp,
             )
-            continue
 
-        # Check that there is enough space available.
-        if node.avail_gb * 2**30.0 < 2.0 * req.file.size_b:
-            log.warning(
-                'Node "%s" is full: not adding datafile "%s/%s".'
-                % (node.name, req.file.acq.name, req.file.name)
+        # Next try rsync over ssh.
+        elif command_available("rsync"):
+            return transfer.Transfer(
+                req,
+                node,
+                cmd=["rsync", "--compress"]
+                + RSYNC_OPTS
+                + [
+                    "--rsync-path=ionice -c2 -n4 rsync",
+                    "--rsh=%s" % " ".join(ssh_cmd),
+                    from_path,
+                    to_path,
+                ],
+                check=_check_rsync,
             )
-            continue
 
-        # Constuct the origin and destination paths.
-        from_path = "%s/%s/%s" % (req.node_from.root, req.file.acq.name, req.file.name)
-        if req.node_from.host != node.host:
-            from_path = "%s@%s:%s" % (
-                req.node_from.username,
-                req.node_from.address,
-                from_path,
+        # If we get here then we have no idea how to transfer the file...
+        else:
+            log.warn("No commands available to complete this transfer.")
+            return transfer.Transfer(req, node, ret=-1, check_source_on_err=False)
+
+    # Okay, great we're just doing a local transfer.
+
+    # First try to just hard link the file. This will only work if we
+    # are on the same filesystem. As there's no actual copying it's
+    # probably unecessary to calculate the md5 check sum, so we'll just
+    # fake it.
+    try:
+        link_path = "%s/%s/%s" % (node.root, req.file.acq.name, req.file.name)
+
+        # Check explicitly if link already exists as this and
+        # being unable to link will both raise OSError and get
+        # confused.
+        if os.path.exists(link_path):
+            log.error("File %s already exists. Clean up manually." % link_path)
+            return transfer.Transfer(req, node, ret=-1, check_source_on_err=False)
+
+        os.link(from_path, link_path)
+
+        # As we're linking the md5sum can't change. Skip the check here...
+        return transfer.Transfer(req, node, ret=0, md5sum=req.file.md5sum)
+
+    # If we couldn't just link the file, try copying it with rsync.
+    except OSError:
+        if command_available("rsync"):
+            return transfer.Transfer(
+                req,
+                node,
+                cmd=["rsync"] + RSYNC_OPTS + [from_path, to_path],
+                check=_check_rsync,
             )
+        else:
+            log.warn("No commands available to complete this transfer.")
+            return transfer.Transfer(req, node, ret=-1, check_source_on_err=False)
 
-        to_path = "%s/%s/" % (node.root, req.file.acq.name)
-        if not os.path.isdir(to_path):
-            log.info('Creating directory "%s".' % to_path)
-            os.mkdir(to_path)
 
-        # Giddy up!
-        log.info('Transferring file "%s/%s".' % (req.file.acq.name, req.file.name))
-        st = time.time()
+def _finish_transfers(node):
+    """Handle the transfers onto `node` which have finished.
 
-        # For the potential error message later
-        stderr = None
+    Returns the number of them which succeeded.
+    """
+    return sum(1 for t in transfer_scheduler.poll(node) if _complete_transfer(t))
 
-        # Attempt to transfer the file. Each of the methods below needs to set a
-        # return code `ret` and give an `md5sum` of the transferred file.
 
-        # First we need to check if we are copying over the network
-        if req.node_from.host != node.host:
-            # First try bbcp which is a fast multistream transfer tool. bbcp can
-            # calculate the md5 hash as it goes, so we'll do that to save doing
-            # it at the end.
-            if command_available("bbcp"):
-                ret, stdout, stderr = run_command(
-                    [
-                        "bbcp",
-                        "-V",
-                        "-f",
-                        "-z",
-                        "--port",
-                        "4200",
-                        "-W",
-                        "4M",
-                        "-s",
-                        "16",
-                        "-e",
-                        "-E",
-                        "%md5=",
-                        from_path,
-                        to_path,
-                    ]
-                )
+def _complete_transfer(xfer):
+    """Update the database with the outcome of a finished transfer.
 
-                # Attempt to parse STDERR for the md5 hash
-                if ret == 0:
-                    mo = re.search("md5 ([a-f0-9]{32})", stderr)
-                    if mo is None:
-                        log.error(
-                            "BBCP transfer has gone awry. STDOUT: %s\n STDERR: %s"
-                            % (stdout, stderr)
-                        )
-                        ret = -1
-                    md5sum = mo.group(1)
-                else:
-                    md5sum = None
-
-            # Next try rsync over ssh.
-            elif command_available("rsync"):
-                ret, stdout, stderr = run_command(
-                    ["rsync", "--compress"]
-                    + RSYNC_OPTS
-                    + [
-                        "--rsync-path=ionice -c2 -n4 rsync",
-                        "--rsh=ssh -q",
-                        from_path,
-                        to_path,
-                    ]
+    Returns True if the transfer succeeded.
+    """
+
+    req = xfer.req
+    node = xfer.node
+    to_path = "%s/%s/" % (node.root, req.file.acq.name)
+    labels = dict(source=req.node_from.name, dest=node.name)
+
+    # Check the return code...
+    if xfer.ret:
+        metrics.transfers.inc(result="failed", **labels)
+        if xfer.check_source_on_err:
+            # If the copy didn't work, then the remote file may be corrupted.
+            log.error(
+                "Copy failed: {0}. Marking source file suspect.".format(
+                    xfer.stderr if xfer.stderr is not None else "Unspecified error."
                 )
+            )
+            nodestats.update_copies(
+                (di.ArchiveFileCopy.file == req.file)
+                & (di.ArchiveFileCopy.node == req.node_from),
+                "M",
+            )
+        else:
+            # An error occurred that can't be due to the source
+            # being corrupt
+            log.error("Copy failed.")
+        return False
+
+    # Check integrity.
+    if xfer.md5sum == req.file.md5sum:
+        size_mb = req.file.size_b / 2**20.0
+        trans_time = xfer.end_time - xfer.start_time
+        rate = size_mb / max(trans_time, 1e-3)
+        metrics.transfers.inc(result="success", **labels)
+        metrics.transfer_bytes.inc(req.file.size_b, **labels)
+        metrics.transfer_seconds.observe(trans_time, **labels)
+        log.info(
+            "Pull complete (md5sum correct). Transferred %.1f MB in %i "
+            "seconds [%.1f MB/s]" % (size_mb, int(trans_time), rate)
+        )
 
-                # rsync v3+ already does a whole-file MD5 sum while
-                # transferring and guarantees the written file has the same
-                # MD5 sum as the source file, so we can skip the check here.
-                md5sum = req.file.md5sum if ret == 0 else None
-
-                # If the rsync error occured during `mkstemp` this is a
-                # problem on the destination, not the source
-                if ret and "mkstemp" in stderr:
-                    log.warn('rsync file creation failed on "{0}"'.format(node.name))
-                    check_source_on_err = False
-                elif "write failed on" in stderr:
-                    log.warn(
-                        'rsync failed to write to "{0}": {1}'.format(
-                            node.name, stderr[stderr.rfind(":") + 2 :].strip()
+        # Update the FileCopy (if exists), or insert a new FileCopy
+        # Use transaction to avoid race condition
+        with db.proxy.transaction():
+            try:
+                done = False
+                while not done:
+                    try:
+                        fcopy = (
+                            di.ArchiveFileCopy.select()
+                            .where(
+                                di.ArchiveFileCopy.file == req.file,
+                                di.ArchiveFileCopy.node == node,
+                            )
+                            .get()
                         )
-                    )
-                    check_source_on_err = False
+                        had_file = fcopy.has_file == "Y"
+                        fcopy.has_file = "Y"
+                        fcopy.wants_file = "Y"
+                        fcopy.save()
+                        if not had_file:
+                            nodestats.add(node, 1, req.file.size_b)
+                        done = True
+                    except pw.OperationalError:
+                        log.error(
+                            "MySQL connexion dropped. Will attempt to reconnect in "
+                            "five seconds."
+                        )
+                        time.sleep(5)
+                        db.connect(True)
+            except pw.DoesNotExist:
+                di.ArchiveFileCopy.insert(
+                    file=req.file, node=node, has_file="Y", wants_file="Y"
+                ).execute()
+                nodestats.add(node, 1, req.file.size_b)
 
-            # If we get here then we have no idea how to transfer the file...
-            else:
-                log.warn("No commands available to complete this transfer.")
-                check_source_on_err = False
-                ret = -1
+        # Mark any FileCopyRequest for this file as completed
+        di.ArchiveFileCopyRequest.update(completed=True).where(
+            di.ArchiveFileCopyRequest.file == req.file
+        ).where(di.ArchiveFileCopyRequest.group_to == node.group).execute()
 
-        # Okay, great we're just doing a local transfer.
-        else:
-            # First try to just hard link the file. This will only work if we
-            # are on the same filesystem. As there's no actual copying it's
-            # probably unecessary to calculate the md5 check sum, so we'll just
-            # fake it.
-            try:
-                link_path = "%s/%s/%s" % (node.root, req.file.acq.name, req.file.name)
-
-                # Check explicitly if link already exists as this and
-                # being unable to link will both raise OSError and get
-                # confused.
-                if os.path.exists(link_path):
-                    log.error("File %s already exists. Clean up manually." % link_path)
-                    check_source_on_err = False
-                    ret = -1
-                else:
-                    os.link(from_path, link_path)
-                    ret = 0
-                    md5sum = (
-                        req.file.md5sum
-                    )  # As we're linking the md5sum can't change. Skip the check here...
+        if node.storage_type == "T":
+            # This node is getting the transport king.
+            transport_cycle.complete(node)
 
-            # If we couldn't just link the file, try copying it with rsync.
-            except OSError:
-                if command_available("rsync"):
-                    ret, stdout, stderr = run_command(
-                        ["rsync"] + RSYNC_OPTS + [from_path, to_path]
-                    )
+        # Update node available space
+        update_node_free_space(node)
 
-                    # rsync v3+ already does a whole-file MD5 sum while
-                    # transferring and guarantees the written file has the same
-                    # MD5 sum as the source file, so we can skip the check here.
-                    md5sum = req.file.md5sum if ret == 0 else None
+        return True
 
-                    # If the rsync error occured during `mkstemp` this is a
-                    # problem on the destination, not the source
-                    if ret and "mkstemp" in stderr:
-                        log.warn(
-                            'rsync file creation failed on "{0}"'.format(node.name)
-                        )
-                        check_source_on_err = False
-                    elif "write failed on" in stderr:
-                        log.warn(
-                            'rsync failed to write to "{0}": {1}'.format(
-                                node.name, stderr[stderr.rfind(":") + 2 :].strip()
-                            )
-                        )
-                        check_source_on_err = False
-                else:
-                    log.warn("No commands available to complete this transfer.")
-                    check_source_on_err = False
-                    ret = -1
-
-        # Check the return code...
-        if ret:
-            if check_source_on_err:
-                # If the copy didn't work, then the remote file may be corrupted.
-                log.error(
-                    "Copy failed: {0}. Marking source file suspect.".format(
-                        stderr if stderr is not None else "Unspecified error."
-                    )
-                )
-                di.ArchiveFileCopy.update(has_file="M").where(
-                    di.ArchiveFileCopy.file == req.file,
-                    di.ArchiveFileCopy.node == req.node_from,
-                ).execute()
-            else:
-                # An error occurred that can't be due to the source
-                # being corrupt
-                log.error("Copy failed.")
-            continue
-        et = time.time()
+    else:
+        metrics.transfers.inc(result="md5_mismatch", **labels)
+        metrics.md5_failures.inc(**labels)
+        log.error(
+            'Error with md5sum check: %s on node "%s", but %s on '
+            'this node, "%s".'
+            % (req.file.md5sum, req.node_from.name, xfer.md5sum, node.name)
+        )
+        log.error('Removing file "%s/%s".' % (to_path, req.file.name))
+        try:
+            os.remove("%s/%s" % (to_path, req.file.name))
+        except:
+            log.error("Could not remove file.")
+
+        # Since the md5sum failed, the remote file may be corrupted.
+        log.error("Marking source file suspect.")
+        nodestats.update_copies(
+            (di.ArchiveFileCopy.file == req.file)
+            & (di.ArchiveFileCopy.node == req.node_from),
+            "M",
+        )
 
-        # Check integrity.
-        if md5sum == req.file.md5sum:
-            size_mb = req.file.size_b / 2**20.0
-            trans_time = et - st
-            rate = size_mb / trans_time
-            log.info(
-                "Pull complete (md5sum correct). Transferred %.1f MB in %i "
-                "seconds [%.1f MB/s]" % (size_mb, int(trans_time), rate)
-            )
+        return False
 
-            # Update the FileCopy (if exists), or insert a new FileCopy
-            # Use transaction to avoid race condition
-            with db.proxy.transaction():
-                try:
-                    done = False
-                    while not done:
-                        try:
-                            fcopy = (
-                                di.ArchiveFileCopy.select()
-                                .where(
-                                    di.ArchiveFileCopy.file == req.file,
-                                    di.ArchiveFileCopy.node == node,
-                                )
-                                .get()
-                            )
-                            fcopy.has_file = "Y"
-                            fcopy.wants_file = "Y"
-                            fcopy.save()
-                            done = True
-                        except pw.OperationalError:
-                            log.error(
-                                "MySQL connexion dropped. Will attempt to reconnect in "
-                                "five seconds."
-                            )
-                            time.sleep(5)
-                            db.connect(True)
-                except pw.DoesNotExist:
-                    di.ArchiveFileCopy.insert(
-                        file=req.file, node=node, has_file="Y", wants_file="Y"
-                    ).execute()
-
-            # Mark any FileCopyRequest for this file as completed
-            di.ArchiveFileCopyRequest.update(completed=True).where(
-                di.ArchiveFileCopyRequest.file == req.file
-            ).where(di.ArchiveFileCopyRequest.group_to == node.group).execute()
-
-            if node.storage_type == "T":
-                # This node is getting the transport king.
-                done_transport_this_cycle = True
-
-            # Update node available space
-            update_node_free_space(node)
 
-        else:
-            log.error(
-                'Error with md5sum check: %s on node "%s", but %s on '
-                'this node, "%s".'
-                % (req.file.md5sum, req.node_from.name, md5sum, node.name)
-            )
-            log.error('Removing file "%s/%s".' % (to_path, req.file.name))
-            try:
-                os.remove("%s/%s" % (to_path, req.file.name))
-            except:
-                log.error("Could not remove file.")
+def update_node(node, stages=None):
+    """Update the status of the node, and process eligible transfers onto it.
 
-            # Since the md5sum failed, the remote file may be corrupted.
-            log.error("Marking source file suspect.")
-            di.ArchiveFileCopy.update(has_file="M").where(
-                di.ArchiveFileCopy.file == req.file,
-                di.ArchiveFileCopy.node == req.node_from,
-            ).execute()
+    If the node is already being updated by another worker, do nothing.
 
+    Parameters
+    ----------
+    node : di.StorageNode
+        The node to update.
+    stages : list, optional
+        The stages of the update to run. If not given, run them all.
+    """
 
-def update_node(node):
-    """Update the status of the node, and process eligible transfers onto it."""
+    if stages is None:
+        stages = list(node_schedule.cadence)
 
-    # Check if this is an HPSS node, and if so call the special handler
-    if is_hpss_node(node):
-        update_node_hpss_inbound(node)
+    lock = _node_lock(node)
+    if not lock.acquire(False):
+        log.debug('Node "%s" is already being updated. Skipping.' % node.name)
         return
 
-    # Make sure this node is usable.
-    if not node.active:
-        log.debug('Skipping deactivated node "%s".' % node.name)
-        return
-    if node.suspect:
-        log.debug('Skipping suspected node "%s".' % node.name)
+    try:
+        _update_node(node, stages)
+    finally:
+        lock.release()
+
 
-    log.info('Updating node "%s".' % (node.name))
+def _update_node(node, stages):
+    """Run the given stages of the update of `node`, and schedule them again.
 
-    # Check and update the amount of free space
-    update_node_free_space(node)
+    Each stage is rescheduled according to the work it did. Stages which don't
+    apply to the node count as having nothing to do.
+    """
+
+    work = dict((stage, 0) for stage in stages)
+
+    try:
+        # Check if this is an HPSS node, and if so call the special handler
+        if is_hpss_node(node):
+            if "hpss" in stages:
+                work["hpss"] = update_node_hpss_inbound(node)
+            return
+
+        # Make sure this node is usable.
+        if not node.active:
+            log.debug('Skipping deactivated node "%s".' % node.name)
+            return
+        if node.suspect:
+            log.debug('Skipping suspected node "%s".' % node.name)
+
+        log.info('Updating node "%s" (%s).' % (node.name, ", ".join(stages)))
+
+        # Check and update the amount of free space
+        if "free_space" in stages:
+            update_node_free_space(node)
+            work["free_space"] = None
 
-    # Check the integrity of any questionable files (has_file=M)
-    update_node_integrity(node)
+        # Check the integrity of any questionable files (has_file=M)
+        if "integrity" in stages:
+            work["integrity"] = update_node_integrity(node)
 
-    # Delete any upwanted files to cleanup space
-    update_node_delete(node)
+        # Delete any upwanted files to cleanup space
+        if "delete" in stages:
+            work["delete"] = update_node_delete(node)
 
-    # Process any regular transfers requests onto this node
-    update_node_requests(node)
+        # Process any regular transfers requests onto this node
+        if "requests" in stages:
+            work["requests"] = update_node_requests(node)
 
-    # Process any tranfers out of HPSS onto this node
-    update_node_hpss_outbound(node)
+            # Don't back off while transfers are still running onto the node,
+            # so they are dealt with soon after they finish
+            if not work["requests"] and transfer_scheduler.running(node):
+                work["requests"] = None
+
+        # Process any tranfers out of HPSS onto this node
+        if "hpss" in stages:
+            work["hpss"] = update_node_hpss_outbound(node)
+    finally:
+        for stage, n in work.items():
+            node_schedule.done(node.id, stage, n)
 
 
 def is_hpss_node(node):
@@ -738,55 +1323,126 @@ def is_hpss_node(node):
     return node.address == "HPSS"
 
 
-def _check_and_bundle_requests(requests, node, pull=False):
-    """Find eligible HPSS transfer requests, and return a bundle of them up to
-    some maximum size."""
+# Limits on the HPSS transfer bundles. Due to fixed, per-file overheads, we
+# limit the number of files pulled by a single job. For a four hour jobspec,
+# this works out to ten files per hour, which seems to be reasonable. Pushes
+# don't require this limitation.
+hpss_bundle_size = 800.0 * 2**30.0  # Size to bundle transfers into (in bytes)
+hpss_push_files = 500  # Maximum number of files pushed by a job
+hpss_pull_files = 40  # Maximum number of files pulled by a job
+hpss_bundle_candidates = 5000  # Requests considered when planning bundles
+
+
+def _hpss_requests(node, pull=False):
+    """Fetch the requests for transfers onto `node` to consider for HPSS bundles.
+
+    The requests are fetched in one query, together with their file,
+    acquisition and source node, and whether a copy of the file exists at the
+    source and the destination. They are ordered by acquisition so that files
+    which are together on tape are bundled together.
+    """
+    dst_exists = replicas.copy_exists(di.ArchiveFileCopyRequest.file, node=node)
+    src_exists = replicas.copy_exists(
+        di.ArchiveFileCopyRequest.file, node=di.ArchiveFileCopyRequest.node_from
+    )
+
+    requests = (
+        di.ArchiveFileCopyRequest.select(
+            di.ArchiveFileCopyRequest,
+            di.ArchiveFile,
+            di.ArchiveAcq,
+            di.StorageNode,
+            di.StorageGroup,
+            dst_exists.alias("dst_has_file"),
+            src_exists.alias("src_has_file"),
+        )
+        .join(di.ArchiveFile)
+        .join(di.ArchiveAcq)
+        .switch(di.ArchiveFileCopyRequest)
+        .join(
+            di.StorageNode,
+            on=(di.ArchiveFileCopyRequest.node_from == di.StorageNode.id),
+        )
+        .join(di.StorageGroup)
+        .where(
+            ~di.ArchiveFileCopyRequest.completed,
+            ~di.ArchiveFileCopyRequest.cancelled,
+            di.ArchiveFileCopyRequest.group_to == node.group,
+        )
+    )
+
+    # Add constraint that pulls must be from an HPSS node
+    if pull:
+        requests = requests.where(di.StorageNode.address == "HPSS")
+
+    return requests.order_by(
+        di.ArchiveAcq.name, di.ArchiveFile.name, di.ArchiveFileCopyRequest.id
+    ).limit(hpss_bundle_candidates)
+
 
-    # Size to bundle transfers into (in bytes)
-    max_bundle_size = 800.0 * 2**30.0
+def _pack_bundles(requests, max_size, max_files):
+    """Pack requests into bundles of at most `max_size` bytes and `max_files` files.
 
-    # Due to fixed, per-file overheads, we limit the number of files pulled
-    # by a single job.  For a four hour jobspec, this works out to ten files
-    # per hour, which seems to be reasonable.  Pushes don't require this
-    # limitation
-    req_limit = 40 if pull else 500
+    Requests are placed, in order, into the first bundle with room for them,
+    so each bundle is filled as far as possible while keeping files which are
+    close together in `requests` in the same bundle. A file larger than
+    `max_size` is given a bundle to itself.
+    """
+    bundles = []
+    for req in requests:
+        size = req.file.size_b or 0
+        for bundle in bundles:
+            if len(bundle["requests"]) < max_files and bundle["size"] + size < max_size:
+                break
+        else:
+            bundle = {"requests": [], "size": 0.0}
+            bundles.append(bundle)
+
+        bundle["requests"].append(req)
+        bundle["size"] += size
+
+    return [bundle["requests"] for bundle in bundles]
+
+
+def _check_and_bundle_requests(node, pull=False):
+    """Find eligible HPSS transfer requests, and pack them into bundles.
+
+    Returns
+    -------
+    bundles : list
+        Lists of requests, each of which is up to some maximum size and number
+        of files, in order of the earliest acquisition in each.
+    """
+
+    max_files = hpss_pull_files if pull else hpss_push_files
 
-    bundle_size = 0.0
     requests_to_process = []
+    files_here = []
+    files_seen = set()
+
+    for req in _hpss_requests(node, pull):
+        # Only transfer each file once, whichever node it is requested from
+        if req.file_id in files_seen:
+            continue
 
-    # Construct list of requests to process by finding eligible requests up to
-    # the maximum single transfer size
-    for req in requests.order_by(di.ArchiveFileCopyRequest.file_id).limit(req_limit):
         # Check to ensure both source and dest nodes are on the same host
         if req.node_from.host != node.host:
             log.error("Source file is not on this host [request_id=%i]." % req.id)
             continue
 
         # Check if there is already a copy at the destination, and skip the request if there is
-        filecopy_dst = di.ArchiveFileCopy.select().where(
-            di.ArchiveFileCopy.file == req.file,
-            di.ArchiveFileCopy.node == node,
-            di.ArchiveFileCopy.has_file == "Y",
-        )
-        if filecopy_dst.exists():
+        if req.dst_has_file:
             log.info(
                 "Skipping request for %s/%s since it already exists on "
                 'this node ("%s"), and updating DB to reflect this.'
                 % (req.file.acq.name, req.file.name, node.name)
             )
-            di.ArchiveFileCopyRequest.update(completed=True).where(
-                di.ArchiveFileCopyRequest.file == req.file,
-                di.ArchiveFileCopyRequest.group_to == node.group,
-            ).execute()
+            files_here.append(req.file_id)
+            files_seen.add(req.file_id)
             continue
 
         # Check that there is actually a copy of the file at the source
-        filecopy_src = di.ArchiveFileCopy.select().where(
-            di.ArchiveFileCopy.file == req.file,
-            di.ArchiveFileCopy.node == req.node_from,
-            di.ArchiveFileCopy.has_file == "Y",
-        )
-        if not filecopy_src.exists():
+        if not req.src_has_file:
             log.error(
                 "Skipping request for %s/%s since it is not available on "
                 'node "%s". [file_id=%i]'
@@ -812,54 +1468,146 @@ def _check_and_bundle_requests(requests, node, pull=False):
             )
             continue
 
-        # Add the request into the list to process (provided we haven't hit the maximum transfer size)
-        if bundle_size + req.file.size_b < max_bundle_size:
-            requests_to_process.append(req)
-            bundle_size += req.file.size_b
-        else:
-            break
+        requests_to_process.append(req)
+        files_seen.add(req.file_id)
+
+    if files_here:
+        di.ArchiveFileCopyRequest.update(completed=True).where(
+            di.ArchiveFileCopyRequest.file << files_here,
+            di.ArchiveFileCopyRequest.group_to == node.group,
+        ).execute()
 
-    return requests_to_process
+    return _pack_bundles(requests_to_process, hpss_bundle_size, max_files)
+
+
+def _complete_hpss_requests(requests, node):
+    """Mark any FileCopyRequest for the files of `requests` onto `node` as completed."""
+    di.ArchiveFileCopyRequest.update(completed=True).where(
+        di.ArchiveFileCopyRequest.file << [req.file_id for req in requests],
+        di.ArchiveFileCopyRequest.group_to == node.group,
+    ).execute()
+
+
+# The mtime of HPSS_SCRIPT_DIR when it was last scanned for callbacks
+_hpss_callback_mtime = None
 
 
 def run_hpss_callbacks_from_file():
-    """Execute filesystem-based HPSS callbacks"""
+    """Execute filesystem-based HPSS callbacks.
+
+    The callbacks are applied in-process, in a single transaction. The
+    directory is only scanned if it has changed since it was last scanned, or
+    a job was still writing its callbacks then. Returns the number of
+    callbacks applied.
+    """
+    global _hpss_callback_mtime
 
     # Do nothing if the HPSS script directory hasn't been defined
     if HPSS_SCRIPT_DIR is None:
-        return
+        return 0
+
+    # Don't rescan the directory if no callback can have been added since last
+    # time. The mtime is only trusted once it is old enough that no file can
+    # have been added since with the same mtime.
+    scan_time = time.time()
+    mtime = os.stat(HPSS_SCRIPT_DIR).st_mtime
+    if mtime == _hpss_callback_mtime:
+        return 0
 
     log.info("Processing HPSS callbacks")
 
     # Compile the regex
     prog = re.compile(
-        ".+/hpss-[^-]+-((?:push|pull)_(?:success|failed))-([0-9]+)-([0-9]+).callback$"
+        "hpss-[^-]+-((?:push|pull)_(?:success|failed))-([0-9]+)-([0-9]+).callback$"
     )
 
+    # The partial callbacks of a job, written as it goes
+    part_prog = re.compile(r"hpss-(.+)-(push|pull)\.callbacks\.part$")
+
     # Iterate over callback files in order
-    for cb in sorted(glob.glob(os.path.join(HPSS_SCRIPT_DIR, "hpss-*-*-*-*.callback"))):
+    cb_files = []
+    callbacks = []
+    running = None
+    writing = False
+    for entry in sorted(os.scandir(HPSS_SCRIPT_DIR), key=lambda e: e.name):
+        # A job reports all of its transfers in a single file, one per line
+        if fnmatch.fnmatch(entry.name, "hpss-*.callbacks"):
+            cb_files.append(entry.path)
+            with open(entry.path, "r") as f:
+                callbacks += hpss_callback.parse_callbacks(f)
+            continue
+
+        # A job renames its partial callbacks when it exits. If it was killed
+        # before it could, apply them once it has left the queue, as its
+        # requests have already been marked complete. If the queue can't be
+        # checked, assume the job is still running.
+        match = part_prog.match(entry.name)
+        if match:
+            if running is None:
+                running = set(job.get("NAME") for job in hpss_queue.jobs())
+            job_name = "%s_%s" % (match.group(2), match.group(1))
+            if job_name in running or not hpss_queue.known:
+                writing = True
+                continue
+
+            try:
+                with open(entry.path, "r") as f:
+                    callbacks += hpss_callback.parse_callbacks(f)
+            except OSError:
+                # The job renamed it as it exited
+                continue
+            log.warning(
+                "HPSS job %s was killed. Applying the callbacks it wrote." % job_name
+            )
+
+            # Remove the scratch files it left behind too
+            base = entry.path[: -len(".part")]
+            cb_files.append(entry.path)
+            for suffix in [".hsi", ".hashes", ".moved"]:
+                if os.path.exists(base + suffix):
+                    cb_files.append(base + suffix)
+            continue
+
+        if not fnmatch.fnmatch(entry.name, "hpss-*-*-*-*.callback"):
+            continue
+
         # The files are zero size.  All the information is in the filename
         # itself
+        cb_files.append(entry.path)
 
         # Decompose the filename
-        match = prog.match(cb)
+        match = prog.match(entry.name)
 
-        # Execute the callback, if decomposition worked
         if match:
-            os.system(
-                "alpenhorn_hpss {0} {1} {2}".format(
-                    match.group(1), match.group(2), match.group(3)
-                )
-            )
+            callbacks.append((match.group(1), int(match.group(2)), int(match.group(3))))
         else:
-            log.error("Incomprehensible callback: {0}".format(cb))
+            log.error("Incomprehensible callback: {0}".format(entry.path))
 
-        # Remove callback
+    # Execute the callbacks. The jobs which made them have finished, so look at
+    # the queue again.
+    if callbacks:
+        hpss_callback.apply_callbacks(callbacks)
+        hpss_queue.invalidate()
+
+    # Remove callbacks
+    for cb in cb_files:
         os.unlink(cb)
 
+    # Keep scanning while any job is writing callbacks, as a killed job leaves
+    # no trace in the directory's mtime.
+    if scan_time - mtime > 1.0 and not writing:
+        _hpss_callback_mtime = mtime
+    else:
+        _hpss_callback_mtime = None
+
+    return len(callbacks)
+
 
 def update_node_hpss_inbound(node):
-    """Process transfers into an HPSS node."""
+    """Process transfers into an HPSS node.
+
+    Returns the number of jobs submitted.
+    """
 
     if HPSS_SCRIPT_DIR is None:
         raise KeyError("ALPENHORN_HPSS_SCRIPT_DIR not found in environment.")
@@ -868,46 +1616,20 @@ def update_node_hpss_inbound(node):
 
     if not is_hpss_node(node):
         log.error("This is not an HPSS node.")
-        return
-
-    # Fetch requests for transfer onto this node
-    requests = di.ArchiveFileCopyRequest.select().where(
-        ~di.ArchiveFileCopyRequest.completed,
-        ~di.ArchiveFileCopyRequest.cancelled,
-        di.ArchiveFileCopyRequest.group_to == node.group,
-    )
+        return 0
 
-    # Get the requests we should actually process
-    requests_to_process = _check_and_bundle_requests(requests, node, pull=False)
-
-    # Exit if there are no requests to process
-    if len(requests_to_process) == 0:
-        return
-
-    if len(queued_archive_jobs()) > 0:
-        log.info("Skipping HPSS inbound as queue full.")
-        return
-
-    # Construct final list of requests to process
-    for req in requests_to_process:
-        log.info("Pushing file %s/%s into HPSS" % (req.file.acq.name, req.file.name))
-
-        # Mark any FileCopyRequest for this file as completed
-        di.ArchiveFileCopyRequest.update(completed=True).where(
-            di.ArchiveFileCopyRequest.file == req.file
-        ).where(di.ArchiveFileCopyRequest.group_to == node.group).execute()
-
-    script_name = _create_hpss_push_script(requests_to_process, node)
-    log.info("Submitting HPSS job %s" % script_name)
-    _submit_hpss_script(script_name)
+    return _dispatch_hpss_jobs(node, "push")
 
 
 def update_node_hpss_outbound(node):
-    """Process transfers out of an HPSS tape node."""
+    """Process transfers out of an HPSS tape node.
+
+    Returns the number of jobs submitted.
+    """
 
     # Do nothing if the HPSS script directory hasn't been defined
     if HPSS_SCRIPT_DIR is None:
-        return
+        return 0
 
     log.info("Processing HPSS outbound transfers (%s)" % node.name)
 
@@ -916,54 +1638,118 @@ def update_node_hpss_outbound(node):
         log.info(
             "Node %s is nearly full. Skipping HPSS outbound transfers." % node.name
         )
-        return
+        return 0
 
-    # Fetch requests for transfer onto this node
-    requests = di.ArchiveFileCopyRequest.select().where(
-        ~di.ArchiveFileCopyRequest.completed,
-        ~di.ArchiveFileCopyRequest.cancelled,
-        di.ArchiveFileCopyRequest.group_to == node.group,
+    return _dispatch_hpss_jobs(node, "pull")
+
+
+def _hpss_jobs_pending(kind):
+    """The IDs of the HPSS jobs of type `kind` which are waiting to start.
+
+    As well as the pending jobs in the archivelong partition named for `kind`,
+    so that jobs submitted before a restart are counted, this includes the jobs
+    we have submitted which haven't shown up in the queue yet.
+    """
+    jobs = hpss_queue.jobs()
+    states = dict((job["JOBID"], job.get("ST")) for job in jobs)
+
+    pending = set(
+        job["JOBID"]
+        for job in jobs
+        if job.get("NAME", "").startswith(kind + "_")
+        and job.get("ST") == "PD"
+        and job.get("PARTITION") == "archivelong"
+    )
+    pending.update(
+        job_id
+        for job_id in hpss_queue.in_flight(kind)
+        if states.get(job_id, "PD") == "PD"
     )
+    return pending
 
-    # Add constraint that transfers must be from an HPSS node
-    requests = requests.join(di.StorageNode).where(di.StorageNode.address == "HPSS")
+
+def _dispatch_hpss_jobs(node, kind):
+    """Submit HPSS jobs of type `kind` ("push" or "pull") for transfers onto `node`.
+
+    Jobs are submitted until `hpss_push_jobs` or `hpss_pull_jobs` are waiting
+    in the queue, each transferring one bundle of requests. Returns the number
+    of jobs submitted.
+    """
+    pull = kind == "pull"
+    target = hpss_pull_jobs if pull else hpss_push_jobs
+
+    pending = _hpss_jobs_pending(kind)
+    log.debug("HPSS %s jobs pending: %s" % (kind, ", ".join(sorted(pending)) or "none"))
+
+    if len(pending) >= target:
+        log.info(
+            "Skipping HPSS %s as %i jobs are already pending." % (kind, len(pending))
+        )
+        return 0
 
     # Get the requests we should actually process
-    requests_to_process = _check_and_bundle_requests(requests, node, pull=True)
+    bundles = _check_and_bundle_requests(node, pull=pull)
+    nsubmitted = 0
+
+    for requests_to_process in bundles[: target - len(pending)]:
+        for req in requests_to_process:
+            if pull:
+                log.info(
+                    "Pulling file %s/%s from HPSS" % (req.file.acq.name, req.file.name)
+                )
+            else:
+                log.info(
+                    "Pushing file %s/%s into HPSS" % (req.file.acq.name, req.file.name)
+                )
 
-    # Exit if there are no requests to process
-    if len(requests_to_process) == 0:
-        return
+        if pull:
+            script_name = _create_hpss_pull_script(requests_to_process, node)
+        else:
+            script_name = _create_hpss_push_script(requests_to_process, node)
 
-    if len(queued_archive_jobs()) > 1:
-        log.info("Skipping HPSS outbound as queue full.")
-        return
+        log.info("Submitting HPSS job %s" % script_name)
+        if _submit_hpss_script(script_name, kind) is not None:
+            # Mark any FileCopyRequest for these files as completed
+            _complete_hpss_requests(requests_to_process, node)
+            nsubmitted += 1
 
-    # Construct final list of requests to process
-    for req in requests_to_process:
-        log.info("Pulling file %s/%s from HPSS" % (req.file.acq.name, req.file.name))
+    return nsubmitted
 
-        # Mark any FileCopyRequest for this file as completed
-        di.ArchiveFileCopyRequest.update(completed=True).where(
-            di.ArchiveFileCopyRequest.file == req.file
-        ).where(di.ArchiveFileCopyRequest.group_to == node.group).execute()
 
-    script_name = _create_hpss_pull_script(requests_to_process, node)
-    log.info("Submitting HPSS job %s" % script_name)
-    _submit_hpss_script(script_name)
+def _hpss_job_name(kind):
+    """A name for a new HPSS job of type `kind`, unique amongst the job scripts."""
+    dtstring = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+
+    name = dtstring
+    n = 0
+    while os.path.exists("%s/%s_%s.sh" % (HPSS_SCRIPT_DIR, kind, name)):
+        n += 1
+        name = "%s.%i" % (dtstring, n)
+
+    return name
 
 
 def _create_hpss_push_script(requests, node):
     start = """#!/bin/bash
 #SBATCH -t 4:00:00
 #SBATCH -p archivelong
-#SBATCH -J pull_%(jobname)s
+#SBATCH -J push_%(jobname)s
 #SBATCH -N 1
 
 # Transfer files from CHIME archive to HPSS
 
 DESTDIR=%(offline_node_root)s
 
+# Report the outcome of all the transfers in one go when the job exits. If the
+# job is killed before it can, alpenhornd applies $CALLBACKS.part once the job
+# has left the queue.
+CALLBACKS=%(cb_path)s/hpss-%(jobname)s-push.callbacks
+trap 'rm -f $CALLBACKS.hsi $CALLBACKS.hashes $CALLBACKS.moved; mv $CALLBACKS.part $CALLBACKS' EXIT
+trap 'exit 1' TERM
+touch $CALLBACKS.part
+"""
+
+    loop_start = """
 ## Looping section
 """
 
@@ -990,8 +1776,7 @@ then
     hsi -q mv $DESTDIR/%(acq)s/tmp.%(file)s $DESTDIR/%(acq)s/%(file)s
 
     # Signal success
-    #ssh %(host)s 'alpenhorn_hpss push_success %(file_id)i %(node_id)i'
-    touch %(cb_path)s/hpss-%(dtstring)s-push_success-%(file_id)i-%(node_id)i.callback
+    echo 'push_success %(file_id)i %(node_id)i' >> $CALLBACKS.part
 
     echo 'Finished push.'
 else
@@ -999,21 +1784,88 @@ else
     hsi -q rm $DESTDIR/%(acq)s/tmp.%(file)s
 
     # Signal failure
-    #ssh %(host)s 'alpenhorn_hpss push_failed %(file_id)i %(node_id)i'
-    touch %(cb_path)s/hpss-%(dtstring)s-push_failed-%(file_id)i-%(node_id)i.callback
+    echo 'push_failed %(file_id)i %(node_id)i' >> $CALLBACKS.part
 
     echo "Push failed."
 fi
 """
 
-    dtnow = datetime.datetime.now()
-    dtstring = dtnow.strftime("%Y%m%dT%H%M%S")
+    # When batched, all the files are copied in one hsi session, and all their
+    # hashes fetched in another. The good files are then moved into place in a
+    # third session, and the corrupt ones removed in a fourth.
+    batch_start = """
+## Batch section
 
-    script = start % {"offline_node_root": node.root, "jobname": dtstring}
+echo 'Starting push of %(nfiles)i files'
 
-    # Loop over files to construct push script
-    for req in requests:
-        req_dict = {
+# Copy the files into temporary locations
+cat > $CALLBACKS.hsi <<'_EOF_'
+%(put_cmds)s
+_EOF_
+hsi -q "in $CALLBACKS.hsi"
+
+# Extract the MD5 hashes of the files
+cat > $CALLBACKS.hsi <<'_EOF_'
+%(lshash_cmds)s
+_EOF_
+hsi -q "in $CALLBACKS.hsi" > $CALLBACKS.hashes 2>&1
+
+: > $CALLBACKS.hsi
+: > $CALLBACKS.moved
+"""
+
+    batch_loop = """
+######## Checking file %(acq)s/%(file)s ########
+
+HPSSHASH=$(awk -v p=$DESTDIR/%(acq)s/tmp.%(file)s '{for (i = 2; i <= NF; i++) if ($i == p) print $1}' $CALLBACKS.hashes)
+
+if [ "$HPSSHASH" == '%(file_hash)s' ]
+then
+    echo "mv $DESTDIR/%(acq)s/tmp.%(file)s $DESTDIR/%(acq)s/%(file)s" >> $CALLBACKS.hsi
+    echo 'push_success %(file_id)i %(node_id)i' >> $CALLBACKS.moved
+else
+    # Signal failure
+    echo 'push_failed %(file_id)i %(node_id)i' >> $CALLBACKS.part
+
+    echo "Push of %(acq)s/%(file)s failed."
+fi
+"""
+
+    batch_end = """
+
+######## Finishing ########
+
+# Move the good files into their final locations
+if hsi -q "in $CALLBACKS.hsi"
+then
+    # Signal success
+    cat $CALLBACKS.moved >> $CALLBACKS.part
+
+    echo 'Finished push.'
+else
+    # Signal failure
+    sed 's/^push_success/push_failed/' $CALLBACKS.moved >> $CALLBACKS.part
+
+    echo "Push failed."
+fi
+
+# Remove the corrupt files
+cat > $CALLBACKS.hsi <<'_EOF_'
+%(rm_cmds)s
+_EOF_
+hsi -q "in $CALLBACKS.hsi"
+"""
+
+    dtstring = _hpss_job_name("push")
+
+    script = start % {
+        "offline_node_root": node.root,
+        "jobname": dtstring,
+        "cb_path": HPSS_SCRIPT_DIR,
+    }
+
+    req_dicts = [
+        {
             "file": req.file.name,
             "acq": req.file.acq.name,
             "node_root": req.node_from.root,
@@ -1024,8 +1876,43 @@ fi
             "cb_path": HPSS_SCRIPT_DIR,
             "dtstring": dtstring,
         }
+        for req in requests
+    ]
+
+    if hpss_batch_hsi:
+        # The commands run in each hsi session
+        put_cmds = []
+        lshash_cmds = []
+        rm_cmds = []
+        for acq in sorted(set(d["acq"] for d in req_dicts)):
+            put_cmds.append("mkdir -p %s/%s" % (node.root, acq))
+        for d in req_dicts:
+            tmp_path = "%s/%s/tmp.%s" % (node.root, d["acq"], d["file"])
+            put_cmds.append(
+                "put -c on -H md5 %s/%s/%s : %s"
+                % (d["node_root"], d["acq"], d["file"], tmp_path)
+            )
+            lshash_cmds.append("lshash %s" % tmp_path)
+            rm_cmds.append("rm %s" % tmp_path)
+
+        script += batch_start % {
+            "nfiles": len(req_dicts),
+            "put_cmds": "\n".join(put_cmds),
+            "lshash_cmds": "\n".join(lshash_cmds),
+        }
+
+        # Loop over files to check them
+        for req_dict in req_dicts:
+            script += batch_loop % req_dict
+
+        # Only the files which weren't moved into place are left to remove
+        script += batch_end % {"rm_cmds": "\n".join(rm_cmds)}
+    else:
+        script += loop_start
 
-        script += loop % req_dict
+        # Loop over files to construct push script
+        for req_dict in req_dicts:
+            script += loop % req_dict
 
     script_name = HPSS_SCRIPT_DIR + "/push_%s.sh" % dtstring
 
@@ -1046,6 +1933,16 @@ def _create_hpss_pull_script(requests, node):
 
 DESTDIR=%(online_node_root)s
 
+# Report the outcome of all the transfers in one go when the job exits. If the
+# job is killed before it can, alpenhornd applies $CALLBACKS.part once the job
+# has left the queue.
+CALLBACKS=%(cb_path)s/hpss-%(jobname)s-pull.callbacks
+trap 'rm -f $CALLBACKS.hsi; mv $CALLBACKS.part $CALLBACKS' EXIT
+trap 'exit 1' TERM
+touch $CALLBACKS.part
+"""
+
+    loop_start = """
 ## Looping section
 """
 
@@ -1074,8 +1971,7 @@ then
     mv $DESTDIR/%(acq)s/tmp.%(file)s $DESTDIR/%(acq)s/%(file)s
 
     # Signal success
-    #ssh %(host)s 'alpenhorn_hpss pull_success %(file_id)i %(node_id)i'
-    touch %(cb_path)s/hpss-%(dtstring)s-pull_success-%(file_id)i-%(node_id)i.callback
+    echo 'pull_success %(file_id)i %(node_id)i' >> $CALLBACKS.part
 
     echo 'Finished pull.'
 else
@@ -1083,21 +1979,71 @@ else
     rm $DESTDIR/%(acq)s/tmp.%(file)s
 
     # Signal failure
-    #ssh %(host)s 'alpenhorn_hpss pull_failed %(file_id)i %(node_id)i'
-    touch %(cb_path)s/hpss-%(dtstring)s-pull_failed-%(file_id)i-%(node_id)i.callback
+    echo 'pull_failed %(file_id)i %(node_id)i' >> $CALLBACKS.part
 
     echo "Pull failed."
 fi
 """
 
-    dtnow = datetime.datetime.now()
-    dtstring = dtnow.strftime("%Y%m%dT%H%M%S")
+    # When batched, all the files are copied out of HPSS in one hsi session,
+    # and then checked one at a time.
+    batch_start = """
+## Batch section
 
-    script = start % {"online_node_root": node.root, "jobname": dtstring}
+echo 'Starting pull of %(nfiles)i files'
 
-    # Loop over files to construct push script
-    for req in requests:
-        req_dict = {
+# Ensure the acquisition directories exist
+mkdir -p %(acq_dirs)s
+
+# Copy the files into temporary locations from HPSS offline
+cat > $CALLBACKS.hsi <<'_EOF_'
+%(get_cmds)s
+_EOF_
+hsi -q "in $CALLBACKS.hsi"
+"""
+
+    batch_loop = """
+######## Checking file %(acq)s/%(file)s ########
+
+# Set group read permissions
+chmod g+r $DESTDIR/%(acq)s/tmp.%(file)s
+
+# Calculate the MD5 hash of the file
+HPSSHASH=$(md5sum $DESTDIR/%(acq)s/tmp.%(file)s | awk '{print $1}')
+
+if [ "$HPSSHASH" == '%(file_hash)s' ]
+then
+    # Move the file into its final location
+    mv $DESTDIR/%(acq)s/tmp.%(file)s $DESTDIR/%(acq)s/%(file)s
+
+    # Signal success
+    echo 'pull_success %(file_id)i %(node_id)i' >> $CALLBACKS.part
+else
+    # Remove the corrupt file
+    rm -f $DESTDIR/%(acq)s/tmp.%(file)s
+
+    # Signal failure
+    echo 'pull_failed %(file_id)i %(node_id)i' >> $CALLBACKS.part
+
+    echo "Pull of %(acq)s/%(file)s failed."
+fi
+"""
+
+    batch_end = """
+
+echo 'Finished pull.'
+"""
+
+    dtstring = _hpss_job_name("pull")
+
+    script = start % {
+        "online_node_root": node.root,
+        "jobname": dtstring,
+        "cb_path": HPSS_SCRIPT_DIR,
+    }
+
+    req_dicts = [
+        {
             "file": req.file.name,
             "acq": req.file.acq.name,
             "node_root": req.node_from.root,
@@ -1108,8 +2054,36 @@ fi
             "cb_path": HPSS_SCRIPT_DIR,
             "dtstring": dtstring,
         }
+        for req in requests
+    ]
+
+    if hpss_batch_hsi:
+        acq_dirs = [
+            "$DESTDIR/%s" % acq for acq in sorted(set(d["acq"] for d in req_dicts))
+        ]
+        get_cmds = [
+            "get %s/%s/tmp.%s : %s/%s/%s"
+            % (node.root, d["acq"], d["file"], d["node_root"], d["acq"], d["file"])
+            for d in req_dicts
+        ]
+
+        script += batch_start % {
+            "nfiles": len(req_dicts),
+            "acq_dirs": " ".join(acq_dirs),
+            "get_cmds": "\n".join(get_cmds),
+        }
 
-        script += loop % req_dict
+        # Loop over files to check them
+        for req_dict in req_dicts:
+            script += batch_loop % req_dict
+
+        script += batch_end
+    else:
+        script += loop_start
+
+        # Loop over files to construct pull script
+        for req_dict in req_dicts:
+            script += loop % req_dict
 
     script_name = HPSS_SCRIPT_DIR + "/pull_%s.sh" % dtstring
 
@@ -1119,5 +2093,26 @@ fi
     return script_name
 
 
-def _submit_hpss_script(script):
-    os.system('ssh nia-login07 "cd %s; sbatch %s"' % os.path.split(script))
+def _submit_hpss_script(script, kind):
+    """Submit an HPSS job script, and track the job as being of type `kind`.
+
+    Returns
+    -------
+    job_id : string
+        The ID of the job, or None if it could not be submitted.
+    """
+    ret, out, err = run_command(
+        ssh.connections.command("nia-login07")
+        + ["nia-login07", "cd %s; sbatch --parsable %s" % os.path.split(script)]
+    )
+
+    if ret != 0:
+        log.error("Could not submit HPSS job %s: %s" % (script, err.strip()))
+        return None
+
+    # The output is the job ID, possibly followed by the cluster name
+    job_id = out.strip().split(";")[0]
+    log.info("Submitted HPSS job %s as job %s." % (script, job_id))
+    hpss_queue.submitted(job_id, kind)
+
+    return job_id
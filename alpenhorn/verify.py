@@ -0,0 +1,327 @@
+"""Checking the file copies on a node against the database."""
+
+# === Start Python 2/3 compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+from future.builtins import *  # noqa  pylint: disable=W0401, W0614
+from future.builtins.disabled import *  # noqa  pylint: disable=W0401, W0614
+
+# === End Python 2/3 compatibility
+
+import os
+import sqlite3
+import time
+from concurrent import futures
+
+from . import hashing
+
+# Outcomes of checking a file copy
+OK = "ok"
+MISSING = "missing"
+CORRUPT = "corrupt"
+
+# How thoroughly a copy is checked: whether the file exists, whether it has the
+# right size, or whether it has the right MD5 hash. Each includes the ones
+# before.
+CHECK_EXISTS = 0
+CHECK_SIZE = 1
+CHECK_MD5 = 2
+
+# Maximum number of seconds between saving progress to the state file
+CHECKPOINT_TIME = 10.0
+
+
+def check_copy(path, size, md5sum=None):
+    """Check a file copy against the database.
+
+    Parameters
+    ----------
+    path : string
+        The file to check.
+    size : int
+        The size of the file in the database.
+    md5sum : string, optional
+        The MD5 hash of the file in the database. If given, the file is
+        hashed, otherwise only its size is checked.
+
+    Returns
+    -------
+    result : string
+        One of `OK`, `MISSING` or `CORRUPT`.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return MISSING
+
+    # A file of the wrong size can't have the right hash
+    if size is not None and st.st_size != size:
+        return CORRUPT
+
+    if md5sum is not None and hashing.md5sum_file(path) != md5sum:
+        return CORRUPT
+
+    return OK
+
+
+def check_copies(copies, workers=1, md5=False):
+    """Check file copies on a pool of threads.
+
+    Only a few more copies than there are workers are taken from `copies` at a
+    time, so it can be a stream of any length.
+
+    Parameters
+    ----------
+    copies : iterable
+        Tuples of (key, path, size, md5sum) for each copy to check.
+    workers : int
+        The number of copies to check at once.
+    md5 : bool
+        Whether to check the MD5 hash of each copy, rather than just its size.
+
+    Yields
+    ------
+    key
+        The key of the copy checked. Copies are yielded in the order they
+        finish.
+    path : string
+        The file checked.
+    result : string
+        The outcome of the check.
+    """
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs = {}
+        for key, path, size, md5sum in copies:
+            job = pool.submit(check_copy, path, size, md5sum if md5 else None)
+            jobs[job] = (key, path)
+
+            if len(jobs) >= 2 * workers:
+                done, _ = futures.wait(jobs, return_when=futures.FIRST_COMPLETED)
+                for job in done:
+                    key, path = jobs.pop(job)
+                    yield key, path, job.result()
+
+        for job in futures.as_completed(jobs):
+            key, path = jobs[job]
+            yield key, path, job.result()
+
+
+def check_dir(dirpath, copies):
+    """Check that the file copies in a directory exist, from a single listing.
+
+    The directory is listed once, and the copies looked for amongst the names
+    listed. No file is stat'd, so cluster filesystems are spared a metadata
+    request for each one.
+
+    Parameters
+    ----------
+    dirpath : string
+        The directory.
+    copies : list
+        Tuples of (key, name, size) for each copy in the directory.
+
+    Returns
+    -------
+    results : list
+        Tuples of (key, path, result) for each copy.
+    """
+    # If the directory can't be listed, all of its files are missing
+    try:
+        with os.scandir(dirpath) as entries:
+            names = set(entry.name for entry in entries if entry.is_file())
+    except OSError:
+        names = set()
+
+    return [
+        (key, os.path.join(dirpath, name), OK if name in names else MISSING)
+        for key, name, size in copies
+    ]
+
+
+def by_dir(copies):
+    """Group a stream of copies by directory, for `check_dirs`.
+
+    Parameters
+    ----------
+    copies : iterable
+        Tuples of (key, path, size, md5sum), ordered by path.
+
+    Yields
+    ------
+    dirpath : string
+        A directory.
+    copies : list
+        Tuples of (key, name, size) for consecutive copies in the directory.
+    """
+    dirpath = None
+    group = []
+    for key, path, size, md5sum in copies:
+        head, name = os.path.split(path)
+        if head != dirpath and group:
+            yield dirpath, group
+            group = []
+        dirpath = head
+        group.append((key, name, size))
+
+    if group:
+        yield dirpath, group
+
+
+def check_dirs(dirs, workers=1):
+    """Check that file copies exist a directory at a time, on a pool of threads.
+
+    Parameters
+    ----------
+    dirs : iterable
+        Pairs of (directory, copies), as yielded by `by_dir`.
+    workers : int
+        The number of directories to check at once.
+
+    Yields
+    ------
+    key, path, result
+        As for `check_copies`.
+    """
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs = set()
+        for dirpath, copies in dirs:
+            jobs.add(pool.submit(check_dir, dirpath, copies))
+
+            if len(jobs) >= 2 * workers:
+                done, jobs = futures.wait(jobs, return_when=futures.FIRST_COMPLETED)
+                for job in done:
+                    for result in job.result():
+                        yield result
+
+        for job in futures.as_completed(jobs):
+            for result in job.result():
+                yield result
+
+
+class VerifyState(object):
+    """The progress of verifying the copies on a node, kept in an SQLite file.
+
+    The outcome and time of the last check of each copy, and the run which
+    made it, are recorded, so that an interrupted run can be resumed, and
+    copies checked recently skipped.
+
+    Parameters
+    ----------
+    path : string
+        The state file. If ":memory:", nothing is kept between runs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS copies "
+            "(id INTEGER PRIMARY KEY, path TEXT, level INTEGER, result TEXT, "
+            "time REAL, run INTEGER)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS runs "
+            "(id INTEGER PRIMARY KEY, options TEXT, start REAL, finish REAL)"
+        )
+        self._conn.commit()
+
+        self._run_id = None
+        self._last_commit = time.time()
+
+    def start_run(self, options):
+        """Start a run, or resume the last unfinished run with the same options.
+
+        Parameters
+        ----------
+        options : string
+            Describes the node and options of the run.
+
+        Returns
+        -------
+        start : float
+            The time the run started.
+        resumed : bool
+            Whether an unfinished run is being resumed.
+        """
+        row = self._conn.execute(
+            "SELECT id, start FROM runs WHERE options = ? AND finish IS NULL "
+            "ORDER BY id DESC LIMIT 1",
+            (options,),
+        ).fetchone()
+        if row is not None:
+            self._run_id, start = row
+            return start, True
+
+        start = time.time()
+        self._run_id = self._conn.execute(
+            "INSERT INTO runs (options, start) VALUES (?, ?)", (options, start)
+        ).lastrowid
+        self._conn.commit()
+        return start, False
+
+    def finish_run(self):
+        """Record that the current run checked every copy."""
+        self._conn.execute(
+            "UPDATE runs SET finish = ? WHERE id = ?", (time.time(), self._run_id)
+        )
+        self._conn.commit()
+
+    def checked(self, copy_id, level=CHECK_SIZE):
+        """When copy `copy_id` was last checked, at least as thoroughly as `level`.
+
+        Returns
+        -------
+        time : float
+            The time of the check, or None if it hasn't been checked.
+        result : string
+            The outcome of the check, or None.
+        this_run : bool
+            Whether the check was made by the current run.
+        """
+        row = self._conn.execute(
+            "SELECT time, result, run FROM copies WHERE id = ? AND level >= ?",
+            (copy_id, level),
+        ).fetchone()
+        if row is None:
+            return None, None, False
+        return row[0], row[1], row[2] == self._run_id
+
+    def record(self, copy_id, path, level, result):
+        """Record the outcome of checking a copy in the current run, at `level`.
+
+        Progress is saved to the file at most every `CHECKPOINT_TIME` seconds.
+        """
+        self._conn.execute(
+            "INSERT OR REPLACE INTO copies (id, path, level, result, time, run) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (copy_id, path, level, result, time.time(), self._run_id),
+        )
+        if time.time() - self._last_commit > CHECKPOINT_TIME:
+            self.commit()
+
+    def commit(self):
+        """Save the progress made."""
+        self._conn.commit()
+        self._last_commit = time.time()
+
+    def problems(self):
+        """The copies found missing or corrupt by the current run.
+
+        Copies checked again since, by another run, are left to that run.
+
+        Yields
+        ------
+        copy_id : int
+        path : string
+        result : string
+        """
+        for row in self._conn.execute(
+            "SELECT id, path, result FROM copies WHERE run = ? AND result != ? "
+            "ORDER BY path",
+            (self._run_id, OK),
+        ):
+            yield row
+
+    def close(self):
+        self.commit()
+        self._conn.close()
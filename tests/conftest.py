@@ -0,0 +1,6 @@
+"""Common setup of the tests."""
+
+import os
+
+# Log to stdout only, rather than to the daemon's log file
+os.environ.setdefault("ALPENHORN_LOG_FILE", "")
@@ -0,0 +1,100 @@
+"""Tests of the queue of files waiting to be imported."""
+
+# === Start Python 2/3 compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+from future.builtins import *  # noqa  pylint: disable=W0401, W0614
+from future.builtins.disabled import *  # noqa  pylint: disable=W0401, W0614
+
+# === End Python 2/3 compatibility
+
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("chimedb.data_index")
+
+from alpenhorn import auto_import  # noqa: E402
+
+NODE1 = SimpleNamespace(id=1, name="node1")
+NODE2 = SimpleNamespace(id=2, name="node2")
+
+
+@pytest.fixture
+def imports(monkeypatch):
+    """Record the batches of files imported, rather than importing them."""
+    batches = []
+    lock = threading.Lock()
+
+    def import_files(node, root, acq_name, file_names):
+        with lock:
+            batches.append((node.id, acq_name, list(file_names)))
+
+    monkeypatch.setattr(auto_import, "import_files", import_files)
+    return batches
+
+
+def test_file_queued_once_while_waiting(imports):
+    queue = auto_import.ImportQueue()
+
+    queue.put(NODE1, "/root", "acq", "f1")
+    queue.put(NODE1, "/root", "acq", "f1")
+    assert queue.depth == 1
+
+
+def test_batches_by_acquisition(imports, monkeypatch):
+    monkeypatch.setattr(auto_import, "IMPORT_BATCH_SIZE", 2)
+    queue = auto_import.ImportQueue()
+
+    queue.put(NODE1, "/root", "acq1", "f1")
+    queue.put(NODE1, "/root", "acq2", "f2")
+    queue.put(NODE1, "/root", "acq1", "f3")
+    queue.put(NODE2, "/root", "acq1", "f4")
+    queue.put(NODE1, "/root", "acq1", "f5")
+
+    def names(batch):
+        return [item[4] for item in batch]
+
+    # Files from the same acquisition on the same node are taken together, up
+    # to the batch size, in the order they were queued
+    assert names(queue._get()) == ["f1", "f3"]
+    assert names(queue._get()) == ["f2"]
+    assert names(queue._get()) == ["f4"]
+    assert names(queue._get()) == ["f5"]
+    assert queue.depth == 0
+
+
+def test_file_being_imported_not_taken_again(imports):
+    queue = auto_import.ImportQueue()
+
+    queue.put(NODE1, "/root", "acq", "f1")
+    batch = queue._get()
+
+    # Queued again while it is being imported: it waits for that to finish
+    queue.put(NODE1, "/root", "acq", "f1")
+    queue.put(NODE1, "/root", "acq", "f2")
+    assert [item[4] for item in queue._get()] == ["f2"]
+
+    queue._done([item[0] for item in batch])
+    assert [item[4] for item in queue._get()] == ["f1"]
+
+
+def test_workers_import_everything(imports):
+    queue = auto_import.ImportQueue(workers=3)
+    queue.start()
+
+    for i in range(50):
+        queue.put(NODE1 if i % 2 else NODE2, "/root", "acq%i" % (i % 4), "f%i" % i)
+    queue.import_now(NODE1, "/root", "acq9", ["g1", "g2"])
+
+    # Wait for the queue to drain, then for the last imports to finish
+    with queue._cond:
+        while queue._queue or queue._active:
+            queue._cond.wait()
+    queue.stop()
+    queue.join()
+
+    imported = sorted(name for node_id, acq, names in imports for name in names)
+    assert imported == sorted(["f%i" % i for i in range(50)] + ["g1", "g2"])
+    for node_id, acq, names in imports:
+        assert all(int(name[1:]) % 4 == int(acq[3:]) for name in names if acq != "acq9")
@@ -0,0 +1,82 @@
+"""Tests of the hashing of files."""
+
+# === Start Python 2/3 compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+from future.builtins import *  # noqa  pylint: disable=W0401, W0614
+from future.builtins.disabled import *  # noqa  pylint: disable=W0401, W0614
+
+# === End Python 2/3 compatibility
+
+import hashlib
+import threading
+import time
+from concurrent import futures
+
+from alpenhorn import hashing
+
+
+def test_md5sum_file(tmp_path, monkeypatch):
+    # Several blocks, the last one partial
+    monkeypatch.setattr(hashing, "BLOCK_SIZE", 1000)
+    data = bytes(range(256)) * 10
+    path = tmp_path / "file"
+    path.write_bytes(data)
+
+    stats = hashing.HashStats()
+    assert hashing.md5sum_file(str(path), stats=stats) == hashlib.md5(data).hexdigest()
+    assert (stats.files, stats.bytes) == (1, len(data))
+
+
+def test_md5sum_files(tmp_path):
+    data = dict(("f%i" % i, b"x" * i) for i in range(5))
+    for name, content in data.items():
+        (tmp_path / name).write_bytes(content)
+
+    # A directory exists, but can't be read as a file
+    (tmp_path / "dir").mkdir()
+
+    paths = [str(tmp_path / name) for name in list(data) + ["missing", "dir"]]
+    stats = hashing.HashStats()
+    results = dict(hashing.md5sum_files(paths, workers=3, stats=stats))
+
+    for name, content in data.items():
+        assert results[str(tmp_path / name)] == hashlib.md5(content).hexdigest()
+    assert results[str(tmp_path / "missing")] is None
+    assert results[str(tmp_path / "dir")] == hashing.UNREADABLE
+    assert (stats.files, stats.bytes) == (5, sum(len(c) for c in data.values()))
+
+
+def test_md5sum_files_on_pool(tmp_path):
+    path = tmp_path / "file"
+    path.write_bytes(b"abc")
+
+    with futures.ThreadPoolExecutor(max_workers=2) as pool:
+        for i in range(2):
+            results = list(hashing.md5sum_files([str(path)], pool=pool))
+            assert results == [(str(path), hashlib.md5(b"abc").hexdigest())]
+
+
+def test_rate_limiter_unlimited():
+    limiter = hashing.RateLimiter()
+
+    start = time.time()
+    limiter.consume(10**12)
+    assert time.time() - start < 0.1
+
+
+def test_rate_limiter_shared_between_threads():
+    limiter = hashing.RateLimiter(bytes_per_second=1000)
+
+    def read():
+        for i in range(5):
+            limiter.consume(20)
+
+    # 200 bytes read in all, of which the first 20 are free
+    start = time.time()
+    threads = [threading.Thread(target=read) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert 0.17 < time.time() - start < 0.5
@@ -0,0 +1,172 @@
+"""Tests of the maintained per-node file totals."""
+
+# === Start Python 2/3 compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+from future.builtins import *  # noqa  pylint: disable=W0401, W0614
+from future.builtins.disabled import *  # noqa  pylint: disable=W0401, W0614
+
+# === End Python 2/3 compatibility
+
+import peewee as pw
+import pytest
+
+pytest.importorskip("chimedb.data_index")
+
+import chimedb.core as db  # noqa: E402
+import chimedb.data_index as di  # noqa: E402
+
+from alpenhorn import nodestats  # noqa: E402
+
+MODELS = [
+    di.StorageGroup,
+    di.StorageNode,
+    di.ArchiveInst,
+    di.AcqType,
+    di.FileType,
+    di.ArchiveAcq,
+    di.ArchiveFile,
+    di.ArchiveFileCopy,
+]
+
+
+@pytest.fixture
+def archive(monkeypatch):
+    """Two nodes holding some of ten files, in a fresh in-memory database.
+
+    Returns the nodes and the files. Node 1 has all the files, node 2 has the
+    even numbered ones, and has a copy of each odd one which is suspect.
+    """
+    db.proxy.initialize(pw.SqliteDatabase(":memory:"))
+    db.proxy.create_tables(MODELS + [nodestats.NodeStats])
+    monkeypatch.setattr(nodestats, "_have_table", None)
+
+    group = di.StorageGroup.create(name="group")
+    nodes = [
+        di.StorageNode.create(name="node%i" % i, group=group, root="/node%i" % i)
+        for i in (1, 2)
+    ]
+
+    acq = di.ArchiveAcq.create(
+        name="acq",
+        inst=di.ArchiveInst.create(name="inst"),
+        type=di.AcqType.create(name="corr"),
+    )
+    ftype = di.FileType.create(name="corr")
+    files = [
+        di.ArchiveFile.create(acq=acq, type=ftype, name="f%i" % i, size_b=100 + i)
+        for i in range(10)
+    ]
+
+    for f in files:
+        di.ArchiveFileCopy.create(file=f, node=nodes[0], has_file="Y")
+        di.ArchiveFileCopy.create(
+            file=f, node=nodes[1], has_file="M" if f.size_b % 2 else "Y"
+        )
+
+    yield nodes, files
+
+    db.proxy.close()
+
+
+def test_totals_computed_until_stored(archive):
+    nodes, files = archive
+    ids = [nodes[0].id, nodes[1].id, None]
+    expected = {
+        nodes[0].id: (10, sum(f.size_b for f in files)),
+        nodes[1].id: (5, sum(f.size_b for f in files[::2])),
+        None: (10, sum(f.size_b for f in files)),
+    }
+
+    assert nodestats.totals(ids) == expected
+    assert nodestats.NodeStats.select().count() == 0
+
+    assert nodestats.totals(ids, store=True) == expected
+    assert nodestats.NodeStats.select().count() == 3
+    assert nodestats.totals(ids) == expected
+
+
+def test_store_keeps_existing_totals(archive):
+    nodes, files = archive
+
+    nodestats._store({nodes[0].id: (1, 2)})
+    nodestats.totals([nodes[0].id, nodes[1].id], store=True)
+
+    assert nodestats.node_totals(nodes[0]) == (1, 2)
+    assert nodestats.NodeStats.select().count() == 2
+
+
+def test_add_adjusts_stored_totals_only(archive):
+    nodes, files = archive
+
+    nodestats.totals([None, nodes[0].id], store=True)
+    nodestats.add(None, 2, 50)
+    nodestats.add(nodes[0], -1, -100)
+    nodestats.add(nodes[1].id, 1, 10)
+
+    totals = nodestats.totals([None, nodes[0].id, nodes[1].id])
+    assert totals[None] == (12, sum(f.size_b for f in files) + 50)
+    assert totals[nodes[0].id] == (9, sum(f.size_b for f in files) - 100)
+
+    # Not stored, so computed from the copies
+    assert totals[nodes[1].id] == (5, sum(f.size_b for f in files[::2]))
+
+
+def test_update_copies_counts_changes_of_state(archive):
+    nodes, files = archive
+    nodestats.refresh()
+
+    # Copies already present are not counted again, suspect ones are added
+    n = nodestats.update_copies(di.ArchiveFileCopy.node == nodes[1], "Y")
+    assert n == 10
+    assert nodestats.node_totals(nodes[1]) == (10, sum(f.size_b for f in files))
+
+    # Copies going from one absent state to another don't change the totals
+    nodestats.update_copies(di.ArchiveFileCopy.node == nodes[0], "N")
+    nodestats.update_copies(di.ArchiveFileCopy.node == nodes[0], "M")
+    assert nodestats.node_totals(nodes[0]) == (0, 0)
+
+    # Other fields are set too
+    nodestats.update_copies(di.ArchiveFileCopy.node == nodes[0], "Y", wants_file="N")
+    assert nodestats.node_totals(nodes[0]) == (10, sum(f.size_b for f in files))
+    assert (
+        di.ArchiveFileCopy.select().where(di.ArchiveFileCopy.wants_file == "N").count()
+        == 10
+    )
+
+    # The stored totals agree with those computed in full
+    stored = nodestats.totals([nodes[0].id, nodes[1].id])
+    assert stored == nodestats._aggregate([nodes[0].id, nodes[1].id], archive=False)
+
+
+def test_refresh_replaces_totals(archive):
+    nodes, files = archive
+
+    nodestats._store({None: (1, 1), nodes[0].id: (1, 1)})
+    nodestats.refresh()
+
+    assert nodestats.totals([None, nodes[0].id]) == {
+        None: (10, sum(f.size_b for f in files)),
+        nodes[0].id: (10, sum(f.size_b for f in files)),
+    }
+    assert (
+        nodestats.NodeStats.select()
+        .where(nodestats.NodeStats.scope == "archive")
+        .count()
+        == 1
+    )
+
+
+def test_without_table(archive, monkeypatch):
+    nodes, files = archive
+    db.proxy.drop_tables([nodestats.NodeStats])
+    monkeypatch.setattr(nodestats, "_have_table", None)
+
+    assert nodestats.node_totals(nodes[1], store=True) == (
+        5,
+        sum(f.size_b for f in files[::2]),
+    )
+    nodestats.refresh()
+    nodestats.add(nodes[1], 1, 1)
+    nodestats.update_copies(di.ArchiveFileCopy.node == nodes[1], "Y")
+
+    assert not nodestats.table_exists()
@@ -0,0 +1,128 @@
+"""Tests of the scheduling of the stages of node updates."""
+
+# === Start Python 2/3 compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+from future.builtins import *  # noqa  pylint: disable=W0401, W0614
+from future.builtins.disabled import *  # noqa  pylint: disable=W0401, W0614
+
+# === End Python 2/3 compatibility
+
+import threading
+import time
+
+import pytest
+
+from alpenhorn import schedule
+
+
+class Clock(object):
+    """A stand-in for the `time` module whose time is set by the test."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(schedule, "time", clock)
+    return clock
+
+
+def _schedule():
+    return schedule.NodeSchedule({"a": 10, "b": 100}, idle_runs=2, max_backoff=4)
+
+
+def test_stages_due_until_run(clock):
+    sched = _schedule()
+    assert sched.due(1) == ["a", "b"]
+
+    sched.done(1, "a")
+    assert sched.due(1) == ["b"]
+    assert sched.due(2) == ["a", "b"]
+
+    clock.now += 10
+    assert sched.due(1) == ["a", "b"]
+
+
+def test_stage_with_work_due_again(clock):
+    sched = _schedule()
+    sched.done(1, "a", 5)
+    assert "a" in sched.due(1)
+
+
+def test_idle_stage_backs_off(clock):
+    sched = _schedule()
+
+    # Idle runs up to `idle_runs` keep the cadence, then it doubles each run,
+    # up to `max_backoff` times
+    for delay in [10, 10, 20, 40, 40]:
+        sched.done(1, "a", 0)
+        clock.now += delay - 1
+        assert "a" not in sched.due(1)
+        clock.now += 1
+        assert "a" in sched.due(1)
+
+    # Doing some work resets the backoff
+    sched.done(1, "a", 1)
+    sched.done(1, "a", 0)
+    clock.now += 10
+    assert "a" in sched.due(1)
+
+
+def test_wake(clock):
+    sched = _schedule()
+    for node_id in (1, 2):
+        for stage in ("a", "b"):
+            for i in range(5):
+                sched.done(node_id, stage, 0)
+
+    sched.wake(["a"], node_id=1)
+    assert sched.due(1) == ["a"]
+    assert sched.due(2) == []
+
+    # Woken stages no longer back off
+    sched.done(1, "a", 0)
+    clock.now += 10
+    assert sched.due(1) == ["a"]
+
+    sched.wake()
+    assert sched.due(1) == ["a", "b"]
+    assert sched.due(2) == ["a", "b"]
+
+
+def test_retain(clock):
+    sched = _schedule()
+    sched.done(1, "a")
+    sched.done(2, "a")
+
+    sched.retain([2])
+    assert sched.due(1) == ["a", "b"]
+    assert sched.due(2) == ["b"]
+
+
+def test_wait_woken():
+    sched = _schedule()
+    sched.done(1, "a")
+
+    thread = threading.Timer(0.1, sched.wake, [["a"]])
+    thread.start()
+
+    start = time.time()
+    sched.wait(5)
+    thread.join()
+    assert time.time() - start < 2
+    assert sched.due(1) == ["a", "b"]
+
+
+def test_wait_until_due():
+    sched = schedule.NodeSchedule({"a": 0.1})
+    sched.done(1, "a")
+
+    start = time.time()
+    sched.wait(5)
+    assert 0.05 < time.time() - start < 2
+    assert sched.due(1) == ["a"]
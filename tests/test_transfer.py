@@ -0,0 +1,121 @@
+"""Tests of the transfer scheduler."""
+
+# === Start Python 2/3 compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+from future.builtins import *  # noqa  pylint: disable=W0401, W0614
+from future.builtins.disabled import *  # noqa  pylint: disable=W0401, W0614
+
+# === End Python 2/3 compatibility
+
+import sys
+import time
+from types import SimpleNamespace
+
+from alpenhorn import transfer
+
+
+def _node(node_id):
+    return SimpleNamespace(id=node_id)
+
+
+def _req(file_id, host, size_b=100):
+    return SimpleNamespace(
+        file_id=file_id,
+        file=SimpleNamespace(size_b=size_b),
+        node_from=SimpleNamespace(host=host),
+    )
+
+
+def _wait(scheduler, node, timeout=10):
+    """Poll `node` until a transfer onto it finishes."""
+    end = time.time() + timeout
+    while time.time() < end:
+        finished = scheduler.poll(node)
+        if finished:
+            return finished
+        time.sleep(0.01)
+    raise AssertionError("transfer did not finish")
+
+
+def test_reserve_limits_per_node():
+    scheduler = transfer.TransferScheduler(max_per_node=2, max_per_host=10)
+    node = _node(1)
+
+    slots = [scheduler.reserve(_req(i, "h%i" % i), node) for i in range(3)]
+
+    assert slots[0] is not None and slots[1] is not None
+    assert slots[2] is None
+    assert scheduler.running(node) == 2
+
+    # Another node has its own slots
+    assert scheduler.reserve(_req(3, "h3"), _node(2)) is not None
+
+
+def test_reserve_limits_per_host():
+    scheduler = transfer.TransferScheduler(max_per_node=10, max_per_host=1)
+
+    assert scheduler.reserve(_req(1, "h"), _node(1)) is not None
+    assert scheduler.reserve(_req(2, "h"), _node(2)) is None
+    assert scheduler.reserve(_req(3, "other"), _node(2)) is not None
+
+
+def test_release_frees_slot():
+    scheduler = transfer.TransferScheduler()
+    node = _node(1)
+
+    slot = scheduler.reserve(_req(1, "h"), node)
+    assert scheduler.in_flight(1, node)
+    assert scheduler.reserve(_req(2, "h"), node) is None
+
+    scheduler.release(slot)
+    assert not scheduler.in_flight(1, node)
+    assert scheduler.running() == 0
+    assert scheduler.reserve(_req(2, "h"), node) is not None
+
+
+def test_reserved_slot_counts_but_never_finishes():
+    scheduler = transfer.TransferScheduler(max_per_node=2, max_per_host=2)
+    node = _node(1)
+
+    scheduler.reserve(_req(1, "h", size_b=300), node)
+
+    assert scheduler.bytes_in_flight(node) == 300
+    assert scheduler.poll(node) == []
+    assert scheduler.running(node) == 1
+
+
+def test_completed_transfer_is_polled_once():
+    scheduler = transfer.TransferScheduler()
+    node = _node(1)
+    req = _req(1, "h")
+
+    slot = scheduler.reserve(req, node)
+    xfer = transfer.Transfer(req, node, ret=0)
+    scheduler.start(slot, xfer)
+
+    assert scheduler.poll(node) == [xfer]
+    assert scheduler.poll(node) == []
+    assert scheduler.running() == 0
+
+
+def test_command_runs_across_polls():
+    scheduler = transfer.TransferScheduler()
+    node = _node(1)
+    req = _req(1, "h")
+
+    def check(xfer):
+        xfer.md5sum = xfer.stdout.strip()
+
+    slot = scheduler.reserve(req, node)
+    cmd = [sys.executable, "-c", "import time; time.sleep(0.2); print('abc')"]
+    xfer = transfer.Transfer(req, node, cmd=cmd, check=check)
+    scheduler.start(slot, xfer)
+
+    # Still running: the slot stays held
+    assert scheduler.poll(node) == []
+    assert scheduler.reserve(_req(2, "h"), node) is None
+
+    assert _wait(scheduler, node) == [xfer]
+    assert xfer.ret == 0
+    assert xfer.md5sum == "abc"
+    assert scheduler.running(node) == 0
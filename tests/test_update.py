@@ -0,0 +1,167 @@
+"""Tests of the batch queue state used to manage HPSS jobs."""
+
+# === Start Python 2/3 compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+from future.builtins import *  # noqa  pylint: disable=W0401, W0614
+from future.builtins.disabled import *  # noqa  pylint: disable=W0401, W0614
+
+# === End Python 2/3 compatibility
+
+import time
+
+import pytest
+
+pytest.importorskip("chimedb.data_index")
+
+from alpenhorn import update  # noqa: E402
+
+
+class Queue(object):
+    """A batch queue whose jobs can be set, and which can be made to fail."""
+
+    def __init__(self, jobs=()):
+        self.jobs = list(jobs)
+        self.fail = False
+        self.nqueries = 0
+
+    def __call__(self):
+        self.nqueries += 1
+        if self.fail:
+            return None
+        return list(self.jobs)
+
+
+def _job(job_id, name, state="PD", partition="archivelong"):
+    return {"JOBID": job_id, "NAME": name, "ST": state, "PARTITION": partition}
+
+
+def test_jobs_cached_until_invalidated():
+    queue = Queue([_job("1", "push_a")])
+    state = update.SchedulerState(queue, ttl=60)
+
+    assert state.jobs() == queue.jobs
+    assert state.known
+    state.jobs()
+    assert queue.nqueries == 1
+
+    state.invalidate()
+    state.jobs()
+    assert queue.nqueries == 2
+
+
+def test_failed_query_keeps_last_state():
+    queue = Queue([_job("1", "push_a")])
+    state = update.SchedulerState(queue, ttl=60)
+    jobs = state.jobs()
+
+    queue.fail = True
+    state.invalidate()
+    assert state.jobs() == jobs
+    assert not state.known
+
+    queue.fail = False
+    state.invalidate()
+    state.jobs()
+    assert state.known
+
+
+def test_unknown_until_first_query_succeeds():
+    queue = Queue()
+    queue.fail = True
+    state = update.SchedulerState(queue, ttl=60)
+
+    assert state.jobs() == []
+    assert not state.known
+
+
+def test_submitted_jobs_tracked_for_grace_period():
+    queue = Queue()
+    state = update.SchedulerState(queue, ttl=0.2)
+
+    # Not in the queue yet, but only just submitted
+    state.submitted("7", "push")
+    assert state.in_flight("push") == ["7"]
+    assert state.in_flight("pull") == []
+
+    # Still not in the queue once the grace period is over
+    time.sleep(0.3)
+    assert state.in_flight() == []
+
+
+def test_submitted_jobs_tracked_while_queued():
+    queue = Queue([_job("7", "push_a", "R")])
+    state = update.SchedulerState(queue, ttl=0.1)
+    state.submitted("7", "push")
+
+    time.sleep(0.2)
+    assert state.in_flight() == ["7"]
+
+    queue.jobs = []
+    time.sleep(0.2)
+    assert state.in_flight() == []
+
+
+def test_submitted_jobs_kept_when_query_fails():
+    queue = Queue()
+    state = update.SchedulerState(queue, ttl=0.1)
+    state.submitted("7", "push")
+
+    queue.fail = True
+    time.sleep(0.2)
+    assert state.in_flight() == ["7"]
+
+
+def test_pending_jobs(monkeypatch):
+    queue = Queue(
+        [
+            _job("1", "push_a"),
+            _job("2", "push_b", state="R"),
+            _job("3", "pull_a"),
+            _job("4", "push_c", partition="debug"),
+        ]
+    )
+    state = update.SchedulerState(queue, ttl=60)
+    state.submitted("5", "push")
+    state.submitted("2", "push")
+    monkeypatch.setattr(update, "hpss_queue", state)
+
+    # Only jobs waiting in the archivelong partition, or not yet queued, count
+    assert update._hpss_jobs_pending("push") == set(["1", "5"])
+    assert update._hpss_jobs_pending("pull") == set(["3"])
+
+
+def test_slurm_jobs_failure(monkeypatch):
+    monkeypatch.setattr(
+        update, "run_command", lambda cmd: (1, "", "slurm_load_jobs error")
+    )
+    assert update.slurm_jobs() is None
+
+    monkeypatch.setattr(
+        update, "run_command", lambda cmd: (0, "12|PD|archivelong|push_a\n", "")
+    )
+    assert update.slurm_jobs() == [_job("12", "push_a")]
+
+
+def test_part_callbacks_kept_while_queue_unknown(tmp_path, monkeypatch):
+    part = tmp_path / "hpss-a-push.callbacks.part"
+    part.write_text("push_success 1 2\n")
+
+    applied = []
+    monkeypatch.setattr(update, "HPSS_SCRIPT_DIR", str(tmp_path))
+    monkeypatch.setattr(update, "_hpss_callback_mtime", None)
+    monkeypatch.setattr(update.hpss_callback, "apply_callbacks", applied.extend)
+
+    queue = Queue()
+    queue.fail = True
+    monkeypatch.setattr(update, "hpss_queue", update.SchedulerState(queue, ttl=60))
+
+    update.run_hpss_callbacks_from_file()
+    assert part.exists()
+    assert applied == []
+
+    # Once the queue shows the job has gone, they are applied
+    queue.fail = False
+    update.hpss_queue.invalidate()
+    update.run_hpss_callbacks_from_file()
+    assert not part.exists()
+    assert len(applied) == 1
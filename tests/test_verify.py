@@ -0,0 +1,140 @@
+"""Tests of the checks of file copies made by `alpenhorn verify`."""
+
+# === Start Python 2/3 compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+from future.builtins import *  # noqa  pylint: disable=W0401, W0614
+from future.builtins.disabled import *  # noqa  pylint: disable=W0401, W0614
+
+# === End Python 2/3 compatibility
+
+from alpenhorn import verify
+
+
+def test_state_resumes_unfinished_run(tmp_path):
+    path = str(tmp_path / "state")
+
+    state = verify.VerifyState(path)
+    start, resumed = state.start_run("node=a")
+    assert not resumed
+    state.record(1, "/a/1", verify.CHECK_SIZE, verify.OK)
+    state.record(2, "/a/2", verify.CHECK_SIZE, verify.MISSING)
+    state.close()
+
+    # Interrupted: the next run with the same options carries on
+    state = verify.VerifyState(path)
+    assert state.start_run("node=a") == (start, True)
+    assert state.checked(1)[1:] == (verify.OK, True)
+    assert state.checked(3) == (None, None, False)
+    state.record(3, "/a/3", verify.CHECK_SIZE, verify.CORRUPT)
+    state.finish_run()
+
+    assert list(state.problems()) == [
+        (2, "/a/2", verify.MISSING),
+        (3, "/a/3", verify.CORRUPT),
+    ]
+    state.close()
+
+    # Finished: a new run is started, which knows about the earlier checks
+    state = verify.VerifyState(path)
+    assert not state.start_run("node=a")[1]
+    checked_time, result, this_run = state.checked(1)
+    assert checked_time is not None
+    assert (result, this_run) == (verify.OK, False)
+    assert list(state.problems()) == []
+    state.close()
+
+
+def test_state_checks_as_thorough(tmp_path):
+    state = verify.VerifyState(":memory:")
+    state.start_run("node=a")
+    state.record(1, "/a/1", verify.CHECK_SIZE, verify.OK)
+    state.record(2, "/a/2", verify.CHECK_MD5, verify.OK)
+
+    # A size check doesn't count as an MD5 check, but does as an existence one
+    assert state.checked(1, verify.CHECK_MD5) == (None, None, False)
+    assert state.checked(1, verify.CHECK_EXISTS)[1:] == (verify.OK, True)
+    assert state.checked(2, verify.CHECK_SIZE)[1:] == (verify.OK, True)
+
+
+def test_problems_of_other_runs_not_reported(tmp_path):
+    path = str(tmp_path / "state")
+
+    # Two runs with different options, at the same time
+    first = verify.VerifyState(path)
+    first.start_run("node=a level=1")
+    second = verify.VerifyState(path)
+    second.start_run("node=a level=2")
+
+    first.record(1, "/a/1", verify.CHECK_SIZE, verify.CORRUPT)
+    first.commit()
+    second.record(2, "/a/2", verify.CHECK_MD5, verify.MISSING)
+    second.commit()
+
+    assert list(first.problems()) == [(1, "/a/1", verify.CORRUPT)]
+    assert list(second.problems()) == [(2, "/a/2", verify.MISSING)]
+
+    first.close()
+    second.close()
+
+
+def test_nothing_saved_in_memory():
+    state = verify.VerifyState(":memory:")
+    state.start_run("node=a")
+    state.record(1, "/a/1", verify.CHECK_SIZE, verify.OK)
+    state.close()
+
+    state = verify.VerifyState(":memory:")
+    assert not state.start_run("node=a")[1]
+    assert state.checked(1) == (None, None, False)
+
+
+def test_check_dir(tmp_path):
+    (tmp_path / "a").write_bytes(b"abc")
+    (tmp_path / "b").write_bytes(b"abcdef")
+    (tmp_path / "c").mkdir()
+
+    copies = [(1, "a", 3), (2, "b", 3), (3, "c", 0), (4, "d", 0)]
+    results = verify.check_dir(str(tmp_path), copies)
+
+    # Only whether the files exist is checked, not their sizes
+    assert [(key, result) for key, path, result in results] == [
+        (1, verify.OK),
+        (2, verify.OK),
+        (3, verify.MISSING),
+        (4, verify.MISSING),
+    ]
+    assert results[0][1] == str(tmp_path / "a")
+
+
+def test_check_dir_unlisted(tmp_path):
+    results = verify.check_dir(str(tmp_path / "none"), [(1, "a", 3)])
+    assert results == [(1, str(tmp_path / "none" / "a"), verify.MISSING)]
+
+
+def test_check_dirs(tmp_path):
+    paths = []
+    for d in range(3):
+        (tmp_path / str(d)).mkdir()
+        for f in range(3):
+            path = tmp_path / str(d) / str(f)
+            if f != d:
+                path.write_bytes(b"x")
+            paths.append(str(path))
+
+    copies = [(i, path, 1, None) for i, path in enumerate(paths)]
+    results = verify.check_dirs(verify.by_dir(copies), workers=2)
+
+    missing = sorted(key for key, path, result in results if result == verify.MISSING)
+    assert missing == [0, 4, 8]
+
+
+def test_check_copy(tmp_path):
+    path = tmp_path / "a"
+    path.write_bytes(b"abc")
+    md5sum = "900150983cd24fb0d6963f7d28e17f72"
+
+    assert verify.check_copy(str(path), 3) == verify.OK
+    assert verify.check_copy(str(path), 4) == verify.CORRUPT
+    assert verify.check_copy(str(path), 3, md5sum) == verify.OK
+    assert verify.check_copy(str(path), 3, "0" * 32) == verify.CORRUPT
+    assert verify.check_copy(str(tmp_path / "b"), 3) == verify.MISSING